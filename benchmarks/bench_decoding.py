@@ -0,0 +1,51 @@
+"""
+Measures how fast a recorded vehicle state response is decoded from the raw
+bytes read off the wire down to the vehicleState the collectors read, with
+each available decoder.  "json-str" is what ClientResponse.json() does: decode
+the bytes to a str and then parse it with the stdlib.  The client already does
+that to check each response for errors, and the exporter then decodes the raw
+bytes again with the chosen decoder, so a poll pays for "json-str" plus one of
+the others.
+
+    poetry run python benchmarks/bench_decoding.py
+"""
+
+import json
+import time
+from typing import Any, Callable
+
+from rivian_exporter import decoding
+
+DATA_FILE = "tests/data/vehicle.json"
+ROUNDS = 20000
+
+
+def json_str(raw: bytes) -> Any:
+    return json.loads(raw.decode("utf-8"))
+
+
+def bench(name: str, decode: Callable[[bytes], Any], raw: bytes) -> None:
+    decoding.vehicle_state(decode(raw))
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        decoding.vehicle_state(decode(raw))
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:>10}: {ROUNDS / elapsed:>10.0f} responses/s "
+        f"{len(raw) * ROUNDS / elapsed / 1e6:>8.1f} MB/s "
+        f"{elapsed / ROUNDS * 1e6:>8.1f} us/response"
+    )
+
+
+def main() -> None:
+    with open(DATA_FILE, "rb") as f:
+        # Compact like the API's responses rather than the indented recording
+        raw = json.dumps(json.load(f), separators=(",", ":")).encode()
+    print(f"{len(raw)} byte response")
+    bench("json-str", json_str, raw)
+    for name, decode in decoding.DECODERS.items():
+        bench(name, decode, raw)
+
+
+if __name__ == "__main__":
+    main()
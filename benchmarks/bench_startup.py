@@ -0,0 +1,91 @@
+"""
+Measures how long the CLI takes to start: importing it, `--help`, and how
+long a replaying exporter takes from being started to serving its first
+/metrics with vehicle series.  Each is the median of several fresh
+interpreters, so it includes everything a container restart or CronJob pays.
+
+    poetry run python benchmarks/bench_startup.py
+"""
+
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from typing import Callable
+
+from rivian_exporter.recording import Recorder
+
+DATA_FILE = "tests/data/vehicle.json"
+ROUNDS = 5
+# Give up on an exporter that hasn't served /metrics after this long (seconds)
+SERVE_TIMEOUT = 30.0
+ENV = {**os.environ, "PYTHONPATH": "src"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return int(s.getsockname()[1])
+
+
+def run(args: list[str]) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, *args], env=ENV, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def first_metrics(recording: str) -> float:
+    port = free_port()
+    args = ["-m", "rivian_exporter", "prometheus", "--mode", "replay"]
+    args += ["--replay-file", recording, "--port", str(port), "--server", "asyncio"]
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, *args],
+        env=ENV,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < SERVE_TIMEOUT:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as r:
+                    if b"rivian_battery_level_ratio{" in r.read():
+                        return time.perf_counter() - start
+            except OSError:
+                pass
+            time.sleep(0.005)
+        raise TimeoutError("The exporter didn't serve /metrics")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def bench(name: str, measure: Callable[[], float]) -> None:
+    times = [measure() for _ in range(ROUNDS)]
+    print(
+        f"{name:>20}: {statistics.median(times) * 1000:>8.0f} ms median "
+        f"{min(times) * 1000:>8.0f} ms best"
+    )
+
+
+def main() -> None:
+    with open(DATA_FILE) as f:
+        response = json.load(f)
+    with tempfile.TemporaryDirectory() as tmp:
+        recording = os.path.join(tmp, "recording.ndjson.gz")
+        with Recorder(recording) as recorder:
+            recorder.write("StartupVin", response)
+        bench("python", lambda: run(["-c", "pass"]))
+        bench("import cli", lambda: run(["-c", "import rivian_exporter.__main__"]))
+        bench("import exporter", lambda: run(["-c", "import rivian_exporter.exporter"]))
+        bench("--help", lambda: run(["-m", "rivian_exporter", "--help"]))
+        bench("first /metrics", lambda: first_metrics(recording))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,487 @@
-import asyncio
 import json
+from typing import Any, Optional, TextIO
 
 import click
 import glog as log
 
-from . import exporter, vehicle
+from . import decoding, options
+from .session_cache import SessionCache
+
+# Commands import the Rivian client, aiohttp and prometheus_client themselves
+# so --help and the one-shot commands start quickly
 
 
 @click.group()
-def cli() -> None:
-    pass
+@click.option(
+    "--session-cache",
+    envvar="SESSION_CACHE_FILE",
+    type=click.Path(dir_okay=False),
+    help="Keep the Rivian session in this file so restarts skip the CSRF "
+    "handshake.  Defaults to $SESSION_CACHE_FILE",
+)
+@click.pass_context
+def cli(ctx: click.Context, session_cache: Optional[str]) -> None:
+    ctx.obj = SessionCache(session_cache) if session_cache else None
+
+
+def check_windows(
+    ctx: click.Context, param: click.Parameter, windows: tuple[str, ...]
+) -> tuple[str, ...]:
+    for window in windows:
+        try:
+            options.parse_window(window)
+        except ValueError as ex:
+            raise click.BadParameter(str(ex)) from ex
+    return windows
 
 
-@cli.command(help="Start a Prometheus exporter for a specific VIN")
+def parse_poll_intervals(
+    ctx: click.Context, param: click.Parameter, values: tuple[str, ...]
+) -> dict[str, float]:
+    intervals = {}
+    for value in values:
+        tier, _, seconds = value.partition("=")
+        if tier not in options.TIERS:
+            raise click.BadParameter(f"{tier} isn't one of {', '.join(options.TIERS)}")
+        try:
+            intervals[tier] = float(seconds)
+        except ValueError as ex:
+            raise click.BadParameter(f"{value} should be TIER=SECONDS") from ex
+        if intervals[tier] <= 0:
+            raise click.BadParameter(f"{value} should be a positive interval")
+    return intervals
+
+
+@cli.command(help="Start a Prometheus exporter for one or more VINs")
 @click.option("--port", default=8000)
 @click.option("--scrape-interval", default=30)
-def prometheus(port: int, scrape_interval: int) -> None:
-    vin = vehicle.get_token("VIN")
-    exporter.run(port, scrape_interval, vin)
+@click.option(
+    "--vin",
+    "vins",
+    multiple=True,
+    help="VIN to export, can be repeated.  Defaults to the VIN token",
+)
+@click.option(
+    "--all-vehicles",
+    is_flag=True,
+    help="Export every vehicle on the account instead of specific VINs",
+)
+@click.option(
+    "--concurrency",
+    default=4,
+    help="Maximum number of vehicle state requests in flight at once",
+)
+@click.option(
+    "--mode",
+    type=click.Choice(options.MODES),
+    default="poll",
+    help="Poll every scrape interval, subscribe to pushed vehicle updates, "
+    "fetch when scraped or replay a recording",
+)
+@click.option(
+    "--field-timestamps",
+    is_flag=True,
+    help="Export when the vehicle reported each field and how old it is",
+)
+@click.option(
+    "--max-requests-per-minute",
+    type=float,
+    help="Request budget shared by every vehicle on the account",
+)
+@click.option(
+    "--server",
+    type=click.Choice(options.SERVERS),
+    default="threaded",
+    help="Serve /metrics from prometheus_client's threaded server or from the "
+    "exporter's event loop with cached, compressed responses",
+)
+@click.option(
+    "--remove-missing",
+    is_flag=True,
+    help="Remove a vehicle's series when its source field disappears instead "
+    "of keeping the last value",
+)
+@click.option(
+    "--collector-timings",
+    is_flag=True,
+    help="Export how long each collector takes to set, which slows processing",
+)
+@click.option(
+    "--json-decoder",
+    type=click.Choice(list(decoding.DECODERS)),
+    default=decoding.DEFAULT_DECODER,
+    help="How vehicle state responses are decoded, orjson when it's installed",
+)
+@click.option(
+    "--replay-file",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Recording made by the record command, for --mode replay",
+)
+@click.option(
+    "--replay-speed",
+    default=1.0,
+    help="How many times faster than recorded to replay, 0 for as fast as possible",
+)
+@click.option(
+    "--replay-vins",
+    default=0,
+    help="Replay every recorded response as this many synthetic vehicles",
+)
+@click.option(
+    "--remote-write-url",
+    help="Also push every poll to this Prometheus remote write endpoint, "
+    "backfilling gaps in scraping",
+)
+@click.option(
+    "--remote-write-queue",
+    default="remote-write-queue",
+    type=click.Path(file_okay=False),
+    help="Directory holding polls until they have been pushed",
+)
+@click.option(
+    "--remote-write-max-polls",
+    default=20000,
+    help="Most polls to hold for pushing, the oldest are dropped beyond this",
+)
+@click.option(
+    "--metrics-config",
+    type=click.Path(exists=True, dir_okay=False),
+    help="TOML or YAML metric definitions to export instead of the built in "
+    "ones, reloaded on SIGHUP",
+)
+@click.option(
+    "--derived-metrics",
+    is_flag=True,
+    help="Also export charging power, energy and distance counters and "
+    "efficiency computed from consecutive polls",
+)
+@click.option(
+    "--efficiency-window",
+    "efficiency_windows",
+    multiple=True,
+    default=options.DEFAULT_WINDOWS,
+    callback=check_windows,
+    help="Window to export efficiency over with --derived-metrics, e.g. 15m, "
+    "1h or 7d.  Can be repeated",
+)
+@click.option(
+    "--sessions",
+    is_flag=True,
+    help="Detect charging sessions and trips and export histograms of them",
+)
+@click.option(
+    "--state-sets",
+    is_flag=True,
+    help="Export each info label as a state set with a series per value, "
+    "except for static infos such as the OTA version",
+)
+@click.option(
+    "--series-ttl",
+    type=click.FloatRange(min=0, min_open=True),
+    help="Remove a vehicle's series once their field hasn't been reported for "
+    "this many seconds, and forget vehicles with none left",
+)
+@click.option(
+    "--max-series",
+    type=click.IntRange(min=1),
+    help="Most vehicle series to export, any beyond are dropped",
+)
+@click.option(
+    "--adaptive-polling",
+    is_flag=True,
+    help="Poll each vehicle more or less often depending on whether it's "
+    "driving, charging, awake or asleep.  Only for --mode poll",
+)
+@click.option(
+    "--poll-interval",
+    "poll_intervals",
+    multiple=True,
+    callback=parse_poll_intervals,
+    help="TIER=SECONDS between polls for --adaptive-polling, e.g. driving=10, "
+    "charging=60, awake (defaults to --scrape-interval) or asleep=900.  Can be "
+    "repeated",
+)
+@click.option(
+    "--state-api",
+    is_flag=True,
+    help="Serve the last fetched vehicle state as JSON under /api/vehicles, "
+    "needs --server asyncio",
+)
+@click.option(
+    "--health-max-age",
+    type=click.FloatRange(min=0, min_open=True),
+    help="/healthz fails when no vehicle has been polled for this many seconds, "
+    "1800 by default.  Needs --server asyncio or --workers",
+)
+@click.option(
+    "--ready-max-age",
+    type=click.FloatRange(min=0, min_open=True),
+    help="/readyz fails while any vehicle hasn't been polled for this many "
+    "seconds.  Defaults to three of the longest poll interval.  Needs --server "
+    "asyncio or --workers",
+)
+@click.option(
+    "--workers",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Shard the vehicles over this many processes, served on the ports "
+    "after --port and merged into one /metrics on --port",
+)
+@click.pass_obj
+def prometheus(
+    session_cache: Optional[SessionCache],
+    port: int,
+    scrape_interval: int,
+    vins: tuple[str, ...],
+    all_vehicles: bool,
+    concurrency: int,
+    mode: str,
+    field_timestamps: bool,
+    max_requests_per_minute: Optional[float],
+    server: str,
+    remove_missing: bool,
+    collector_timings: bool,
+    json_decoder: str,
+    replay_file: Optional[str],
+    replay_speed: float,
+    replay_vins: int,
+    remote_write_url: Optional[str],
+    remote_write_queue: str,
+    remote_write_max_polls: int,
+    metrics_config: Optional[str],
+    derived_metrics: bool,
+    efficiency_windows: tuple[str, ...],
+    sessions: bool,
+    state_sets: bool,
+    series_ttl: Optional[float],
+    max_series: Optional[int],
+    adaptive_polling: bool,
+    poll_intervals: dict[str, float],
+    state_api: bool,
+    health_max_age: Optional[float],
+    ready_max_age: Optional[float],
+    workers: int,
+) -> None:
+    from . import exporter, supervisor
+
+    if mode == "replay" and replay_file is None:
+        raise click.UsageError("--mode replay needs --replay-file")
+    if mode == "replay" and workers > 1:
+        raise click.UsageError("--workers can't be used with --mode replay")
+    if adaptive_polling and mode != "poll":
+        raise click.UsageError("--adaptive-polling needs --mode poll")
+    if state_api and (server != "asyncio" or workers > 1):
+        raise click.UsageError("--state-api needs --server asyncio and one worker")
+    if (health_max_age or ready_max_age) and server != "asyncio" and workers == 1:
+        raise click.UsageError(
+            "--health-max-age and --ready-max-age need --server asyncio or --workers"
+        )
+    if all_vehicles or mode == "replay":
+        vin_list = []
+    else:
+        vin_list = list(vins) or get_vins()
+    run_options: dict[str, Any] = dict(
+        scrape_interval=scrape_interval,
+        concurrency=concurrency,
+        mode=mode,
+        field_timestamps=field_timestamps,
+        requests_per_minute=max_requests_per_minute,
+        remove_missing=remove_missing,
+        collector_timings=collector_timings,
+        session_cache=session_cache,
+        json_decoder=json_decoder,
+        replay_file=replay_file,
+        replay_speed=replay_speed,
+        replay_vins=replay_vins,
+        remote_write_url=remote_write_url,
+        remote_write_queue=remote_write_queue,
+        remote_write_max_polls=remote_write_max_polls,
+        metrics_config=metrics_config,
+        derived_metrics=derived_metrics,
+        efficiency_windows=efficiency_windows,
+        sessions=sessions,
+        state_sets=state_sets,
+        series_ttl=series_ttl,
+        max_series=max_series,
+        adaptive_polling=adaptive_polling,
+        poll_intervals=poll_intervals,
+        health_max_age=health_max_age,
+        ready_max_age=ready_max_age,
+    )
+    if workers > 1:
+        supervisor.run(port, workers, vin_list, run_options)
+    else:
+        exporter.run(
+            port, vins=vin_list, server=server, state_api=state_api, **run_options
+        )
+
+
+@cli.command(help="Record vehicle state responses to replay with --mode replay")
+@click.option(
+    "--output",
+    default="recording.ndjson.gz",
+    type=click.Path(dir_okay=False),
+    help="Gzipped NDJSON file to append to",
+)
+@click.option("--scrape-interval", default=30)
+@click.option(
+    "--count",
+    default=0,
+    help="Stop after polling each vehicle this many times, 0 to record until "
+    "interrupted",
+)
+@click.option(
+    "--vin",
+    "vins",
+    multiple=True,
+    help="VIN to record, can be repeated.  Defaults to the VIN token",
+)
+@click.option(
+    "--all-vehicles",
+    is_flag=True,
+    help="Record every vehicle on the account instead of specific VINs",
+)
+@click.option(
+    "--full-state",
+    is_flag=True,
+    help="Request every vehicle state field rather than only those exported",
+)
+@click.pass_obj
+def record(
+    session_cache: Optional[SessionCache],
+    output: str,
+    scrape_interval: int,
+    count: int,
+    vins: tuple[str, ...],
+    all_vehicles: bool,
+    full_state: bool,
+) -> None:
+    from . import exporter
+
+    vin_list = [] if all_vehicles else list(vins) or get_vins()
+    exporter.record(output, vin_list, scrape_interval, count, full_state, session_cache)
+
+
+@cli.command(
+    help="Stream the state of many vehicles as NDJSON, one line per vehicle as "
+    "it arrives, over one Rivian session.  Fetches every vehicle on the account "
+    "when no VINs are given"
+)
+@click.argument("vins", nargs=-1)
+@click.option(
+    "--vin-file",
+    type=click.File(),
+    help="File of VINs to fetch, one per line, as well as any given as arguments",
+)
+@click.option(
+    "--output",
+    default="-",
+    type=click.File("a"),
+    help="File to append the NDJSON to, standard output by default",
+)
+@click.option(
+    "--concurrency",
+    default=4,
+    type=click.IntRange(min=1),
+    help="Maximum number of vehicle state requests in flight at once",
+)
+@click.option(
+    "--interval",
+    default=0.0,
+    type=click.FloatRange(min=0),
+    help="Fetch again every this many seconds, 0 to fetch once",
+)
+@click.option(
+    "--count",
+    default=0,
+    type=click.IntRange(min=0),
+    help="With --interval stop after this many rounds, 0 to run until interrupted",
+)
+@click.option(
+    "--max-requests-per-minute",
+    type=float,
+    help="Cap on vehicle state requests across all VINs",
+)
+@click.option(
+    "--full-state",
+    is_flag=True,
+    help="Request every vehicle state field rather than only those exported",
+)
+@click.pass_obj
+def vehicle_states(
+    session_cache: Optional[SessionCache],
+    vins: tuple[str, ...],
+    vin_file: Optional[TextIO],
+    output: TextIO,
+    concurrency: int,
+    interval: float,
+    count: int,
+    max_requests_per_minute: Optional[float],
+    full_state: bool,
+) -> None:
+    from . import exporter
+
+    vin_list = list(vins)
+    if vin_file is not None:
+        vin_list += [line.strip() for line in vin_file if line.strip()]
+    exporter.snapshot(
+        output,
+        vin_list,
+        concurrency,
+        interval,
+        count if interval else 1,
+        full_state,
+        max_requests_per_minute,
+        session_cache,
+    )
+
+
+def get_vins() -> list[str]:
+    """The VIN token may hold a comma separated list of VINs"""
+    from . import vehicle
+
+    token = vehicle.get_token("VIN")
+    return [vin.strip() for vin in token.split(",") if vin.strip()]
 
 
 @cli.command(help="create tokens needed for the graph api")
 def login() -> None:
-    (access_token, refresh_token, user_session_token) = asyncio.run(vehicle.login())
+    import asyncio
+
+    from . import vehicle
+
+    access_token, refresh_token, user_session_token = asyncio.run(vehicle.login())
     print(f"ACCESS_TOKEN={access_token}")
     print(f"REFRESH_TOKEN={refresh_token}")
     print(f"USER_SESSION_TOKEN={user_session_token}")
 
 
 @cli.command()
-def user_info():
-    info = asyncio.run(vehicle.get_user_info())
+@click.pass_obj
+def user_info(session_cache: Optional[SessionCache]) -> None:
+    import asyncio
+
+    from . import vehicle
+
+    info = asyncio.run(vehicle.get_user_info(session_cache))
     print(json.dumps(info))
 
 
 @cli.command()
-def vehicle_state() -> None:
+@click.option(
+    "--full-state",
+    is_flag=True,
+    help="Request every vehicle state field rather than only those exported",
+)
+@click.pass_obj
+def vehicle_state(session_cache: Optional[SessionCache], full_state: bool) -> None:
+    import asyncio
+
+    from . import builtin_metrics, vehicle
+
     vin = vehicle.get_token("VIN")
-    state = asyncio.run(vehicle.get_vehicle_state(vin))
+    properties = None if full_state else set(builtin_metrics.SOURCES)
+    state = asyncio.run(vehicle.get_vehicle_state(vin, session_cache, properties))
     print(json.dumps(state))
 
 
@@ -0,0 +1,151 @@
+from typing import Callable, NamedTuple, Optional
+
+# The built in metric definitions, as plain data so the CLI can tell which
+# vehicle state fields they read without importing prometheus_client.  The
+# exporter builds its collectors from these.
+
+
+class GaugeSpec(NamedTuple):
+    name: str
+    help: str
+    source: str
+    key: str = "value"
+    modifier: Optional[Callable[[float], float]] = None
+
+
+class InfoSpec(NamedTuple):
+    name: str
+    help: str
+    """Label name to source field"""
+    labels: dict[str, str]
+    """Kept as an info when the others are exported as state sets"""
+    static: bool = False
+
+
+GAUGES = [
+    GaugeSpec(
+        "rivian_battery_capacity_kwh", "battery capacity in kwH", "batteryCapacity"
+    ),
+    GaugeSpec(
+        "rivian_battery_level_ratio",
+        "current level of battery as a %",
+        "batteryLevel",
+        modifier=lambda v: v / 100,
+    ),
+    GaugeSpec(
+        "rivian_battery_limit_ratio",
+        "Limit to which the battery will charge",
+        "batteryLimit",
+        modifier=lambda v: v / 100,
+    ),
+    GaugeSpec("rivian_bearing_degrees", "Bearing of the vehicle", "gnssBearing"),
+    GaugeSpec(
+        "rivian_cabin_climate_driver_temperature_celsius",
+        "Desired temperature for the driver",
+        "cabinClimateInteriorTemperature",
+    ),
+    GaugeSpec(
+        "rivian_cabin_climate_interior_temperature_celsius",
+        "Current temperature in the cabin in C",
+        "cabinClimateInteriorTemperature",
+    ),
+    GaugeSpec(
+        "rivian_distance_to_empty_meters",
+        "range",
+        "distanceToEmpty",
+        modifier=lambda v: v * 1000,
+    ),
+    GaugeSpec("rivian_latitude_degrees", "Latitude", "gnssLocation", key="latitude"),
+    GaugeSpec("rivian_longitude_degrees", "Longitude", "gnssLocation", key="longitude"),
+    GaugeSpec("rivian_speed_kph", "speed", "gnssSpeed"),
+    GaugeSpec(
+        "rivian_time_to_end_of_charge_minutes",
+        "Time to end of charge",
+        "timeToEndOfCharge",
+    ),
+    GaugeSpec(
+        "rivian_vehicle_mileage_meters",
+        "current odo reading in meters",
+        "vehicleMileage",
+    ),
+]
+
+INFOS = [
+    InfoSpec(
+        "rivian_charger",
+        "Charger Info",
+        {
+            "derate_status": "chargerDerateStatus",
+            "state": "chargerState",
+            "status": "chargerStatus",
+        },
+    ),
+    InfoSpec(
+        "rivian_closures",
+        "Closures",
+        {
+            "frunk_closed": "closureFrunkClosed",
+            "frunk_locked": "closureFrunkLocked",
+            "liftgate_closed": "closureLiftgateClosed",
+            "liftgate_locked": "closureLiftgateLocked",
+        },
+    ),
+    InfoSpec(
+        "rivian_doors",
+        "Doors",
+        {
+            "front_left_closed": "doorFrontLeftClosed",
+            "front_left_locked": "doorFrontLeftLocked",
+            "front_right_closed": "doorFrontRightClosed",
+            "front_right_locked": "doorFrontRightLocked",
+            "rear_left_closed": "doorRearLeftClosed",
+            "rear_left_locked": "doorRearLeftLocked",
+            "rear_right_closed": "doorRearRightClosed",
+            "rear_right_locked": "doorRearRightLocked",
+        },
+    ),
+    InfoSpec("rivian_drive_mode", "Drive Mode", {"drive_mode": "driveMode"}),
+    InfoSpec(
+        "rivian_ota_version",
+        "OTA Version",
+        {
+            "version": "otaCurrentVersion",
+            "githash": "otaCurrentVersionGitHash",
+        },
+        static=True,
+    ),
+    InfoSpec(
+        "rivian_pet_mode",
+        "Pet Mode",
+        {
+            "status": "petModeStatus",
+            "temperature_status": "petModeTemperatureStatus",
+        },
+    ),
+    InfoSpec(
+        "rivian_vehicle_state",
+        "Vehicle states",
+        {
+            "defrost_defog": "defrostDefogStatus",
+            "gear": "gearStatus",
+            "power": "powerState",
+            "wiper_fluid": "wiperFluidState",
+        },
+    ),
+    InfoSpec("rivian_range_threshold", "Range threshold", {"state": "rangeThreshold"}),
+    InfoSpec(
+        "rivian_tire_pressure",
+        "Tire Pressure",
+        {
+            "front_left": "tirePressureStatusFrontLeft",
+            "front_right": "tirePressureStatusFrontRight",
+            "rear_left": "tirePressureStatusRearLeft",
+            "rear_right": "tirePressureStatusRearRight",
+        },
+    ),
+]
+
+# Vehicle state fields the built in metrics read
+SOURCES = frozenset(spec.source for spec in GAUGES).union(
+    *(spec.labels.values() for spec in INFOS)
+)
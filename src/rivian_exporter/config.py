@@ -0,0 +1,228 @@
+import re
+import tomllib
+from typing import Any, NamedTuple, Optional, Union
+
+from .rivian_collectors import LABELS, RivianInfo, VehicleCollector, gauge, identity
+from .vehicle import RivianExporterException
+
+# Errors reading a config file may raise
+READ_ERRORS: tuple[type[Exception], ...] = (OSError, ValueError)
+try:
+    import yaml
+
+    READ_ERRORS += (yaml.YAMLError,)
+except ImportError:  # pragma: no cover
+    yaml = None  # type: ignore[assignment]
+
+METRIC_NAME = re.compile(r"^[a-zA-Z_:][a-zA-Z0-9_:]*$")
+LABEL_NAME = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+GAUGE_KEYS = {"name", "help", "source", "key", "scale", "offset"}
+INFO_KEYS = {"name", "help", "labels", "static"}
+
+
+class ConfigError(RivianExporterException):
+    """The metric definitions can't be read or are invalid"""
+
+
+class GaugeDefinition(NamedTuple):
+    name: str
+    help: str
+    source: str
+    key: str
+    scale: float
+    offset: float
+
+
+class InfoDefinition(NamedTuple):
+    name: str
+    help: str
+    """(source field, sub-key) of each info label"""
+    labels: dict[str, tuple[str, str]]
+    """Kept as an info when the others are exported as state sets"""
+    static: bool
+
+
+Definition = Union[GaugeDefinition, InfoDefinition]
+
+
+class Linear:
+    """A gauge modifier that scales and then offsets the API value"""
+
+    scale: float
+    offset: float
+
+    def __init__(self, scale: float, offset: float) -> None:
+        self.scale = scale
+        self.offset = offset
+
+    def __call__(self, value: float) -> float:
+        return value * self.scale + self.offset
+
+
+def read_config(path: str) -> Any:
+    """Parse a TOML file, or YAML when PyYAML is installed"""
+    try:
+        if path.endswith(".toml"):
+            with open(path, "rb") as f:
+                return tomllib.load(f)
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ConfigError("PyYAML is needed for YAML metric definitions")
+            with open(path) as f:
+                return yaml.safe_load(f)
+    except READ_ERRORS as ex:
+        raise ConfigError(f"Unable to read {path}: {ex}") from ex
+    raise ConfigError(f"{path} should be a .toml, .yaml or .yml file")
+
+
+def _text(definition: dict[str, Any], key: str, errors: list[str], where: str) -> str:
+    value = definition.get(key)
+    if not isinstance(value, str) or not value:
+        errors.append(f"{where}: {key} must be a non-empty string")
+        return ""
+    return value
+
+
+def _number(
+    definition: dict[str, Any], key: str, default: float, errors: list[str], where: str
+) -> float:
+    value = definition.get(key, default)
+    # bool is an int but `scale = true` is surely a mistake
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        errors.append(f"{where}: {key} must be a number")
+        return default
+    return float(value)
+
+
+def _gauge(
+    definition: dict[str, Any], errors: list[str], where: str
+) -> GaugeDefinition:
+    return GaugeDefinition(
+        _text(definition, "name", errors, where),
+        _text(definition, "help", errors, where),
+        _text(definition, "source", errors, where),
+        _text({"key": "value", **definition}, "key", errors, where),
+        _number(definition, "scale", 1, errors, where),
+        _number(definition, "offset", 0, errors, where),
+    )
+
+
+def _info_label(
+    label: Any, field: Any, errors: list[str], where: str
+) -> Optional[tuple[str, str]]:
+    if not isinstance(label, str) or not LABEL_NAME.match(label):
+        errors.append(f"{where}: {label!r} is not a valid label name")
+    elif label in LABELS or label.startswith("__"):
+        errors.append(f"{where}: the {label} label is reserved")
+    if isinstance(field, str) and field:
+        return (field, "value")
+    if isinstance(field, dict) and not set(field) - {"source", "key"}:
+        source = _text(field, "source", errors, f"{where} label {label}")
+        key = _text({"key": "value", **field}, "key", errors, f"{where} label {label}")
+        return (source, key)
+    errors.append(
+        f"{where}: label {label} must be a source field or a table of source and key"
+    )
+    return None
+
+
+def _info(definition: dict[str, Any], errors: list[str], where: str) -> InfoDefinition:
+    labels = definition.get("labels")
+    fields = {}
+    if not isinstance(labels, dict) or not labels:
+        errors.append(f"{where}: labels must map label names to source fields")
+    else:
+        for label, field in labels.items():
+            parsed = _info_label(label, field, errors, where)
+            if parsed is not None:
+                fields[label] = parsed
+    static = definition.get("static", False)
+    if not isinstance(static, bool):
+        errors.append(f"{where}: static must be true or false")
+    return InfoDefinition(
+        _text(definition, "name", errors, where),
+        _text(definition, "help", errors, where),
+        fields,
+        static is True,
+    )
+
+
+def _check_names(definitions: list[Definition], errors: list[str]) -> None:
+    names: set[str] = set()
+    for definition in definitions:
+        if definition.name and not METRIC_NAME.match(definition.name):
+            errors.append(f"{definition.name} is not a valid metric name")
+        if definition.name in names:
+            errors.append(f"{definition.name} is defined more than once")
+        names.add(definition.name)
+    if not definitions:
+        errors.append("no metrics are defined")
+
+
+def parse_definitions(config: Any) -> list[Definition]:
+    """
+    Validate the metric definitions of a config file.  Every problem found is
+    reported in a single ConfigError.
+    """
+    if not isinstance(config, dict):
+        raise ConfigError("Metric definitions must be a table of gauge and info lists")
+    errors = [f"unknown section {key}" for key in set(config) - {"gauge", "info"}]
+    definitions: list[Definition] = []
+    for kind, allowed in (("gauge", GAUGE_KEYS), ("info", INFO_KEYS)):
+        entries = config.get(kind, [])
+        if not isinstance(entries, list):
+            errors.append(f"{kind} must be a list")
+            continue
+        for index, definition in enumerate(entries, 1):
+            where = f"{kind} {index}"
+            if not isinstance(definition, dict):
+                errors.append(f"{where} must be a table")
+                continue
+            where = f"{kind} {index} ({definition.get('name', 'unnamed')})"
+            errors += [f"{where}: unknown key {k}" for k in set(definition) - allowed]
+            parse = _gauge if kind == "gauge" else _info
+            definitions.append(parse(definition, errors, where))
+    _check_names(definitions, errors)
+    if errors:
+        raise ConfigError("Invalid metric definitions:\n  " + "\n  ".join(errors))
+    return definitions
+
+
+def build_collectors(
+    definitions: list[Definition],
+) -> list[VehicleCollector]:
+    """
+    The collectors for `definitions`.  Their metrics aren't registered so the
+    caller can swap them for the current ones.
+    """
+    collectors: list[VehicleCollector] = []
+    for definition in definitions:
+        if isinstance(definition, GaugeDefinition):
+            modifier = identity
+            if definition.scale != 1 or definition.offset != 0:
+                modifier = Linear(definition.scale, definition.offset)
+            collectors.append(
+                gauge(
+                    definition.name,
+                    definition.help,
+                    definition.source,
+                    key=definition.key,
+                    modifier=modifier,
+                    registry=None,
+                )
+            )
+        else:
+            collectors.append(
+                RivianInfo(
+                    definition.name,
+                    definition.help,
+                    definition.labels,
+                    None,
+                    definition.static,
+                )
+            )
+    return collectors
+
+
+def load_collectors(path: str) -> list[VehicleCollector]:
+    return build_collectors(parse_definitions(read_config(path)))
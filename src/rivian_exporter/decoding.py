@@ -0,0 +1,32 @@
+import json
+from typing import Any, Callable
+
+Decoder = Callable[[bytes], Any]
+
+# Decoders by name, fastest first
+DECODERS: dict[str, Decoder] = {}
+try:
+    import orjson
+
+    DECODERS["orjson"] = orjson.loads
+except ImportError:  # pragma: no cover
+    pass
+DECODERS["json"] = json.loads
+
+DEFAULT_DECODER = next(iter(DECODERS))
+
+
+def get_decoder(name: str = DEFAULT_DECODER) -> Decoder:
+    """
+    Decodes raw response bytes.  orjson is used when it's installed as it's
+    about twice as fast as the stdlib parser on vehicle state responses
+    """
+    return DECODERS[name]
+
+
+def vehicle_state(body: Any) -> dict[str, Any]:
+    """The part of a GetVehicleState response the collectors read"""
+    state = body["data"]["vehicleState"]
+    if not isinstance(state, dict):
+        raise ValueError(f"Response has no vehicle state: {body}")
+    return state
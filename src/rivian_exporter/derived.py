@@ -0,0 +1,194 @@
+import math
+from typing import Any, NamedTuple, Optional, Sequence
+
+import prometheus_client as prom
+
+from .instrumentation import remove_series
+from .options import DEFAULT_WINDOWS, parse_window
+from .rivian_collectors import LABELS, parse_timestamp
+
+# Vehicle state fields the derived metrics are computed from
+SOURCES = frozenset({"batteryLevel", "batteryCapacity", "vehicleMileage"})
+# Below this much energy used in a window (kWh) efficiency is meaningless
+MIN_ENERGY = 0.01
+
+
+class Reading(NamedTuple):
+    """A field's value and when the vehicle reported it"""
+
+    value: float
+    timestamp: float
+
+
+def read_energy(vehicle_state: dict[str, Any]) -> Optional[Reading]:
+    """kWh in the battery, from the level and capacity"""
+    try:
+        level = vehicle_state["batteryLevel"]
+        capacity = vehicle_state["batteryCapacity"]["value"]
+        return Reading(
+            level["value"] / 100 * capacity, parse_timestamp(level["timeStamp"])
+        )
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def read_mileage(vehicle_state: dict[str, Any]) -> Optional[Reading]:
+    try:
+        mileage = vehicle_state["vehicleMileage"]
+        return Reading(float(mileage["value"]), parse_timestamp(mileage["timeStamp"]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def is_newer(reading: Optional[Reading], previous: Optional[Reading]) -> bool:
+    if reading is None:
+        return False
+    return previous is None or reading.timestamp > previous.timestamp
+
+
+class Decaying:
+    """
+    An exponentially decaying sum: amounts added fade with time constant
+    `window`, so it approximates the total over the last window in constant
+    memory
+    """
+
+    window: float
+    total: float
+    updated_at: Optional[float]
+
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self.total = 0.0
+        self.updated_at = None
+
+    def add(self, amount: float, at: float) -> None:
+        if self.updated_at is None or at > self.updated_at:
+            if self.updated_at is not None:
+                self.total *= math.exp(-(at - self.updated_at) / self.window)
+            self.updated_at = at
+        self.total += amount
+
+
+class VehicleEnergy:
+    """What's kept between polls for one vehicle"""
+
+    energy: Optional[Reading]
+    mileage: Optional[Reading]
+    """Decaying (distance, energy used) for each window"""
+    windows: dict[str, tuple[Decaying, Decaying]]
+
+    def __init__(self, windows: dict[str, float]) -> None:
+        self.energy = None
+        self.mileage = None
+        self.windows = {
+            name: (Decaying(seconds), Decaying(seconds))
+            for name, seconds in windows.items()
+        }
+
+
+class DerivedMetrics:
+    """
+    Charging power, energy and distance counters and driving efficiency,
+    computed incrementally from consecutive vehicle states so dashboards don't
+    have to run deriv() and increase() over long ranges.  Only newly reported
+    values count, using the timestamps the vehicle reported them with, so
+    repeated polls of a parked car change nothing.
+
+    Efficiency is the distance driven per kWh used over each window, with
+    older driving weighted down exponentially.  Energy used while parked
+    counts against it.
+    """
+
+    """Vehicle state fields that must be requested"""
+    sources = SOURCES
+    windows: dict[str, float]
+    vehicles: dict[str, VehicleEnergy]
+    charge_power: prom.Gauge
+    energy_added: prom.Counter
+    energy_used: prom.Counter
+    distance: prom.Counter
+    efficiency: prom.Gauge
+
+    def __init__(
+        self,
+        windows: Sequence[str] = DEFAULT_WINDOWS,
+        registry: Optional[prom.CollectorRegistry] = prom.REGISTRY,
+    ) -> None:
+        self.windows = {window: parse_window(window) for window in windows}
+        self.vehicles = {}
+        self.charge_power = prom.Gauge(
+            "rivian_charge_power_kilowatts",
+            "Rate the battery gained energy at between its last two reports",
+            LABELS,
+            registry=registry,
+        )
+        self.energy_added = prom.Counter(
+            "rivian_energy_added_kwh",
+            "Energy added to the battery",
+            LABELS,
+            registry=registry,
+        )
+        self.energy_used = prom.Counter(
+            "rivian_energy_used_kwh",
+            "Energy drawn from the battery",
+            LABELS,
+            registry=registry,
+        )
+        self.distance = prom.Counter(
+            "rivian_distance_traveled_meters",
+            "Distance driven",
+            LABELS,
+            registry=registry,
+        )
+        self.efficiency = prom.Gauge(
+            "rivian_efficiency_meters_per_kwh",
+            "Distance driven per kWh used over a decaying window",
+            LABELS + ["window"],
+            registry=registry,
+        )
+
+    def update(self, vin: str, vehicle_state: dict[str, Any]) -> None:
+        vehicle = self.vehicles.get(vin)
+        if vehicle is None:
+            vehicle = self.vehicles[vin] = VehicleEnergy(self.windows)
+        used = driven = 0.0
+        energy, previous = read_energy(vehicle_state), vehicle.energy
+        if is_newer(energy, previous):
+            vehicle.energy = energy
+            if energy is not None and previous is not None:
+                used = self.update_energy(vin, previous, energy)
+        mileage, previous = read_mileage(vehicle_state), vehicle.mileage
+        if is_newer(mileage, previous):
+            vehicle.mileage = mileage
+            if mileage is not None and previous is not None:
+                driven = max(mileage.value - previous.value, 0)
+                self.distance.labels(vin).inc(driven)
+        if not used and not driven:
+            return
+        at = max(r.timestamp for r in (vehicle.energy, vehicle.mileage) if r)
+        for window, (distance, energy_used) in vehicle.windows.items():
+            distance.add(driven, at)
+            energy_used.add(used, at)
+            if energy_used.total >= MIN_ENERGY:
+                ratio = distance.total / energy_used.total
+                self.efficiency.labels(vin, window).set(ratio)
+
+    def forget(self, vin: str) -> None:
+        self.vehicles.pop(vin, None)
+        for counter in (self.energy_added, self.energy_used, self.distance):
+            remove_series(counter, vin)
+        remove_series(self.charge_power, vin)
+        for window in self.windows:
+            remove_series(self.efficiency, vin, window)
+
+    def update_energy(self, vin: str, previous: Reading, energy: Reading) -> float:
+        """Count the change in the battery's energy, returning the kWh used"""
+        change = energy.value - previous.value
+        hours = (energy.timestamp - previous.timestamp) / 3600
+        self.charge_power.labels(vin).set(max(change, 0) / hours)
+        if change > 0:
+            self.energy_added.labels(vin).inc(change)
+            return 0.0
+        self.energy_used.labels(vin).inc(-change)
+        return -change
@@ -1,5 +1,18 @@
 import asyncio
-from typing import Any
+import json
+import signal
+from time import monotonic, perf_counter, time
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Iterable,
+    Optional,
+    Protocol,
+    Sequence,
+    TextIO,
+    TypeVar,
+)
 
 import glog as log
 import prometheus_client as prom
@@ -7,200 +20,952 @@ from rivian import Rivian
 from rivian.exceptions import (
     RivianApiException,
     RivianApiRateLimitError,
-    RivianExpiredTokenError,
     RivianUnauthenticated,
 )
 
-from . import vehicle
-from .rivian_collectors import gauge, info
+from . import builtin_metrics, config, decoding, vehicle
+from .derived import DerivedMetrics
+from .health import READY_POLLS, Health
+from .http_server import RENDER_MAX_AGE, MetricsServer
+from .instrumentation import (
+    DECODE_DURATION,
+    LAST_SUCCESS,
+    POLL_ERRORS,
+    PROCESSING_DURATION,
+    REQUEST_DURATION,
+    RESPONSE_BYTES,
+    remove_series,
+)
+from .on_demand import RivianCollector, StateCache
+from .options import DEFAULT_WINDOWS
+from .plan import ExtractionPlan
+from .polling import AdaptivePolling
+from .recording import Recorder, read_recording
+from .remote_write import RemoteWriter, SampleQueue
+from .rivian_collectors import (
+    FieldTimestamps,
+    VehicleCollector,
+    as_state_sets,
+    gauge,
+    identity,
+    info,
+)
+from .scheduler import Backoff, FixedRateTicker, TokenBucket, retry_after
+from .session_cache import SessionCache
+from .sessions import SessionTracker
+from .state_api import StateApi
+from .subscription import VehicleSubscription
+
+T = TypeVar("T")
 
+# Failed polls are retried with exponential backoff starting from the scrape
+# interval and capped at this many seconds, unless the API says how long to wait
+BACKOFF_MAX = 900
+# When a vehicle subscription drops we poll until it can be re-established,
+# retrying with exponential backoff between these bounds (seconds)
+SUBSCRIBE_BACKOFF_MIN = 30
+SUBSCRIBE_BACKOFF_MAX = 900
+# How often to check that a subscription is still connected
+SUBSCRIPTION_CHECK_INTERVAL = 1.0
+# Longest wait between looking for series past their TTL (seconds)
+EXPIRY_INTERVAL = 60.0
+
+# The built in collectors are created unregistered so that importing this
+# module doesn't touch the registry; run() registers the ones it exports
 GAUGES = [
-    gauge("rivian_battery_capacity_kwh", "battery capacity in kwH", "batteryCapacity"),
-    gauge(
-        "rivian_battery_level_ratio",
-        "current level of battery as a %",
-        "batteryLevel",
-        modifier=lambda v: v / 100,
-    ),  # type: ignore
-    gauge(
-        "rivian_battery_limit_ratio",
-        "Limit to which the battery will charge",
-        "batteryLimit",
-        modifier=lambda v: v / 100,
-    ),  # type: ignore
-    gauge("rivian_bearing_degrees", "Bearing of the vehicle", "gnssBearing"),
-    gauge(
-        "rivian_cabin_climate_driver_temperature_celsius",
-        "Desired temperature for the driver",
-        "cabinClimateInteriorTemperature",
-    ),
-    gauge(
-        "rivian_cabin_climate_interior_temperature_celsius",
-        "Current temperature in the cabin in C",
-        "cabinClimateInteriorTemperature",
-    ),
-    gauge(
-        "rivian_distance_to_empty_meters",
-        "range",
-        "distanceToEmpty",
-        modifier=lambda v: v * 1000,
-    ),  # type: ignore
-    gauge(
-        "rivian_latitude_degrees",
-        "Latitude",
-        "gnssLocation",
-        getter=lambda v: v["latitude"],
-    ),
-    gauge(
-        "rivian_longitude_degrees",
-        "Longitude",
-        "gnssLocation",
-        getter=lambda v: v["longitude"],
-    ),
-    gauge("rivian_speed_kph", "speed", "gnssSpeed"),
-    gauge(
-        "rivian_time_to_end_of_charge_minutes",
-        "Time to end of charge",
-        "timeToEndOfCharge",
-    ),
     gauge(
-        "rivian_vehicle_mileage_meters",
-        "current odo reading in meters",
-        "vehicleMileage",
-    ),
+        spec.name,
+        spec.help,
+        spec.source,
+        key=spec.key,
+        modifier=spec.modifier or identity,
+        registry=None,
+    )
+    for spec in builtin_metrics.GAUGES
 ]
-
 INFOS = [
-    info(
-        "rivian_charger",
-        "Charger Info",
-        {
-            "derate_status": "chargerDerateStatus",
-            "state": "chargerState",
-            "status": "chargerStatus",
-        },
-    ),
-    info(
-        "rivian_closures",
-        "Closures",
-        {
-            "frunk_closed": "closureFrunkClosed",
-            "frunk_locked": "closureFrunkLocked",
-            "liftgate_closed": "closureLiftgateClosed",
-            "liftgate_locked": "closureLiftgateLocked",
-        },
-    ),
-    info(
-        "rivian_doors",
-        "Doors",
-        {
-            "front_left_closed": "doorFrontLeftClosed",
-            "front_left_locked": "doorFrontLeftLocked",
-            "front_right_closed": "doorFrontRightClosed",
-            "front_right_locked": "doorFrontRightLocked",
-            "rear_left_closed": "doorRearLeftClosed",
-            "rear_left_locked": "doorRearLeftLocked",
-            "rear_right_closed": "doorRearRightClosed",
-            "rear_right_locked": "doorRearRightLocked",
-        },
-    ),
-    info("rivian_drive_mode", "Drive Mode", {"drive_mode": "driveMode"}),
-    info(
-        "rivian_ota_version",
-        "OTA Version",
-        {
-            "version": "otaCurrentVersion",
-            "githash": "otaCurrentVersionGitHash",
-        },
-    ),
-    info(
-        "rivian_pet_mode",
-        "Pet Mode",
-        {
-            "status": "petModeStatus",
-            "temperature_status": "petModeTemperatureStatus",
-        },
-    ),
-    info(
-        "rivian_vehicle_state",
-        "Vehicle states",
-        {
-            "defrost_defog": "defrostDefogStatus",
-            "gear": "gearStatus",
-            "power": "powerState",
-            "wiper_fluid": "wiperFluidState",
-        },
-    ),
-    info("rivian_range_threshold", "Range threshold", {"state": "rangeThreshold"}),
-    info(
-        "rivian_tire_pressure",
-        "Tire Pressure",
-        {
-            "front_left": "tirePressureStatusFrontLeft",
-            "front_right": "tirePressureStatusFrontRight",
-            "rear_left": "tirePressureStatusRearLeft",
-            "rear_right": "tirePressureStatusRearRight",
-        },
-    ),
+    info(spec.name, spec.help, spec.labels, registry=None, static=spec.static)
+    for spec in builtin_metrics.INFOS
 ]
 
 
-COLLECTORS = GAUGES + INFOS
+COLLECTORS: list[VehicleCollector] = [*GAUGES, *INFOS]
+
+
+# Compiled at startup and whenever the metric definitions are reloaded, see
+# ExtractionPlan
+PLAN = ExtractionPlan(COLLECTORS)
+
+
+def unregister(collectors: Iterable[VehicleCollector]) -> None:
+    for collector in collectors:
+        try:
+            prom.REGISTRY.unregister(collector.metric)
+        except KeyError:
+            # Already unregistered, e.g. for on-demand collection
+            pass
+
+
+def use_collectors(collectors: list[VehicleCollector], register: bool = True) -> None:
+    """
+    Export `collectors`, whose metrics mustn't be registered yet, instead of
+    the current ones, which may not have been registered either.  COLLECTORS
+    is updated in place so everything holding on to it follows.  Turn
+    `register` off for on-demand collection.
+    """
+    previous = list(COLLECTORS)
+    unregister(previous)
+    if register:
+        registered = []
+        try:
+            for collector in collectors:
+                prom.REGISTRY.register(collector.metric)
+                registered.append(collector)
+        except ValueError:
+            # A name clashes with another metric, so put the old ones back
+            unregister(registered)
+            for collector in previous:
+                prom.REGISTRY.register(collector.metric)
+            raise
+    COLLECTORS[:] = collectors
+    PLAN.compile(collectors)
+
+
+def load_collectors(
+    metrics_config: Optional[str], state_sets: bool = False
+) -> list[VehicleCollector]:
+    """
+    The collectors defined in `metrics_config`, or the built in ones, with
+    their infos as state sets when `state_sets` is on
+    """
+    collectors = COLLECTORS
+    if metrics_config is not None:
+        collectors = config.load_collectors(metrics_config)
+    return as_state_sets(collectors) if state_sets else list(collectors)
 
 
-def set_prom_metrics(data: Any) -> None:
-    state = data["data"]["vehicleState"]
-    for collector in COLLECTORS:
-        collector.process(state)
+def set_prom_metrics(data: Any, vin: str) -> None:
+    state = decoding.vehicle_state(data)
+    with PROCESSING_DURATION.labels("full").time():
+        count = PLAN.execute(state, vin)
+    log.info(f"Set {count} metrics for {vin}")
 
-    count = len(COLLECTORS)
-    log.info(f"Set {count} metrics")
+
+def set_partial_prom_metrics(
+    state: dict[str, Any], changed: set[str], vin: str
+) -> None:
+    """
+    Only process collectors that read a changed field.  `state` is the merged
+    vehicle state so multi-field infos still see their other fields.
+    """
+    with PROCESSING_DURATION.labels("partial").time():
+        count = PLAN.execute(state, vin, changed)
+    log.debug(f"Set {count} metrics for {vin} from partial update")
+
+
+class StateTracker(Protocol):
+    """Computes metrics from the sequence of states of each vehicle"""
+
+    """Vehicle state fields that must be requested"""
+    sources: frozenset[str]
+
+    def update(self, vin: str, vehicle_state: dict[str, Any]) -> None:
+        """Called with the vehicle's state whenever it's been updated"""
+
+    def forget(self, vin: str) -> None:
+        """Called when the vehicle has been forgotten, to drop its state and series"""
 
 
 class RivianExporter:
-    vin: str
+    """
+    Polls the vehicle state of one or more VINs over a single shared Rivian
+    session.  Each VIN gets its own polling loop; `concurrency` bounds how many
+    requests are in flight against the API at once and `requests_per_minute`
+    optionally caps the request rate of the whole account.
+    """
+
+    vins: list[str]
     scrape_interval: int
+    mode: str
     rivian: Rivian
+    """Where the session tokens are kept between runs, if anywhere"""
+    session_cache: Optional[SessionCache]
+    """Whether the current session was restored from `session_cache`"""
+    restored: bool
+    """Counts the sessions created, to tell whether a rejected one was replaced"""
+    sessions: int
+    semaphore: asyncio.Semaphore
+    budget: Optional[TokenBucket]
+    """
+    The vehicle state fields requested, by default only those the collectors
+    read.  Empty to request all of them.
+    """
+    properties: frozenset[str]
+    """Decodes the raw response bytes"""
+    decode: decoding.Decoder
+    states: dict[str, dict[str, Any]]
+    """Called with the VIN whenever that vehicle's metrics have been updated"""
+    listeners: list[Callable[[str], None]]
+    """Called with the VIN after every poll, whether or not it succeeded"""
+    poll_listeners: list[Callable[[str], None]]
+    """Metric definitions reloaded on SIGHUP, if any"""
+    metrics_config: Optional[str]
+    """Whether reloaded infos are exported as state sets, see as_state_sets"""
+    state_sets: bool
+    """Picks each vehicle's poll interval, otherwise it's `scrape_interval`"""
+    polling: Optional[AdaptivePolling]
+    """Fields requested for something other than the collectors"""
+    extra_properties: frozenset[str]
+    health: Health
 
-    def __init__(self, vin: str, scrape_interval: int) -> None:
-        self.vin = vin
-        self.rivian = vehicle.get_rivian()
+    def __init__(
+        self,
+        vins: list[str],
+        scrape_interval: int,
+        concurrency: int = 4,
+        mode: str = "poll",
+        field_timestamps: bool = False,
+        requests_per_minute: Optional[float] = None,
+        session_cache: Optional[SessionCache] = None,
+        json_decoder: str = decoding.DEFAULT_DECODER,
+        metrics_config: Optional[str] = None,
+    ) -> None:
+        self.vins = vins
+        self.metrics_config = metrics_config
+        self.state_sets = False
+        self.polling = None
+        self.session_cache = session_cache
+        self.restored = False
+        self.sessions = 0
+        self.rivian = self.connect()
         self.scrape_interval = scrape_interval
+        self.mode = mode
+        self.field_timestamps = field_timestamps
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.budget = None
+        if requests_per_minute:
+            self.budget = TokenBucket(requests_per_minute / 60, concurrency)
+        self.token_lock = asyncio.Lock()
+        self.extra_properties = frozenset()
+        self.properties = PLAN.sources
+        self.decode = decoding.get_decoder(json_decoder)
+        self.states = {}
+        self.listeners = []
+        self.poll_listeners = []
+        self.health = Health(ready_max_age=READY_POLLS * max(scrape_interval, 1))
+        self.health.check_freshness = mode != "on-demand"
+
+    def connect(self) -> Rivian:
+        return vehicle.get_rivian(self.session_cache)
+
+    async def discover_vins(self) -> list[str]:
+        info = await self.with_session(self.rivian.get_user_information)
+        body = await info.json()
+        return vehicle.vins_from_user_info(body)
+
+    def add_listener(self, listener: Callable[[str], None]) -> None:
+        """
+        `listener` is called with the VIN whenever its state is updated, and
+        when it's forgotten, by which time it's gone from `states`
+        """
+        self.listeners.append(listener)
+
+    def add_poll_listener(self, listener: Callable[[str], None]) -> None:
+        """
+        `listener` is called with the VIN after every poll, including the ones
+        that fail and so leave the state alone
+        """
+        self.poll_listeners.append(listener)
+
+    def add_tracker(self, tracker: StateTracker) -> None:
+        """Request the fields `tracker` needs and update it with every state"""
+        self.extra_properties |= tracker.sources
+        self.properties = PLAN.sources | self.extra_properties
+        self.add_listener(lambda vin: self.track(tracker, vin))
+
+    def track(self, tracker: StateTracker, vin: str) -> None:
+        state = self.states.get(vin)
+        if state is None:
+            tracker.forget(vin)
+        else:
+            tracker.update(vin, state)
 
-    async def get_vehicle_state(self) -> Any:
-        state = await self.rivian.get_vehicle_state(self.vin)
-        body = await state.json()
+    def notify(self, vin: str) -> None:
+        for listener in self.listeners:
+            listener(vin)
+
+    def adapt_polling(self, intervals: Optional[dict[str, float]] = None) -> None:
+        """Poll each vehicle at an interval picked from what it's doing"""
+        self.polling = AdaptivePolling(self.scrape_interval, intervals)
+        self.add_tracker(self.polling)
+        longest = max(self.polling.intervals.values())
+        self.health.ready_max_age = max(
+            self.health.ready_max_age, READY_POLLS * longest
+        )
+
+    def set_health_thresholds(
+        self, max_age: Optional[float] = None, ready_max_age: Optional[float] = None
+    ) -> None:
+        """
+        `max_age` defaults to DEFAULT_MAX_AGE and `ready_max_age` to missing a
+        few polls at the longest poll interval
+        """
+        if max_age is not None:
+            self.health.max_age = max_age
+        if ready_max_age is not None:
+            self.health.ready_max_age = ready_max_age
+
+    def poll_interval(self, vin: str) -> float:
+        if self.polling is None:
+            return self.scrape_interval
+        return self.polling.interval(vin)
+
+    def backoff(self) -> Backoff:
+        return Backoff(max(self.scrape_interval, 1), BACKOFF_MAX)
+
+    async def get_vehicle_state(self, vin: str) -> Any:
+        return await self.with_session(lambda: self.request_vehicle_state(vin))
+
+    async def request_vehicle_state(self, vin: str) -> Any:
+        if self.budget is not None:
+            await self.budget.acquire()
+        async with self.semaphore:
+            with REQUEST_DURATION.labels("vehicle_state").time():
+                # The client removes unsupported properties from the set it's given
+                state = await self.rivian.get_vehicle_state(vin, set(self.properties))
+                raw = await state.read()
+        RESPONSE_BYTES.labels("vehicle_state").observe(len(raw))
+        start = perf_counter()
+        body = self.decode(raw)
+        DECODE_DURATION.labels("vehicle_state").observe(perf_counter() - start)
         return body
 
-    async def inner_loop(self) -> None:
+    async def fetch_state(self, vin: str) -> Any:
+        """Fetch the vehicle state and remember it without setting the metrics"""
+        state = await self.get_vehicle_state(vin)
+        self.states[vin] = dict(decoding.vehicle_state(state))
+        LAST_SUCCESS.labels(vin).set_to_current_time()
+        self.health.polled(vin)
+        self.notify(vin)
+        return state
+
+    async def start_session(self) -> None:
+        self.restored = await vehicle.start_session(self.rivian, self.session_cache)
+
+    async def with_session(self, request: Callable[[], Awaitable[T]]) -> T:
+        """Make `request`, retrying it once if a restored session was rejected"""
+        session = self.sessions
         try:
-            state = await self.get_vehicle_state()
-            set_prom_metrics(state)
-            await asyncio.sleep(self.scrape_interval)
-        except RivianExpiredTokenError:
-            log.info("Rivian token expired, refreshing")
-            await self.rivian.create_csrf_token()
+            return await request()
+        except RivianUnauthenticated:
+            if not await self.renew_session(session):
+                raise
+        return await request()
+
+    async def renew_session(self, rejected: int) -> bool:
+        """
+        Replace session number `rejected` after the API rejected it, if it was
+        restored from the session cache.  Returns whether there's a new session
+        to retry with.
+        """
+        # Every vehicle loop sees the rejection at roughly the same time; only
+        # the first one through needs to do the handshake
+        async with self.token_lock:
+            if self.sessions != rejected:
+                return True
+            if not self.restored:
+                return False
+            log.info("The cached Rivian session was rejected, creating a new one")
+            if self.session_cache is not None:
+                self.session_cache.clear()
+            self.restored = await vehicle.start_session(
+                self.rivian, self.session_cache, refresh=True
+            )
+            self.sessions += 1
+            return True
+
+    async def update(self, vin: str) -> None:
+        state = await self.get_vehicle_state(vin)
+        self.apply_state(vin, state)
+
+    def apply_state(self, vin: str, state: Any) -> None:
+        """Set the metrics of `vin` from a full vehicle state response"""
+        self.states[vin] = dict(decoding.vehicle_state(state))
+        set_prom_metrics(state, vin)
+        LAST_SUCCESS.labels(vin).set_to_current_time()
+        self.health.polled(vin)
+        self.notify(vin)
+
+    def apply_update(self, vin: str, update: dict[str, Any]) -> None:
+        """Merge a partial vehicle state from a subscription frame"""
+        try:
+            state = self.states.setdefault(vin, {})
+            state.update(update)
+            set_partial_prom_metrics(state, set(update), vin)
+            self.notify(vin)
+        except Exception as ex:  # pylint: disable=broad-except
+            # Raising here would kill the rivian client's web socket receiver
+            log.error("Failed to apply update for %s: %s", vin, ex, exc_info=1)
+
+    async def inner_loop(self, vin: str, backoff: Backoff) -> Optional[float]:
+        """
+        Poll once.  Returns None on success, otherwise how many seconds to wait
+        before trying again.  Failures are counted by exception class.
+        """
+        try:
+            await self.update(vin)
+            backoff.reset()
+            return None
         except RivianApiRateLimitError as err:
+            POLL_ERRORS.labels(type(err).__name__).inc()
             log.error("Rate limit being enforced: %s", err, exc_info=1)
-            log.info("Sleeping 900 seconds")
-            await asyncio.sleep(900)
-        except RivianUnauthenticated:
+            delay = retry_after(err)
+            if delay is None:
+                delay = backoff.next_delay()
+            self.health.rate_limited(delay)
+            if self.budget is not None:
+                # Everything sharing the account has to back off, not just us
+                self.budget.pause(delay)
+            return delay
+        except RivianUnauthenticated as err:
+            POLL_ERRORS.labels(type(err).__name__).inc()
+            self.health.unauthenticated(err)
+            if self.session_cache is not None:
+                # Don't restore the same session on the next start
+                self.session_cache.clear()
             raise
         except RivianApiException as ex:
-            log.error("Rivian api exception: %s", ex, exc_info=1)
+            POLL_ERRORS.labels(type(ex).__name__).inc()
+            log.error("Rivian api exception for %s: %s", vin, ex, exc_info=1)
+            return backoff.next_delay()
         except Exception as ex:  # pylint: disable=broad-except
+            POLL_ERRORS.labels(type(ex).__name__).inc()
             log.error(
-                "Unknown Exception while updating Rivian data: %s", ex, exc_info=1
+                "Unknown Exception while updating Rivian data for %s: %s",
+                vin,
+                ex,
+                exc_info=1,
             )
+            return backoff.next_delay()
+        finally:
+            for listener in self.poll_listeners:
+                listener(vin)
 
-    async def run(self) -> None:
-        await self.rivian.create_csrf_token()
+    async def vehicle_loop(self, vin: str) -> None:
+        ticker = FixedRateTicker(self.scrape_interval)
+        backoff = self.backoff()
+        ticker.reset()
+        while True:
+            delay = await self.inner_loop(vin, backoff)
+            if delay is None:
+                ticker.interval = self.poll_interval(vin)
+                await ticker.wait()
+                continue
+            self.health.failed(vin, delay)
+            log.info(f"Retrying {vin} in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            ticker.reset()
+
+    async def subscription_loop(self, vin: str) -> None:
+        """
+        Seed the full state with a poll then apply subscription frames as they
+        arrive.  Whenever the subscription is down we fall back to polling and
+        try to resubscribe with exponential backoff.
+        """
+        loop = asyncio.get_running_loop()
+        subscription = VehicleSubscription(
+            self.rivian, vin, lambda update: self.apply_update(vin, update)
+        )
+        backoff = self.backoff()
+        resubscribe = Backoff(SUBSCRIBE_BACKOFF_MIN, SUBSCRIBE_BACKOFF_MAX)
+        await self.inner_loop(vin, backoff)
+        next_attempt = loop.time()
         while True:
-            await self.inner_loop()
+            self.health.subscription(vin, subscription.connected)
+            if subscription.connected:
+                resubscribe.reset()
+                next_attempt = loop.time() + SUBSCRIBE_BACKOFF_MIN
+                await asyncio.sleep(SUBSCRIPTION_CHECK_INTERVAL)
+                continue
+            if loop.time() >= next_attempt:
+                await subscription.stop()
+                if await subscription.start(set(self.properties)):
+                    continue
+                wait = resubscribe.next_delay()
+                next_attempt = loop.time() + wait
+                log.info(f"Polling {vin} for {wait:.0f}s before resubscribing")
+            delay = await self.inner_loop(vin, backoff)
+            if delay is not None:
+                self.health.failed(vin, delay)
+            await asyncio.sleep(self.scrape_interval if delay is None else delay)
+
+    async def serve_on_demand(self) -> None:
+        """
+        Swap the global metrics for a collector that fetches vehicle state when
+        Prometheus scrapes, at most once per scrape interval per vehicle
+        """
+        cache = StateCache(self.fetch_state, self.scrape_interval)
+        for collector in COLLECTORS:
+            prom.REGISTRY.unregister(collector.metric)
+        prom.REGISTRY.register(
+            RivianCollector(
+                COLLECTORS,
+                cache,
+                self.vins,
+                asyncio.get_running_loop(),
+                timestamps=self.field_timestamps,
+            )
+        )
+        # The HTTP server thread drives all the work from here on
+        await asyncio.Event().wait()
+
+    def reload_metrics(self) -> None:
+        """
+        Swap in the metric definitions from `metrics_config`, keeping the
+        current ones if they're invalid.  Running subscriptions only receive
+        newly needed fields once they resubscribe.
+        """
+        if self.metrics_config is None:
+            return
+        try:
+            collectors = load_collectors(self.metrics_config, self.state_sets)
+            use_collectors(collectors, register=self.mode != "on-demand")
+        except (config.ConfigError, ValueError) as ex:
+            log.error(f"Keeping the current metrics: {ex}")
+            return
+        self.properties = PLAN.sources | self.extra_properties
+        log.info(f"Loaded {len(collectors)} metrics from {self.metrics_config}")
+        # Fill the new metrics in rather than leaving them empty until the next poll
+        for vin, state in self.states.items():
+            PLAN.execute(state, vin)
+            self.notify(vin)
+
+    async def expire_series(self) -> None:
+        """Remove series whose fields haven't been reported for PLAN.series_ttl"""
+        assert PLAN.series_ttl is not None
+        while True:
+            await asyncio.sleep(min(PLAN.series_ttl / 2, EXPIRY_INTERVAL))
+            for vin in PLAN.expire(monotonic()):
+                log.info(f"Nothing reported for {vin} in a while, removed its series")
+                self.forget(vin)
+
+    def forget(self, vin: str) -> None:
+        """Drop the state of `vin` and have the listeners drop theirs"""
+        self.states.pop(vin, None)
+        remove_series(LAST_SUCCESS, vin)
+        self.health.forget(vin)
+        self.notify(vin)
+
+    async def run(self) -> None:
+        if self.metrics_config is not None:
+            loop = asyncio.get_running_loop()
+            loop.add_signal_handler(signal.SIGHUP, self.reload_metrics)
+        await self.start_session()
+        if not self.vins:
+            self.vins = await self.discover_vins()
+            log.info(f"Discovered {len(self.vins)} vehicles: {self.vins}")
+        self.health.expect(self.vins)
+        if self.mode == "on-demand":
+            await self.serve_on_demand()
+            return
+        async with asyncio.TaskGroup() as tg:
+            for vin in self.vins:
+                if self.mode == "subscribe":
+                    tg.create_task(self.subscription_loop(vin))
+                else:
+                    tg.create_task(self.vehicle_loop(vin))
+
+    async def record(self, recorder: Recorder, count: int = 0) -> None:
+        """
+        Poll every vehicle each scrape interval and append the responses to
+        `recorder`, `count` times or until cancelled when it's 0
+        """
+        async with self.rivian:
+            await self.start_session()
+            if not self.vins:
+                self.vins = await self.discover_vins()
+            ticker = FixedRateTicker(self.scrape_interval)
+            ticker.reset()
+            polls = 0
+            while True:
+                responses = await asyncio.gather(
+                    *(self.fetch_state(vin) for vin in self.vins),
+                    return_exceptions=True,
+                )
+                for vin, response in zip(self.vins, responses):
+                    if isinstance(response, BaseException):
+                        log.error("Unable to record %s: %s", vin, response)
+                        continue
+                    recorder.write(vin, response)
+                recorder.flush()
+                polls += 1
+                log.info(f"Recorded poll {polls} of {len(self.vins)} vehicles")
+                if polls == count:
+                    return
+                await ticker.wait()
+
+    async def snapshot(
+        self, output: TextIO, interval: float = 0, count: int = 1
+    ) -> None:
+        """
+        Fetch every vehicle's state and write each to `output` as an NDJSON
+        {"fetched_at", "vin", "response"} line as soon as it arrives, or with
+        an "error" instead of the response when it couldn't be fetched.
+        Repeats every `interval` seconds, `count` times or until cancelled when
+        it's 0.
+        """
+        async with self.rivian:
+            await self.start_session()
+            if not self.vins:
+                self.vins = await self.discover_vins()
+            ticker = FixedRateTicker(interval)
+            ticker.reset()
+            rounds = 0
+            while True:
+                fetches = [self.snapshot_entry(vin) for vin in self.vins]
+                for fetched in asyncio.as_completed(fetches):
+                    entry = await fetched
+                    output.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                    output.flush()
+                rounds += 1
+                log.info(f"Fetched {len(self.vins)} vehicles, round {rounds}")
+                if rounds == count:
+                    return
+                await ticker.wait()
+
+    async def snapshot_entry(self, vin: str) -> dict[str, Any]:
+        """One NDJSON line of `snapshot`"""
+        entry: dict[str, Any] = {"fetched_at": time(), "vin": vin}
+        try:
+            entry["response"] = await self.fetch_state(vin)
+        except RivianUnauthenticated:
+            if self.session_cache is not None:
+                self.session_cache.clear()
+            raise
+        except Exception as err:  # pylint: disable=broad-except
+            POLL_ERRORS.labels(type(err).__name__).inc()
+            log.error("Unable to fetch %s: %s", vin, err)
+            entry["error"] = f"{type(err).__name__}: {err}"
+            if isinstance(err, RivianApiRateLimitError) and self.budget is not None:
+                # Slow the rest of the batch down rather than failing it too
+                self.budget.pause(retry_after(err) or BACKOFF_MAX)
+        return entry
+
+
+class ReplayExporter(RivianExporter):
+    """
+    Feeds a recording made by the record command through the same processing
+    as live polls, without touching the API.  Responses are replayed at
+    `speed` times the rate they were recorded at, or as fast as possible when
+    `speed` is 0, and each is applied to `fanout` synthetic VINs named
+    {vin}-0000, {vin}-0001... when given.
+    """
+
+    path: str
+    speed: float
+    fanout: int
+
+    def __init__(
+        self,
+        path: str,
+        speed: float = 1.0,
+        fanout: int = 0,
+        field_timestamps: bool = False,
+        json_decoder: str = decoding.DEFAULT_DECODER,
+    ) -> None:
+        self.path = path
+        self.speed = speed
+        self.fanout = fanout
+        super().__init__(
+            [],
+            scrape_interval=0,
+            mode="replay",
+            field_timestamps=field_timestamps,
+            json_decoder=json_decoder,
+        )
+
+    def connect(self) -> Rivian:
+        # Never used, so no credentials are needed
+        return Rivian()
+
+    def targets(self, vin: str) -> list[str]:
+        if not self.fanout:
+            return [vin]
+        return [f"{vin}-{i:04}" for i in range(self.fanout)]
+
+    async def replay(self) -> int:
+        """Replay the recording once and return how many polls were applied"""
+        loop = asyncio.get_running_loop()
+        start: Optional[tuple[float, float]] = None
+        polls = 0
+        for recorded in read_recording(self.path, self.decode):
+            if start is None:
+                start = (recorded.recorded_at, loop.time())
+            due = 0.0
+            if self.speed > 0:
+                due = start[1] + (recorded.recorded_at - start[0]) / self.speed
+            # Sleeping even when behind lets the metrics server answer scrapes
+            await asyncio.sleep(max(due - loop.time(), 0))
+            for vin in self.targets(recorded.vin):
+                self.apply_state(vin, recorded.response)
+                polls += 1
+        return polls
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        polls = await self.replay()
+        elapsed = loop.time() - started
+        log.info(
+            f"Replayed {polls} polls from {self.path} in {elapsed:.1f}s "
+            f"({polls / max(elapsed, 1e-9):.0f} polls/s)"
+        )
+        # Keep serving the final state
+        await asyncio.Event().wait()
+
+
+def configure_plan(
+    field_timestamps: bool,
+    remove_missing: bool,
+    collector_timings: bool,
+    series_ttl: Optional[float],
+    max_series: Optional[int],
+) -> None:
+    if field_timestamps:
+        PLAN.field_timestamps = FieldTimestamps()
+    PLAN.remove_missing = remove_missing
+    PLAN.series_ttl = series_ttl
+    PLAN.max_series = max_series
+    if collector_timings:
+        PLAN.enable_timings()
+
+
+def check_options(
+    mode: str,
+    server: str,
+    replay_file: Optional[str],
+    adaptive_polling: bool,
+    state_api: bool,
+    health_thresholds: bool,
+) -> None:
+    """Raise ValueError for options of run() that don't go together"""
+    if mode == "replay" and replay_file is None:
+        raise ValueError("Replay mode needs a recording to replay")
+    if adaptive_polling and mode != "poll":
+        raise ValueError("Adaptive polling only applies to poll mode")
+    if state_api and server != "asyncio":
+        raise ValueError("The state API is only served by the asyncio server")
+    if health_thresholds and server != "asyncio":
+        raise ValueError("Health checks are only served by the asyncio server")
+
+
+def run(
+    port: int,
+    scrape_interval: int,
+    vins: list[str],
+    concurrency: int,
+    mode: str = "poll",
+    field_timestamps: bool = False,
+    requests_per_minute: Optional[float] = None,
+    server: str = "threaded",
+    remove_missing: bool = False,
+    collector_timings: bool = False,
+    session_cache: Optional[SessionCache] = None,
+    json_decoder: str = decoding.DEFAULT_DECODER,
+    replay_file: Optional[str] = None,
+    replay_speed: float = 1.0,
+    replay_vins: int = 0,
+    remote_write_url: Optional[str] = None,
+    remote_write_queue: str = "remote-write-queue",
+    remote_write_max_polls: int = 20000,
+    metrics_config: Optional[str] = None,
+    host: str = "0.0.0.0",
+    derived_metrics: bool = False,
+    efficiency_windows: Sequence[str] = DEFAULT_WINDOWS,
+    sessions: bool = False,
+    state_sets: bool = False,
+    series_ttl: Optional[float] = None,
+    max_series: Optional[int] = None,
+    adaptive_polling: bool = False,
+    poll_intervals: Optional[dict[str, float]] = None,
+    state_api: bool = False,
+    health_max_age: Optional[float] = None,
+    ready_max_age: Optional[float] = None,
+) -> None:
+    """
+    `replay_file` is required in replay mode and ignored otherwise.  /metrics
+    is served on `host`, every interface by default.  The state API needs the
+    asyncio server, as do /healthz and /readyz, so their thresholds can't be
+    set without it.
+    """
+    check_options(
+        mode,
+        server,
+        replay_file,
+        adaptive_polling,
+        state_api,
+        bool(health_max_age or ready_max_age),
+    )
+    use_collectors(load_collectors(metrics_config, state_sets))
+    if server == "threaded":
+        log.info(f"Starting prometheus server on port {port}")
+        prom.start_http_server(port, host)
+    configure_plan(
+        field_timestamps and mode != "on-demand",
+        remove_missing,
+        collector_timings,
+        series_ttl,
+        max_series,
+    )
+    exporter: RivianExporter
+    if mode == "replay" and replay_file is not None:
+        exporter = ReplayExporter(
+            replay_file, replay_speed, replay_vins, field_timestamps, json_decoder
+        )
+    else:
+        exporter = RivianExporter(
+            vins,
+            scrape_interval,
+            concurrency,
+            mode,
+            field_timestamps,
+            requests_per_minute,
+            session_cache,
+            json_decoder,
+            metrics_config,
+        )
+    exporter.state_sets = state_sets
+    if adaptive_polling:
+        exporter.adapt_polling(poll_intervals)
+    exporter.set_health_thresholds(health_max_age, ready_max_age)
+    if derived_metrics:
+        exporter.add_tracker(DerivedMetrics(efficiency_windows))
+    if sessions:
+        exporter.add_tracker(SessionTracker())
+    remote_writer = None
+    if remote_write_url:
+        queue = SampleQueue(remote_write_queue, remote_write_max_polls)
+        remote_writer = RemoteWriter(remote_write_url, COLLECTORS, queue)
+    asyncio.run(
+        serve(
+            exporter,
+            port if server == "asyncio" else None,
+            remote_writer,
+            host,
+            state_api,
+        )
+    )
+
+
+async def serve(
+    exporter: RivianExporter,
+    port: Optional[int] = None,
+    remote_writer: Optional[RemoteWriter] = None,
+    host: str = "0.0.0.0",
+    state_api: bool = False,
+) -> None:
+    """
+    Run the exporter, serving /metrics, and the state API when `state_api` is
+    on, from its event loop when there's a `port` and pushing every update
+    through the `remote_writer` if any
+    """
+    async with asyncio.TaskGroup() as tg:
+        if PLAN.series_ttl is not None and exporter.mode != "on-demand":
+            tg.create_task(exporter.expire_series())
+        if remote_writer is not None:
+            writer = remote_writer
+
+            def observe(vin: str) -> None:
+                if vin in exporter.states:
+                    writer.observe(vin, exporter.states[vin])
+                else:
+                    writer.forget(vin)
+
+            exporter.add_listener(observe)
+            tg.create_task(writer.run())
+        if port is None:
+            tg.create_task(exporter.run())
+        else:
+            tg.create_task(run_with_server(exporter, port, host, state_api))
+
+
+async def run_with_server(
+    exporter: RivianExporter,
+    port: int,
+    host: str = "0.0.0.0",
+    state_api: bool = False,
+) -> None:
+    """
+    Serve /metrics from the same event loop the exporter polls on.  When the
+    session is rejected polling stops but the server stays up, failing
+    /healthz, until cancelled.
+    """
+    metrics_server = MetricsServer(
+        # Field ages are computed at scrape time so can't be cached for long
+        max_age=1 if exporter.field_timestamps else RENDER_MAX_AGE,
+        # On-demand collection fetches during the render
+        cache=exporter.mode != "on-demand",
+    )
+    exporter.add_listener(lambda _: metrics_server.invalidate())
+    # Failed polls update poll_errors and the like without touching the state
+    exporter.add_poll_listener(lambda _: metrics_server.invalidate())
+    metrics_server.routes += exporter.health.routes()
+    if state_api:
+        api = StateApi(exporter.states)
+        exporter.add_listener(api.invalidate)
+        metrics_server.routes += api.routes()
+    await metrics_server.start(port, host)
+    rejected: Optional[Exception] = None
+    try:
+        try:
+            await exporter.run()
+        except* RivianUnauthenticated as group:
+            rejected = group.exceptions[0]
+        if rejected is not None:
+            # Stay up so /healthz can say why until the orchestrator restarts us
+            exporter.health.unauthenticated(rejected)
+            log.error(f"Stopped polling, the Rivian session was rejected: {rejected}")
+            await asyncio.Event().wait()
+    finally:
+        await metrics_server.stop()
+
+
+def record(
+    path: str,
+    vins: list[str],
+    scrape_interval: int,
+    count: int = 0,
+    full_state: bool = False,
+    session_cache: Optional[SessionCache] = None,
+) -> None:
+    exporter = RivianExporter(vins, scrape_interval, session_cache=session_cache)
+    if full_state:
+        exporter.properties = frozenset()
+    with Recorder(path) as recorder:
+        asyncio.run(exporter.record(recorder, count))
 
 
-def run(port: int, scrape_interval: int, vin: str) -> None:
-    log.info(f"Starting prometheus server on port {port}")
-    prom.start_http_server(port)
-    exporter = RivianExporter(vin, scrape_interval)
-    asyncio.run(exporter.run())
+def snapshot(
+    output: TextIO,
+    vins: list[str],
+    concurrency: int = 4,
+    interval: float = 0,
+    count: int = 1,
+    full_state: bool = False,
+    requests_per_minute: Optional[float] = None,
+    session_cache: Optional[SessionCache] = None,
+) -> None:
+    """
+    Stream the state of `vins`, or of every vehicle on the account when there
+    are none, to `output` as NDJSON over one session
+    """
+    exporter = RivianExporter(
+        vins,
+        int(interval),
+        concurrency,
+        requests_per_minute=requests_per_minute,
+        session_cache=session_cache,
+    )
+    if full_state:
+        exporter.properties = frozenset()
+    asyncio.run(exporter.snapshot(output, interval, count))
@@ -0,0 +1,162 @@
+from time import monotonic
+from typing import Any, Iterable, Optional
+
+from aiohttp import web
+
+# With no vehicle polled for this long (seconds) the exporter counts as wedged,
+# long enough to ride out the longest backoff
+DEFAULT_MAX_AGE = 1800.0
+# A vehicle counts as stale for readiness after missing this many polls
+READY_POLLS = 3
+
+
+class VehicleHealth:
+    """How polling one vehicle is going"""
+
+    """monotonic() of the last successful poll, None until there's been one"""
+    polled_at: Optional[float]
+    """monotonic() when a failed poll will be retried, None when it succeeded"""
+    retry_at: Optional[float]
+    failures: int
+    subscribed: bool
+
+    def __init__(self) -> None:
+        self.polled_at = None
+        self.retry_at = None
+        self.failures = 0
+        self.subscribed = False
+
+
+class Health:
+    """
+    Tracks how fresh each vehicle's data is, whether the session has been
+    rejected and whether the account is being rate limited, and serves them
+    as /healthz and /readyz.
+
+    /healthz fails once the session has been rejected, or when no vehicle has
+    been polled for `max_age`, which is what a wedged exporter looks like:
+    orchestrators should restart it.  /readyz also fails while any vehicle is
+    older than `ready_max_age` or the account is rate limited: the data is
+    stale, so route around it.  A vehicle with a connected subscription is
+    always fresh, and in on-demand mode, where nothing is fetched between
+    scrapes, only the session is checked.
+    """
+
+    started_at: float
+    vehicles: dict[str, VehicleHealth]
+    """Why the session was rejected, if it was"""
+    auth_error: Optional[str]
+    """monotonic() until which the account is rate limited"""
+    paused_until: float
+    max_age: float
+    ready_max_age: float
+    """Off when vehicles are only fetched on scrape"""
+    check_freshness: bool
+
+    def __init__(
+        self, max_age: float = DEFAULT_MAX_AGE, ready_max_age: float = DEFAULT_MAX_AGE
+    ) -> None:
+        self.started_at = monotonic()
+        self.vehicles = {}
+        self.auth_error = None
+        self.paused_until = 0.0
+        self.max_age = max_age
+        self.ready_max_age = ready_max_age
+        self.check_freshness = True
+
+    def vehicle(self, vin: str) -> VehicleHealth:
+        vehicle = self.vehicles.get(vin)
+        if vehicle is None:
+            vehicle = self.vehicles[vin] = VehicleHealth()
+        return vehicle
+
+    def expect(self, vins: Iterable[str]) -> None:
+        """Vehicles that are stale until their first poll"""
+        for vin in vins:
+            self.vehicle(vin)
+
+    def polled(self, vin: str) -> None:
+        vehicle = self.vehicle(vin)
+        vehicle.polled_at = monotonic()
+        vehicle.retry_at = None
+        vehicle.failures = 0
+        self.auth_error = None
+
+    def failed(self, vin: str, delay: float) -> None:
+        vehicle = self.vehicle(vin)
+        vehicle.retry_at = monotonic() + delay
+        vehicle.failures += 1
+
+    def forget(self, vin: str) -> None:
+        """Stop expecting `vin` to be polled"""
+        self.vehicles.pop(vin, None)
+
+    def subscription(self, vin: str, connected: bool) -> None:
+        self.vehicle(vin).subscribed = connected
+
+    def unauthenticated(self, error: Exception) -> None:
+        self.auth_error = str(error) or type(error).__name__
+
+    def rate_limited(self, delay: float) -> None:
+        self.paused_until = max(self.paused_until, monotonic() + delay)
+
+    def age(self, vehicle: VehicleHealth, now: float) -> float:
+        """Seconds since the vehicle was last polled, or since starting"""
+        if vehicle.subscribed or not self.check_freshness:
+            return 0.0
+        return now - (
+            self.started_at if vehicle.polled_at is None else vehicle.polled_at
+        )
+
+    def liveness_problems(self, now: float) -> list[str]:
+        problems = []
+        if self.auth_error is not None:
+            problems.append(f"The Rivian session was rejected: {self.auth_error}")
+        ages = [self.age(v, now) for v in self.vehicles.values()]
+        age = min(ages) if ages else now - self.started_at
+        if self.check_freshness and age > self.max_age:
+            problems.append(f"No vehicle has been polled for {age:.0f}s")
+        return problems
+
+    def readiness_problems(self, now: float) -> list[str]:
+        problems = self.liveness_problems(now)
+        if now < self.paused_until:
+            problems.append(f"Rate limited for {self.paused_until - now:.0f}s")
+        if not self.vehicles:
+            problems.append("No vehicles yet")
+        for vin, vehicle in sorted(self.vehicles.items()):
+            age = self.age(vehicle, now)
+            if age > self.ready_max_age:
+                problems.append(f"{vin} hasn't been polled for {age:.0f}s")
+        return problems
+
+    def report(self, problems: list[str], now: float) -> dict[str, Any]:
+        vehicles = {}
+        for vin, vehicle in sorted(self.vehicles.items()):
+            polled = vehicle.polled_at
+            retry = vehicle.retry_at
+            vehicles[vin] = {
+                "last_poll_age_seconds": None if polled is None else now - polled,
+                "retry_in_seconds": None if retry is None else max(retry - now, 0),
+                "consecutive_failures": vehicle.failures,
+                "subscribed": vehicle.subscribed,
+            }
+        return {"ok": not problems, "problems": problems, "vehicles": vehicles}
+
+    async def handle_healthz(self, request: web.Request) -> web.Response:
+        now = monotonic()
+        problems = self.liveness_problems(now)
+        status = 503 if problems else 200
+        return web.json_response(self.report(problems, now), status=status)
+
+    async def handle_readyz(self, request: web.Request) -> web.Response:
+        now = monotonic()
+        problems = self.readiness_problems(now)
+        status = 503 if problems else 200
+        return web.json_response(self.report(problems, now), status=status)
+
+    def routes(self) -> list[web.RouteDef]:
+        return [
+            web.get("/healthz", self.handle_healthz),
+            web.get("/readyz", self.handle_readyz),
+        ]
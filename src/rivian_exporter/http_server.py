@@ -0,0 +1,112 @@
+import asyncio
+import gzip
+from typing import Optional
+
+import glog as log
+import prometheus_client as prom
+from aiohttp import web
+from prometheus_client import exposition
+
+# Process metrics and poll errors change without a data update, so a render is
+# only reused for this many seconds by default
+RENDER_MAX_AGE = 5.0
+
+
+class MetricsServer:
+    """
+    Serves /metrics from the exporter's own event loop.  The exposition is
+    rendered at most once per data update (see `invalidate`) for each format
+    and encoding, and the bytes are reused for every scrape until the next
+    update.  Rendering happens on a worker thread so a big registry doesn't
+    stall polling.
+
+    `max_age` bounds how long a render is reused for, for metrics that change
+    without a data update (e.g. process metrics or ages computed at scrape
+    time), None to reuse it until the next update.  With `cache` off every
+    scrape renders, which on-demand collection needs.
+    """
+
+    registry: prom.CollectorRegistry
+    max_age: Optional[float]
+    cache: bool
+    generation: int
+    rendered: dict[tuple[str, bool], tuple[int, float, bytes]]
+    """Served alongside /metrics"""
+    routes: list[web.RouteDef]
+    runner: Optional[web.AppRunner]
+
+    def __init__(
+        self,
+        registry: prom.CollectorRegistry = prom.REGISTRY,
+        max_age: Optional[float] = RENDER_MAX_AGE,
+        cache: bool = True,
+    ) -> None:
+        self.registry = registry
+        self.max_age = max_age
+        self.cache = cache
+        self.generation = 0
+        self.rendered = {}
+        self.routes = []
+        self.runner = None
+        self.render_lock = asyncio.Lock()
+
+    def invalidate(self) -> None:
+        """Called whenever the metrics have been updated or a poll failed"""
+        self.generation += 1
+
+    def cached(self, key: tuple[str, bool], now: float) -> Optional[bytes]:
+        if not self.cache or key not in self.rendered:
+            return None
+        generation, rendered_at, body = self.rendered[key]
+        if generation != self.generation:
+            return None
+        if self.max_age is not None and now - rendered_at > self.max_age:
+            return None
+        return body
+
+    async def render(self, accept: str, compress: bool) -> tuple[bytes, str]:
+        encoder, content_type = exposition.choose_encoder(accept)
+        key = (content_type, compress)
+        loop = asyncio.get_running_loop()
+        body = self.cached(key, loop.time())
+        if body is not None:
+            return body, content_type
+        # Concurrent scrapes wait for one render instead of each doing their own
+        async with self.render_lock:
+            body = self.cached(key, loop.time())
+            if body is not None:
+                return body, content_type
+            generation = self.generation
+            rendered_at = loop.time()
+            body = await loop.run_in_executor(None, encoder, self.registry)
+            if compress:
+                body = await loop.run_in_executor(None, gzip.compress, body)
+            self.rendered[key] = (generation, rendered_at, body)
+        return body, content_type
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        accept = request.headers.get("Accept", "")
+        compress = "gzip" in request.headers.get("Accept-Encoding", "")
+        body, content_type = await self.render(accept, compress)
+        headers = {"Content-Type": content_type}
+        if compress:
+            headers["Content-Encoding"] = "gzip"
+        return web.Response(body=body, headers=headers)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/", self.handle_metrics)
+        app.router.add_get("/metrics", self.handle_metrics)
+        app.add_routes(self.routes)
+        return app
+
+    async def start(self, port: int, host: str = "0.0.0.0") -> None:
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        log.info(f"Serving metrics from the event loop on port {port}")
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,108 @@
+import prometheus_client as prom
+from prometheus_client.metrics import MetricWrapperBase
+
+# Metrics about the exporter itself rather than the vehicles it exports
+
+# Rivian responses range from a few hundred bytes to tens of kilobytes
+BYTES_BUCKETS = (256, 1024, 4096, 8192, 16384, 32768, 65536, 131072, 262144)
+# Decoding and processing should take micro to milliseconds
+FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+
+REQUEST_DURATION = prom.Histogram(
+    "rivian_exporter_request_duration_seconds",
+    "Time taken by Rivian API requests",
+    ["operation"],
+)
+RESPONSE_BYTES = prom.Histogram(
+    "rivian_exporter_response_bytes",
+    "Size of Rivian API response bodies",
+    ["operation"],
+    buckets=BYTES_BUCKETS,
+)
+DECODE_DURATION = prom.Histogram(
+    "rivian_exporter_decode_duration_seconds",
+    "Time taken to decode Rivian API responses",
+    ["operation"],
+    buckets=FAST_BUCKETS,
+)
+PROCESSING_DURATION = prom.Histogram(
+    "rivian_exporter_processing_duration_seconds",
+    "Time taken to turn a vehicle state into metrics",
+    ["update"],
+    buckets=FAST_BUCKETS,
+)
+COLLECTOR_DURATION = prom.Histogram(
+    "rivian_exporter_collector_duration_seconds",
+    "Time taken to set each collector, only when collector timings are enabled",
+    ["collector"],
+    buckets=FAST_BUCKETS,
+)
+LAST_SUCCESS = prom.Gauge(
+    "rivian_exporter_last_success_timestamp_seconds",
+    "When the vehicle state was last updated successfully",
+    ["vin"],
+)
+POLL_ERRORS = prom.Counter(
+    "rivian_exporter_poll_errors",
+    "Failed vehicle state polls by exception class",
+    ["exception"],
+)
+POLL_TIER = prom.Gauge(
+    "rivian_exporter_poll_tier",
+    "The adaptive polling tier each vehicle is in, 1 for the current tier",
+    ["vin", "tier"],
+)
+POLL_INTERVAL = prom.Gauge(
+    "rivian_exporter_poll_interval_seconds",
+    "How often each vehicle is being polled by adaptive polling",
+    ["vin"],
+)
+SERIES_DROPPED = prom.Counter(
+    "rivian_exporter_series_dropped",
+    "Series removed as their field stopped being reported, or not created as "
+    "the series budget was used up (each refused series is counted once)",
+    ["reason"],
+)
+REMOTE_WRITE_SAMPLES = prom.Counter(
+    "rivian_exporter_remote_write_samples",
+    "Samples accepted by the remote write endpoint",
+)
+REMOTE_WRITE_FAILURES = prom.Counter(
+    "rivian_exporter_remote_write_failures",
+    "Failed remote write requests by HTTP status or exception class",
+    ["reason"],
+)
+REMOTE_WRITE_DROPPED = prom.Counter(
+    "rivian_exporter_remote_write_dropped_samples",
+    "Samples never pushed because the queue was full or the endpoint rejected them",
+    ["reason"],
+)
+REMOTE_WRITE_QUEUE = prom.Gauge(
+    "rivian_exporter_remote_write_queued_polls",
+    "Polls waiting to be pushed to the remote write endpoint",
+)
+
+# The supervisor's own metrics, served alongside those scraped from its workers.
+# They're kept out of the default registry which every worker also exports.
+SUPERVISOR_REGISTRY = prom.CollectorRegistry()
+prom.ProcessCollector(registry=SUPERVISOR_REGISTRY)
+WORKER_UP = prom.Gauge(
+    "rivian_exporter_worker_up",
+    "Whether the last scrape of each worker process succeeded",
+    ["shard"],
+    registry=SUPERVISOR_REGISTRY,
+)
+WORKER_RESTARTS = prom.Counter(
+    "rivian_exporter_worker_restarts",
+    "Worker processes restarted after exiting",
+    ["shard"],
+    registry=SUPERVISOR_REGISTRY,
+)
+
+
+def remove_series(metric: MetricWrapperBase, *labels: str) -> None:
+    """Remove a labelled series, if it was ever created"""
+    try:
+        metric.remove(*labels)
+    except KeyError:
+        pass
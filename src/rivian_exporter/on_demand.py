@@ -0,0 +1,130 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Iterable, Optional, Sequence
+
+import glog as log
+from prometheus_client.metrics_core import Metric
+from prometheus_client.registry import Collector
+
+from .decoding import vehicle_state
+from .rivian_collectors import VehicleCollector, field_timestamp_families
+
+Fetch = Callable[[str], Awaitable[Any]]
+
+
+class StateCache:
+    """
+    Caches the vehicle state response of each VIN for `ttl` seconds.  Callers
+    that miss the cache while a fetch is already running for that VIN wait on
+    the same fetch rather than starting another one.
+    """
+
+    fetch: Fetch
+    ttl: float
+    entries: dict[str, tuple[float, Any]]
+    inflight: dict[str, "asyncio.Future[Any]"]
+
+    def __init__(self, fetch: Fetch, ttl: float) -> None:
+        self.fetch = fetch
+        self.ttl = ttl
+        self.entries = {}
+        self.inflight = {}
+
+    async def get(self, vin: str) -> Any:
+        loop = asyncio.get_running_loop()
+        entry = self.entries.get(vin)
+        if entry is not None and loop.time() - entry[0] < self.ttl:
+            return entry[1]
+
+        future = self.inflight.get(vin)
+        if future is None:
+            future = asyncio.ensure_future(self.refresh(vin))
+            self.inflight[vin] = future
+            future.add_done_callback(lambda _: self.inflight.pop(vin, None))
+        # Shield the shared fetch so one scrape timing out doesn't cancel it for
+        # every other scrape waiting on it
+        return await asyncio.shield(future)
+
+    async def refresh(self, vin: str) -> Any:
+        loop = asyncio.get_running_loop()
+        try:
+            state = await self.fetch(vin)
+        except Exception as ex:  # pylint: disable=broad-except
+            entry = self.entries.get(vin)
+            if entry is None:
+                raise
+            log.error("Serving stale state for %s: %s", vin, ex, exc_info=1)
+            return entry[1]
+        self.entries[vin] = (loop.time(), state)
+        return state
+
+
+class RivianCollector(Collector):
+    """
+    Renders the Rivian gauges and infos on demand.  `collect` is called from
+    the Prometheus HTTP server thread so the cache lookups are handed to the
+    event loop the Rivian client lives on.
+
+    With `timestamps` it also renders rivian_field_timestamp_seconds and
+    rivian_field_age_seconds, as the other modes do.  The samples aren't
+    stamped with the reported times: Prometheus drops samples that old.
+    """
+
+    """Not copied, so reloaded metric definitions are picked up"""
+    collectors: Sequence[VehicleCollector]
+    cache: StateCache
+    vins: list[str]
+    loop: asyncio.AbstractEventLoop
+    timeout: float
+    """Render when each field was reported"""
+    timestamps: bool
+
+    def __init__(
+        self,
+        collectors: Sequence[VehicleCollector],
+        cache: StateCache,
+        vins: list[str],
+        loop: asyncio.AbstractEventLoop,
+        timeout: float = 30,
+        timestamps: bool = False,
+    ) -> None:
+        self.collectors = collectors
+        self.cache = cache
+        self.vins = vins
+        self.loop = loop
+        self.timeout = timeout
+        self.timestamps = timestamps
+
+    async def states(self) -> dict[str, dict[str, Any]]:
+        results = await asyncio.gather(
+            *(self.cache.get(vin) for vin in self.vins), return_exceptions=True
+        )
+        states = {}
+        for vin, result in zip(self.vins, results):
+            if isinstance(result, BaseException):
+                log.error("Unable to get vehicle state for %s: %s", vin, result)
+                continue
+            states[vin] = vehicle_state(result)
+        return states
+
+    def describe(self) -> Iterable[Metric]:
+        # Without this the registry would call collect() on registration, which
+        # would fetch from the API
+        for collector in self.collectors:
+            yield collector.family({})
+        if self.timestamps:
+            yield from field_timestamp_families({}, (), 0)
+
+    def collect(self) -> Iterable[Metric]:
+        states: Optional[dict[str, dict[str, Any]]] = None
+        future = asyncio.run_coroutine_threadsafe(self.states(), self.loop)
+        try:
+            states = future.result(self.timeout)
+        except Exception as ex:  # pylint: disable=broad-except
+            future.cancel()
+            log.error("Unable to collect vehicle states: %s", ex, exc_info=1)
+        for collector in self.collectors:
+            yield collector.family(states or {})
+        if self.timestamps:
+            fields = {s for collector in self.collectors for s in collector.sources}
+            yield from field_timestamp_families(states or {}, fields, time.time())
@@ -0,0 +1,26 @@
+import re
+
+# Choices and defaults for command line options.  The CLI builds its options
+# from these before knowing which command runs, so this module mustn't import
+# anything heavy: the Rivian client, aiohttp and prometheus_client are only
+# imported by the commands that use them.
+
+MODES = ["poll", "subscribe", "on-demand", "replay"]
+SERVERS = ["threaded", "asyncio"]
+
+# Efficiency is exported for each of these windows unless others are given
+DEFAULT_WINDOWS = ("1h", "1d")
+WINDOW = re.compile(r"^(\d+)([smhd])$")
+WINDOW_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# Adaptive polling tiers in order of precedence.  "awake" polls every
+# --scrape-interval.
+TIERS = ("driving", "charging", "awake", "asleep")
+
+
+def parse_window(window: str) -> float:
+    """Seconds in a window such as 15m, 1h or 7d"""
+    match = WINDOW.match(window)
+    if match is None or int(match.group(1)) == 0:
+        raise ValueError(f"{window} isn't a window like 15m, 1h or 7d")
+    return int(match.group(1)) * WINDOW_UNITS[match.group(2)]
@@ -0,0 +1,502 @@
+from time import monotonic, perf_counter
+from typing import Any, Callable, Iterable, NamedTuple, Optional
+
+import glog as log
+import prometheus_client as prom
+
+from .instrumentation import COLLECTOR_DURATION, SERIES_DROPPED
+from .rivian_collectors import (
+    FieldTimestamps,
+    RivianGauge,
+    RivianStateSet,
+    VehicleCollector,
+    identity,
+)
+
+COLLECTOR_ERRORS = prom.Counter(
+    "rivian_collector_errors",
+    "Times a collector could not be set from the vehicle state",
+    ["collector"],
+)
+
+
+class GaugeStep(NamedTuple):
+    name: str
+    source: str
+    """Sub-key of the source field, None when `getter` has to be used"""
+    key: Optional[str]
+    getter: Callable[[Any], Any]
+    """None when the value is exported as is"""
+    modifier: Optional[Callable[[Any], Any]]
+    gauge: prom.Gauge
+
+
+class InfoStep(NamedTuple):
+    """(info label, source field, sub-key) for every label of the info"""
+
+    name: str
+    fields: tuple[tuple[str, str, str], ...]
+    sources: frozenset[str]
+    info: prom.Info
+
+
+class StateSetStep(NamedTuple):
+    name: str
+    source: str
+    key: str
+    state_set: RivianStateSet
+
+
+class BoundPlan(NamedTuple):
+    """
+    Per VIN state of a plan.  The labelled children are created on first use
+    and indexed like the plan's steps
+    """
+
+    gauges: list[Optional[Callable[[float], None]]]
+    infos: list[Optional[prom.Info]]
+    """Raw values each info was last set from, so unchanged infos are skipped"""
+    last_info: list[Optional[tuple[Any, ...]]]
+    """The last timeStamp seen for each source field"""
+    last_seen: dict[str, str]
+    """The setter of each state's child, for each state set"""
+    state_sets: list[dict[str, Callable[[float], None]]]
+    """The state each state set was last set to"""
+    last_state: list[Optional[str]]
+    """When each source field was last present, only kept with a series TTL"""
+    reported_at: dict[str, float]
+
+
+class ExtractionPlan:
+    """
+    COLLECTORS compiled into flat extraction steps.  Executing a plan is a
+    single pass over the vehicle state with no per-metric label lookups, debug
+    formatting or identity lambdas.
+
+    With `skip_unchanged` a field is only processed when its timeStamp differs
+    from the one seen on the previous execution for that VIN.
+
+    Each step fails on its own: a missing field or bad value counts towards
+    rivian_collector_errors_total and the other steps still run.  With
+    `remove_missing` the series of a step whose field vanished is removed
+    rather than left at its last value.
+
+    `enable_timings` observes how long every step takes in
+    rivian_exporter_collector_duration_seconds.  It's off by default as the
+    observations cost about as much as the steps themselves.
+
+    With a `series_ttl`, `expire` removes the series of fields that haven't
+    been reported for that many seconds, and forgets vehicles with nothing
+    left.  With `max_series` no more than that many series are created, the
+    rest being counted in rivian_exporter_series_dropped_total once each.
+    Fields whose series were refused are processed again on the next
+    execution, even when unchanged, in case the budget has room by then.
+    """
+
+    gauges: list[GaugeStep]
+    infos: list[InfoStep]
+    state_sets: list[StateSetStep]
+    sources: frozenset[str]
+    bound: dict[str, BoundPlan]
+    skip_unchanged: bool
+    remove_missing: bool
+    field_timestamps: Optional[FieldTimestamps]
+    series_ttl: Optional[float]
+    max_series: Optional[int]
+    """Labelled children currently exported"""
+    series: int
+    """The metric, VIN and state of each series the budget refused"""
+    refused: set[tuple[str, str, Optional[str]]]
+    gauge_timers: Optional[list[prom.Histogram]]
+    info_timers: Optional[list[prom.Histogram]]
+
+    def __init__(
+        self,
+        collectors: Iterable[VehicleCollector],
+        skip_unchanged: bool = True,
+        remove_missing: bool = False,
+    ) -> None:
+        self.skip_unchanged = skip_unchanged
+        self.remove_missing = remove_missing
+        self.field_timestamps = None
+        self.series_ttl = None
+        self.max_series = None
+        self.gauge_timers = None
+        self.info_timers = None
+        self.compile(collectors)
+
+    def compile(self, collectors: Iterable[VehicleCollector]) -> None:
+        """
+        (Re)build the steps from `collectors`, e.g. after the metric
+        definitions have been reloaded.  Per VIN state starts afresh.
+        """
+        self.gauges = []
+        self.infos = []
+        self.state_sets = []
+        self.bound = {}
+        self.series = 0
+        self.refused = set()
+        for collector in collectors:
+            if isinstance(collector, RivianGauge):
+                modifier = (
+                    None if collector.modifier is identity else collector.modifier
+                )
+                self.gauges.append(
+                    GaugeStep(
+                        collector.prometheus_label,
+                        collector.rivian_label,
+                        collector.key,
+                        collector.getter,
+                        modifier,
+                        collector.gauge,
+                    )
+                )
+            elif isinstance(collector, RivianStateSet):
+                self.state_sets.append(
+                    StateSetStep(
+                        collector.prometheus_label,
+                        collector.rivian_label,
+                        collector.key,
+                        collector,
+                    )
+                )
+            else:
+                fields = tuple(
+                    (label, source, key)
+                    for label, (source, key) in collector.data.items()
+                )
+                self.infos.append(
+                    InfoStep(
+                        collector.prometheus_label,
+                        fields,
+                        frozenset(collector.sources),
+                        collector.info,
+                    )
+                )
+        self.sources = frozenset(step.source for step in self.gauges).union(
+            (step.source for step in self.state_sets),
+            *(step.sources for step in self.infos),
+        )
+        if self.gauge_timers is not None:
+            self.enable_timings()
+
+    def enable_timings(self) -> None:
+        self.gauge_timers = [COLLECTOR_DURATION.labels(s.name) for s in self.gauges]
+        self.info_timers = [COLLECTOR_DURATION.labels(s.name) for s in self.infos]
+
+    def __len__(self) -> int:
+        return len(self.gauges) + len(self.infos) + len(self.state_sets)
+
+    def bind(self, vin: str) -> BoundPlan:
+        bound = self.bound.get(vin)
+        if bound is None:
+            bound = BoundPlan(
+                [None] * len(self.gauges),
+                [None] * len(self.infos),
+                [None] * len(self.infos),
+                {},
+                [{} for _ in self.state_sets],
+                [None] * len(self.state_sets),
+                {},
+            )
+            self.bound[vin] = bound
+        return bound
+
+    def fresh_sources(
+        self,
+        vehicle_state: dict[str, Any],
+        vin: str,
+        bound: BoundPlan,
+        changed: Optional[set[str]],
+    ) -> tuple[set[str], set[str]]:
+        """
+        Returns the present source fields that need processing, recording their
+        timestamps as seen, and on a full update the source fields that are
+        missing
+        """
+        last_seen = bound.last_seen
+        reported_at = bound.reported_at if self.series_ttl is not None else None
+        now = monotonic()
+        fresh = set()
+        missing = set()
+        for source in self.sources if changed is None else self.sources & changed:
+            datum = vehicle_state.get(source)
+            if datum is None:
+                if changed is None:
+                    missing.add(source)
+                    last_seen.pop(source, None)
+                continue
+            if reported_at is not None:
+                reported_at[source] = now
+            timestamp = datum.get("timeStamp") if isinstance(datum, dict) else None
+            if timestamp is None:
+                fresh.add(source)
+                continue
+            if self.skip_unchanged and last_seen.get(source) == timestamp:
+                continue
+            last_seen[source] = timestamp
+            fresh.add(source)
+            if self.field_timestamps is not None:
+                self.field_timestamps.observe(vin, source, timestamp)
+        return fresh, missing
+
+    def failed(self, name: str, vin: str, reason: Any) -> None:
+        COLLECTOR_ERRORS.labels(name).inc()
+        log.debug("Unable to set %s for %s: %s", name, vin, reason)
+
+    def admit(
+        self,
+        name: str,
+        vin: str,
+        bound: BoundPlan,
+        sources: Iterable[str],
+        state: Optional[str] = None,
+    ) -> bool:
+        """
+        Whether a new series fits in the budget, counting it if so.  A refused
+        series' `sources` are left unseen so they're retried.
+        """
+        key = (name, vin, state)
+        if self.max_series is not None and self.series >= self.max_series:
+            if key not in self.refused:
+                self.refused.add(key)
+                SERIES_DROPPED.labels("budget").inc()
+                log.debug("Series budget exhausted, not exporting %s for %s", name, vin)
+            for source in sources:
+                bound.last_seen.pop(source, None)
+            return False
+        self.refused.discard(key)
+        self.series += 1
+        return True
+
+    def execute(
+        self,
+        vehicle_state: dict[str, Any],
+        vin: str,
+        changed: Optional[set[str]] = None,
+    ) -> int:
+        """
+        Set the metrics for `vin` from `vehicle_state` and return how many were
+        set.  Steps whose fields are missing or unchanged are skipped.  When
+        `changed` is given only steps reading one of those fields are run, for
+        partial updates, and absent fields aren't treated as missing.
+        """
+        bound = self.bind(vin)
+        fresh, missing = self.fresh_sources(vehicle_state, vin, bound, changed)
+        count = self.set_gauges(vehicle_state, vin, bound, fresh, missing)
+        count += self.set_infos(vehicle_state, vin, bound, fresh, missing)
+        count += self.set_state_sets(vehicle_state, vin, bound, fresh, missing)
+        return count
+
+    def set_gauges(
+        self,
+        vehicle_state: dict[str, Any],
+        vin: str,
+        bound: BoundPlan,
+        fresh: set[str],
+        missing: set[str],
+    ) -> int:
+        count = 0
+        setters = bound.gauges
+        timers = self.gauge_timers
+        for index, step in enumerate(self.gauges):
+            if step.source not in fresh:
+                if step.source in missing:
+                    self.failed(step.name, vin, f"{step.source} is missing")
+                    if self.remove_missing:
+                        self.remove_gauge(index, bound, vin)
+                continue
+            start = perf_counter()
+            try:
+                datum = vehicle_state[step.source]
+                value = datum[step.key] if step.key is not None else step.getter(datum)
+                if step.modifier is not None:
+                    value = step.modifier(value)
+                set_value = setters[index] or self.gauge_child(index, bound, vin)
+                if set_value is not None:
+                    set_value(value)
+                    count += 1
+            except Exception as ex:  # pylint: disable=broad-except
+                self.failed(step.name, vin, ex)
+            if timers is not None:
+                timers[index].observe(perf_counter() - start)
+        return count
+
+    def gauge_child(
+        self, index: int, bound: BoundPlan, vin: str
+    ) -> Optional[Callable[[float], None]]:
+        """The setter of a new gauge series, if it fits in the budget"""
+        step = self.gauges[index]
+        if not self.admit(step.name, vin, bound, (step.source,)):
+            return None
+        set_value = bound.gauges[index] = step.gauge.labels(vin).set
+        return set_value
+
+    def set_infos(
+        self,
+        vehicle_state: dict[str, Any],
+        vin: str,
+        bound: BoundPlan,
+        fresh: set[str],
+        missing: set[str],
+    ) -> int:
+        count = 0
+        last_info = bound.last_info
+        timers = self.info_timers
+        for index, step in enumerate(self.infos):
+            if not missing.isdisjoint(step.sources):
+                self.failed(step.name, vin, "a source field is missing")
+                if self.remove_missing:
+                    self.remove_info(index, bound, vin)
+                continue
+            if fresh.isdisjoint(step.sources) or any(
+                vehicle_state.get(source) is None for source in step.sources
+            ):
+                continue
+            start = perf_counter()
+            try:
+                raw = tuple(
+                    vehicle_state[source][key] for _, source, key in step.fields
+                )
+                if last_info[index] == raw or self.set_info(
+                    step, index, bound, vin, raw
+                ):
+                    count += 1
+            except Exception as ex:  # pylint: disable=broad-except
+                self.failed(step.name, vin, ex)
+            if timers is not None:
+                timers[index].observe(perf_counter() - start)
+        return count
+
+    def set_info(
+        self, step: InfoStep, index: int, bound: BoundPlan, vin: str, raw: tuple
+    ) -> bool:
+        """Returns whether it was set, which it isn't when over the budget"""
+        child = bound.infos[index]
+        if child is None:
+            if not self.admit(step.name, vin, bound, step.sources):
+                return False
+            child = bound.infos[index] = step.info.labels(vin)
+        child.info(
+            {label: str(value) for (label, _, _), value in zip(step.fields, raw)}
+        )
+        bound.last_info[index] = raw
+        return True
+
+    def set_state_sets(
+        self,
+        vehicle_state: dict[str, Any],
+        vin: str,
+        bound: BoundPlan,
+        fresh: set[str],
+        missing: set[str],
+    ) -> int:
+        count = 0
+        for index, step in enumerate(self.state_sets):
+            current: Optional[str] = bound.last_state[index]
+            if step.source in fresh:
+                try:
+                    datum = vehicle_state[step.source]
+                    current = step.state_set.learn(datum[step.key])
+                    count += 1
+                except Exception as ex:  # pylint: disable=broad-except
+                    self.failed(step.name, vin, ex)
+                    continue
+            elif step.source in missing:
+                self.failed(step.name, vin, f"{step.source} is missing")
+                if self.remove_missing:
+                    self.remove_state_set(index, bound, vin)
+                continue
+            # Unchanged fields still get the values other vehicles taught it
+            if current is not None and (
+                current != bound.last_state[index]
+                or len(bound.state_sets[index]) != len(step.state_set.states)
+            ):
+                self.set_state_set(step, index, bound, vin, current)
+        return count
+
+    def set_state_set(
+        self, step: StateSetStep, index: int, bound: BoundPlan, vin: str, current: str
+    ) -> None:
+        children = bound.state_sets[index]
+        for state in step.state_set.states:
+            set_value = children.get(state)
+            if set_value is None:
+                if not self.admit(step.name, vin, bound, (step.source,), state):
+                    continue
+                set_value = children[state] = step.state_set.gauge.labels(
+                    vin, state
+                ).set
+            set_value(state == current)
+        bound.last_state[index] = current
+
+    def remove_gauge(self, index: int, bound: BoundPlan, vin: str) -> int:
+        """Remove a gauge's series for `vin`, returning how many were removed"""
+        if bound.gauges[index] is None:
+            return 0
+        self.gauges[index].gauge.remove(vin)
+        bound.gauges[index] = None
+        self.series -= 1
+        return 1
+
+    def remove_info(self, index: int, bound: BoundPlan, vin: str) -> int:
+        if bound.infos[index] is None:
+            return 0
+        self.infos[index].info.remove(vin)
+        bound.infos[index] = None
+        bound.last_info[index] = None
+        self.series -= 1
+        return 1
+
+    def remove_state_set(self, index: int, bound: BoundPlan, vin: str) -> int:
+        children = bound.state_sets[index]
+        for state in children:
+            self.state_sets[index].state_set.gauge.remove(vin, state)
+        removed = len(children)
+        children.clear()
+        bound.last_state[index] = None
+        self.series -= removed
+        return removed
+
+    def expire(self, now: float) -> list[str]:
+        """
+        Remove the series of fields last reported over `series_ttl` seconds
+        before `now` (monotonic).  Returns the VINs that have nothing left,
+        which are forgotten.
+        """
+        if self.series_ttl is None:
+            return []
+        forgotten = []
+        for vin, bound in list(self.bound.items()):
+            stale = {
+                source
+                for source, reported_at in bound.reported_at.items()
+                if now - reported_at > self.series_ttl
+            }
+            if stale:
+                self.expire_sources(vin, bound, stale)
+            if not bound.reported_at:
+                del self.bound[vin]
+                self.refused = {key for key in self.refused if key[1] != vin}
+                forgotten.append(vin)
+        return forgotten
+
+    def expire_sources(self, vin: str, bound: BoundPlan, stale: set[str]) -> None:
+        removed = 0
+        for index, step in enumerate(self.gauges):
+            if step.source in stale:
+                removed += self.remove_gauge(index, bound, vin)
+        for index, info_step in enumerate(self.infos):
+            if not stale.isdisjoint(info_step.sources):
+                removed += self.remove_info(index, bound, vin)
+        for index, state_set_step in enumerate(self.state_sets):
+            if state_set_step.source in stale:
+                removed += self.remove_state_set(index, bound, vin)
+        for source in stale:
+            del bound.reported_at[source]
+            # Processed afresh if it comes back, even with the same timestamp
+            bound.last_seen.pop(source, None)
+            if self.field_timestamps is not None:
+                self.field_timestamps.remove(vin, source)
+        SERIES_DROPPED.labels("expired").inc(removed)
+        log.info(f"Removed {removed} series of {vin} not reported for a while")
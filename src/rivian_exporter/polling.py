@@ -0,0 +1,76 @@
+from typing import Any, Optional
+
+from .instrumentation import POLL_INTERVAL, POLL_TIER, remove_series
+from .options import TIERS
+from .sessions import ASLEEP_POWER_STATES, CHARGING_STATES, PARKED_GEARS
+
+# Vehicle state fields the tier is picked from
+SOURCES = frozenset({"chargerState", "gearStatus", "gnssSpeed", "powerState"})
+DEFAULT_INTERVALS = {"driving": 10.0, "charging": 60.0, "asleep": 900.0}
+# Moving faster than this (kph) counts as driving whatever the gear
+DRIVING_SPEED = 1.0
+
+
+def field_value(vehicle_state: dict[str, Any], field: str) -> Any:
+    datum = vehicle_state.get(field)
+    return datum.get("value") if isinstance(datum, dict) else None
+
+
+def vehicle_tier(vehicle_state: dict[str, Any]) -> str:
+    """What the vehicle is doing, as one of TIERS"""
+    speed = field_value(vehicle_state, "gnssSpeed")
+    gear = field_value(vehicle_state, "gearStatus")
+    if gear is not None and gear not in PARKED_GEARS:
+        return "driving"
+    if isinstance(speed, (int, float)) and speed > DRIVING_SPEED:
+        return "driving"
+    if field_value(vehicle_state, "chargerState") in CHARGING_STATES:
+        return "charging"
+    if field_value(vehicle_state, "powerState") in ASLEEP_POWER_STATES:
+        return "asleep"
+    return "awake"
+
+
+class AdaptivePolling:
+    """
+    Picks how often to poll each vehicle from what its last state says it's
+    doing: often while driving, less while charging and rarely while asleep.
+    A parked car is only seen to wake up on the next poll, so the asleep
+    interval bounds how late the start of a trip is noticed.
+    """
+
+    """Vehicle state fields that must be requested"""
+    sources = SOURCES
+    """Seconds between polls for each tier"""
+    intervals: dict[str, float]
+    tiers: dict[str, str]
+
+    def __init__(
+        self, scrape_interval: float, intervals: Optional[dict[str, float]] = None
+    ) -> None:
+        self.intervals = {
+            **DEFAULT_INTERVALS,
+            "awake": scrape_interval,
+            **(intervals or {}),
+        }
+        self.tiers = {}
+
+    def update(self, vin: str, vehicle_state: dict[str, Any]) -> None:
+        tier = vehicle_tier(vehicle_state)
+        if self.tiers.get(vin) == tier:
+            return
+        self.tiers[vin] = tier
+        for name in TIERS:
+            POLL_TIER.labels(vin, name).set(name == tier)
+        POLL_INTERVAL.labels(vin).set(self.intervals[tier])
+
+    def forget(self, vin: str) -> None:
+        if self.tiers.pop(vin, None) is None:
+            return
+        for name in TIERS:
+            remove_series(POLL_TIER, vin, name)
+        remove_series(POLL_INTERVAL, vin)
+
+    def interval(self, vin: str) -> float:
+        """Seconds until `vin` should next be polled, awake until it's been seen"""
+        return self.intervals[self.tiers.get(vin, "awake")]
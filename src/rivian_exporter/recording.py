@@ -0,0 +1,85 @@
+import gzip
+import json
+import time
+from typing import Any, Callable, Iterator, NamedTuple, Optional
+
+import glog as log
+
+
+class Recorded(NamedTuple):
+    """A vehicle state response, when it was received and for which VIN"""
+
+    recorded_at: float
+    vin: str
+    response: Any
+
+
+class Recorder:
+    """
+    Appends vehicle state responses to a gzipped NDJSON recording, one
+    {"recorded_at", "vin", "response"} object per line.  Every recording
+    session adds a gzip member so an existing recording is extended, not
+    rewritten.
+    """
+
+    path: str
+    file: Optional[gzip.GzipFile]
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = None
+
+    def __enter__(self) -> "Recorder":
+        self.file = gzip.open(self.path, "ab")
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(
+        self, vin: str, response: Any, recorded_at: Optional[float] = None
+    ) -> None:
+        assert self.file is not None, "Recorder used outside of a with block"
+        entry = {
+            "recorded_at": time.time() if recorded_at is None else recorded_at,
+            "vin": vin,
+            "response": response,
+        }
+        self.file.write(json.dumps(entry, separators=(",", ":")).encode() + b"\n")
+
+    def flush(self) -> None:
+        """Make everything written so far readable even if we're killed"""
+        if self.file is not None:
+            self.file.flush()
+
+
+def read_recording(
+    path: str, decode: Callable[[bytes], Any] = json.loads
+) -> Iterator[Recorded]:
+    """
+    Yields the responses of a recording in order.  Malformed lines are skipped
+    and a recording cut short by the recorder being killed ends at the last
+    complete line.
+    """
+    with gzip.open(path, "rb") as f:
+        number = 0
+        while True:
+            try:
+                line = f.readline()
+            except EOFError:
+                log.warning(f"{path} is truncated, stopping after line {number}")
+                return
+            if not line:
+                return
+            number += 1
+            if not line.strip():
+                continue
+            try:
+                entry = decode(line)
+                yield Recorded(
+                    float(entry["recorded_at"]), str(entry["vin"]), entry["response"]
+                )
+            except (KeyError, TypeError, ValueError) as ex:
+                log.warning(f"Skipping line {number} of {path}: {ex}")
@@ -0,0 +1,303 @@
+import asyncio
+import json
+import os
+import struct
+import tempfile
+import time
+from typing import Any, Callable, Iterable, NamedTuple, Optional, Sequence
+
+import aiohttp
+import glog as log
+
+from .instrumentation import (
+    REMOTE_WRITE_DROPPED,
+    REMOTE_WRITE_FAILURES,
+    REMOTE_WRITE_QUEUE,
+    REMOTE_WRITE_SAMPLES,
+)
+from .rivian_collectors import VehicleCollector
+from .scheduler import Backoff
+
+# python-snappy's compressor when it's installed, see snappy_compress
+compress_block: Optional[Callable[[bytes], bytes]] = None
+try:
+    import snappy
+
+    compress_block = snappy.compress
+except ImportError:  # pragma: no cover
+    pass
+
+# Polls sent in one remote write request
+POLLS_PER_REQUEST = 100
+# Failed pushes are retried with exponential backoff between these (seconds)
+RETRY_MIN = 1.0
+RETRY_MAX = 300.0
+REQUEST_TIMEOUT = 30
+HEADERS = {
+    "Content-Encoding": "snappy",
+    "Content-Type": "application/x-protobuf",
+    "User-Agent": "rivian_exporter",
+    "X-Prometheus-Remote-Write-Version": "0.1.0",
+}
+
+
+class Sample(NamedTuple):
+    name: str
+    labels: dict[str, str]
+    value: float
+    """Milliseconds since the epoch"""
+    timestamp: int
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _field(number: int, payload: bytes) -> bytes:
+    """A length delimited protobuf field"""
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _label(name: str, value: str) -> bytes:
+    return _field(1, _field(1, name.encode()) + _field(2, value.encode()))
+
+
+def _sample(value: float, timestamp: int) -> bytes:
+    # value is field 1 as a fixed64 double, timestamp field 2 as a varint
+    encoded = b"\x09" + struct.pack("<d", value)
+    if timestamp:
+        encoded += b"\x10" + _varint(timestamp)
+    return _field(2, encoded)
+
+
+def encode_write_request(samples: Iterable[Sample]) -> bytes:
+    """
+    Encode a prometheus.WriteRequest by hand so protobuf isn't a dependency.
+    Samples are grouped into one TimeSeries per series, in time order.
+    """
+    series: dict[tuple[tuple[str, str], ...], list[tuple[int, float]]] = {}
+    for sample in samples:
+        labels = tuple(sorted({**sample.labels, "__name__": sample.name}.items()))
+        series.setdefault(labels, []).append((sample.timestamp, sample.value))
+    request = bytearray()
+    for labels, points in series.items():
+        encoded = b"".join(_label(name, value) for name, value in labels)
+        encoded += b"".join(_sample(value, ts) for ts, value in sorted(points))
+        request += _field(1, encoded)
+    return bytes(request)
+
+
+def snappy_literal(data: bytes) -> bytes:
+    """
+    Snappy block format made only of literals.  It doesn't compress at all but
+    every snappy decoder accepts it, so remote write works without the
+    python-snappy extension.
+    """
+    out = bytearray(_varint(len(data)))
+    for start in range(0, len(data), 65536):
+        chunk = data[start : start + 65536]
+        length = len(chunk) - 1
+        if length < 60:
+            out.append(length << 2)
+        elif length < 256:
+            out += bytes((60 << 2, length))
+        else:
+            out += bytes((61 << 2,)) + struct.pack("<H", length)
+        out += chunk
+    return bytes(out)
+
+
+def snappy_compress(data: bytes) -> bytes:
+    if compress_block is not None:
+        return bytes(compress_block(data))
+    return snappy_literal(data)
+
+
+def collect_samples(
+    collectors: Iterable[VehicleCollector],
+    vin: str,
+    vehicle_state: dict[str, Any],
+) -> list[Sample]:
+    """
+    The samples of every collector for one vehicle, stamped with the time the
+    vehicle reported them
+    """
+    samples = []
+    now = int(time.time() * 1000)
+    for collector in collectors:
+        for sample in collector.family({vin: vehicle_state}, timestamps=True).samples:
+            timestamp = now
+            if sample.timestamp is not None:
+                timestamp = int(float(sample.timestamp) * 1000)
+            samples.append(Sample(sample.name, sample.labels, sample.value, timestamp))
+    return samples
+
+
+class SampleQueue:
+    """
+    Polls waiting to be pushed, one file per poll in `directory` so they
+    survive restarts.  Holds at most `max_polls`, dropping the oldest when
+    full.
+    """
+
+    directory: str
+    max_polls: int
+    files: list[str]
+    sequence: int
+
+    def __init__(self, directory: str, max_polls: int) -> None:
+        self.directory = directory
+        self.max_polls = max_polls
+        os.makedirs(directory, exist_ok=True)
+        self.files = sorted(
+            f for f in os.listdir(directory) if f.endswith(".json") and f[:-5].isdigit()
+        )
+        self.sequence = int(self.files[-1][:-5]) + 1 if self.files else 0
+        self.trim()
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def put(self, samples: Sequence[Sample]) -> None:
+        name = f"{self.sequence:016}.json"
+        self.sequence += 1
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".poll-")
+        with os.fdopen(fd, "w") as f:
+            json.dump([list(sample) for sample in samples], f, separators=(",", ":"))
+        os.replace(temp_path, self.path(name))
+        self.files.append(name)
+        self.trim()
+
+    def trim(self) -> None:
+        while len(self.files) > self.max_polls:
+            dropped = self.read(self.files[0])
+            REMOTE_WRITE_DROPPED.labels("queue_full").inc(len(dropped))
+            self.remove([self.files[0]])
+        REMOTE_WRITE_QUEUE.set(len(self.files))
+
+    def read(self, name: str) -> list[Sample]:
+        try:
+            with open(self.path(name)) as f:
+                return [Sample(*sample) for sample in json.load(f)]
+        except (OSError, TypeError, ValueError) as ex:
+            log.warning(f"Discarding unreadable queued poll {name}: {ex}")
+            return []
+
+    def peek(self, limit: int) -> tuple[list[str], list[Sample]]:
+        """The oldest `limit` polls and their samples"""
+        names = self.files[:limit]
+        samples = [sample for name in names for sample in self.read(name)]
+        return names, samples
+
+    def remove(self, names: list[str]) -> None:
+        for name in names:
+            try:
+                os.unlink(self.path(name))
+            except FileNotFoundError:
+                pass
+        removed = set(names)
+        self.files = [name for name in self.files if name not in removed]
+        REMOTE_WRITE_QUEUE.set(len(self.files))
+
+
+class RemoteWriter:
+    """
+    Pushes every poll to a Prometheus remote write endpoint so gaps in scraping
+    can be backfilled with the vehicle-reported timestamps.  Polls are queued
+    on disk and sent in batches, retrying with backoff while the endpoint is
+    unavailable.  Only samples newer than the last one queued for their series
+    are pushed, as remote write rejects out of order samples.
+    """
+
+    url: str
+    """Not copied, so reloaded metric definitions are picked up"""
+    collectors: Sequence[VehicleCollector]
+    queue: SampleQueue
+    """Newest timestamp queued for each series"""
+    newest: dict[tuple[str, tuple[tuple[str, str], ...]], int]
+    ready: asyncio.Event
+    backoff: Backoff
+
+    def __init__(
+        self,
+        url: str,
+        collectors: Sequence[VehicleCollector],
+        queue: SampleQueue,
+        retry_min: float = RETRY_MIN,
+        retry_max: float = RETRY_MAX,
+    ) -> None:
+        self.url = url
+        self.collectors = collectors
+        self.queue = queue
+        self.newest = {}
+        self.ready = asyncio.Event()
+        self.backoff = Backoff(retry_min, retry_max)
+
+    def observe(self, vin: str, vehicle_state: dict[str, Any]) -> None:
+        """Queue the new samples of a vehicle whose state was just updated"""
+        samples = []
+        for sample in collect_samples(self.collectors, vin, vehicle_state):
+            series = (sample.name, tuple(sorted(sample.labels.items())))
+            if sample.timestamp <= self.newest.get(series, -1):
+                continue
+            self.newest[series] = sample.timestamp
+            samples.append(sample)
+        if samples:
+            self.queue.put(samples)
+            self.ready.set()
+
+    def forget(self, vin: str) -> None:
+        """Drop the newest timestamps of a vehicle that's been forgotten"""
+        self.newest = {
+            series: timestamp
+            for series, timestamp in self.newest.items()
+            if ("vin", vin) not in series[1]
+        }
+
+    async def push(self, session: aiohttp.ClientSession, samples: list[Sample]) -> bool:
+        """
+        Returns True once the samples have been dealt with, either accepted or
+        rejected for good, and False if they should be retried
+        """
+        body = snappy_compress(encode_write_request(samples))
+        try:
+            async with session.post(self.url, data=body, headers=HEADERS) as response:
+                if response.status < 300:
+                    REMOTE_WRITE_SAMPLES.inc(len(samples))
+                    return True
+                REMOTE_WRITE_FAILURES.labels(str(response.status)).inc()
+                text = await response.text()
+                if response.status == 429 or response.status >= 500:
+                    log.warning(f"Remote write failed, retrying: {text}")
+                    return False
+                # Resending a request the endpoint doesn't like won't help
+                log.error(f"Remote write rejected {len(samples)} samples: {text}")
+                REMOTE_WRITE_DROPPED.labels("rejected").inc(len(samples))
+                return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            REMOTE_WRITE_FAILURES.labels(type(ex).__name__).inc()
+            log.warning(f"Remote write failed, retrying: {ex}")
+            return False
+
+    async def run(self) -> None:
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                if not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                names, samples = self.queue.peek(POLLS_PER_REQUEST)
+                if samples and not await self.push(session, samples):
+                    await asyncio.sleep(self.backoff.next_delay())
+                    continue
+                self.backoff.reset()
+                self.queue.remove(names)
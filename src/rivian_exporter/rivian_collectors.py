@@ -1,7 +1,90 @@
-from typing import Any, Callable, Tuple
+import operator
+import time
+from datetime import datetime
+from typing import Any, Callable, Iterable, Optional, Tuple, Union
 
 import glog as log
 import prometheus_client as prom
+from prometheus_client.core import GaugeMetricFamily, InfoMetricFamily
+
+# Every series is labelled with the VIN it came from so that a single exporter
+# can serve a whole fleet
+LABELS = ["vin"]
+FIELD_TIMESTAMP_HELP = "When the vehicle reported the field"
+FIELD_AGE_HELP = "Seconds since the vehicle reported the field"
+# Most values a state set learns, including OTHER_STATE for any beyond that
+MAX_STATES = 32
+OTHER_STATE = "other"
+
+
+def parse_timestamp(timestamp: str) -> float:
+    """Rivian timestamps look like 2023-09-30T04:35:27.825Z"""
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+def sample_timestamp(vehicle_state: dict[str, Any], sources: Tuple[str, ...]) -> float:
+    """The newest vehicle-reported timestamp of the given fields"""
+    return max(
+        parse_timestamp(vehicle_state[source]["timeStamp"]) for source in sources
+    )
+
+
+class FieldTimestamps:
+    """
+    Exports when the vehicle last reported each field, and how old that report
+    is, so stale telemetry from a parked car can be told apart from fresh data
+    """
+
+    timestamp: prom.Gauge
+    age: prom.Gauge
+
+    def __init__(self) -> None:
+        labels = LABELS + ["field"]
+        self.timestamp = prom.Gauge(
+            "rivian_field_timestamp_seconds", FIELD_TIMESTAMP_HELP, labels
+        )
+        self.age = prom.Gauge("rivian_field_age_seconds", FIELD_AGE_HELP, labels)
+
+    def observe(self, vin: str, field: str, timestamp: str) -> None:
+        reported = parse_timestamp(timestamp)
+        self.timestamp.labels(vin, field).set(reported)
+        # Evaluated at scrape time so the age keeps growing between polls
+        self.age.labels(vin, field).set_function(lambda: time.time() - reported)
+
+    def remove(self, vin: str, field: str) -> None:
+        for gauge in (self.timestamp, self.age):
+            try:
+                gauge.remove(vin, field)
+            except KeyError:
+                # Never observed, e.g. the field had no timeStamp
+                pass
+
+
+def field_timestamp_families(
+    states: dict[str, dict[str, Any]], fields: Iterable[str], now: float
+) -> tuple[GaugeMetricFamily, GaugeMetricFamily]:
+    """
+    The families FieldTimestamps exports, rendered from `states` (keyed by
+    VIN) for the given `fields` as of `now`, for on-demand collection
+    """
+    labels = LABELS + ["field"]
+    timestamp = GaugeMetricFamily(
+        "rivian_field_timestamp_seconds", FIELD_TIMESTAMP_HELP, labels=labels
+    )
+    age = GaugeMetricFamily("rivian_field_age_seconds", FIELD_AGE_HELP, labels=labels)
+    for vin, vehicle_state in states.items():
+        for field in sorted(fields):
+            datum = vehicle_state.get(field)
+            if not isinstance(datum, dict) or datum.get("timeStamp") is None:
+                continue
+            try:
+                reported = parse_timestamp(datum["timeStamp"])
+            except (TypeError, ValueError):
+                log.debug(f"Bad timeStamp for {field} of {vin}")
+                continue
+            timestamp.add_metric([vin, field], reported)
+            age.add_metric([vin, field], now - reported)
+    return timestamp, age
 
 
 class RivianInfo:
@@ -12,17 +95,38 @@ class RivianInfo:
 
     info: prom.Info
     prometheus_label: str
+    prometheus_description: str
     data: dict[str, Tuple[str, str]]
+    """
+    Whether the values rarely change, e.g. software versions.  Only these are
+    kept as infos when the others are exported as state sets.
+    """
+    static: bool
 
     def __init__(
         self,
         prometheus_label: str,
         prometheus_description: str,
         data: dict[str, Tuple[str, str]],
+        registry: Optional[prom.CollectorRegistry] = prom.REGISTRY,
+        static: bool = False,
     ) -> None:
-        self.info = prom.Info(prometheus_label, prometheus_description)
+        self.info = prom.Info(
+            prometheus_label, prometheus_description, LABELS, registry=registry
+        )
         self.prometheus_label = prometheus_label
+        self.prometheus_description = prometheus_description
         self.data = data
+        self.static = static
+
+    @property
+    def metric(self) -> prom.Info:
+        return self.info
+
+    @property
+    def sources(self) -> Tuple[str, ...]:
+        """The vehicle state fields this info is built from"""
+        return tuple(state_key for state_key, _ in self.data.values())
 
     def values(self, state: dict[str, Any]) -> dict[str, str]:
         return {
@@ -30,14 +134,40 @@ class RivianInfo:
             for key, (state_key, state_value) in self.data.items()
         }
 
-    def process(self, vehicle_state: dict[str, Any]) -> None:
-        self.info.info(self.values(vehicle_state))
+    def process(self, vehicle_state: dict[str, Any], vin: str) -> None:
+        self.info.labels(vin).info(self.values(vehicle_state))
+
+    def family(
+        self, states: dict[str, dict[str, Any]], timestamps: bool = False
+    ) -> InfoMetricFamily:
+        """
+        Render the info for every vehicle in `states` (keyed by VIN) without
+        going through the global prom.Info.  With `timestamps` each sample
+        carries the newest vehicle-reported timestamp of its fields.
+        """
+        family = InfoMetricFamily(
+            self.prometheus_label, self.prometheus_description, labels=LABELS
+        )
+        for vin, vehicle_state in states.items():
+            try:
+                values = self.values(vehicle_state)
+                timestamp = (
+                    sample_timestamp(vehicle_state, self.sources)
+                    if timestamps
+                    else None
+                )
+                family.add_metric([vin], values, timestamp)
+            except (KeyError, TypeError, ValueError):
+                log.debug(f"{self.prometheus_label} not available for {vin}")
+        return family
 
 
 def info(
     prometheus_label: str,
     prometheus_description: str,
     data: dict[str, str],
+    registry: Optional[prom.CollectorRegistry] = prom.REGISTRY,
+    static: bool = False,
 ) -> RivianInfo:
     """
     Short hand to create a RivianInfo object
@@ -45,7 +175,13 @@ def info(
     """
     info_data = {key: (value, "value") for key, value in data.items()}
 
-    return RivianInfo(prometheus_label, prometheus_description, info_data)
+    return RivianInfo(
+        prometheus_label, prometheus_description, info_data, registry, static
+    )
+
+
+def identity(value: Any) -> Any:
+    return value
 
 
 class RivianGauge:
@@ -55,13 +191,19 @@ class RivianGauge:
     """
 
     prometheus_label: str
+    prometheus_description: str
     rivian_label: str
-    getter: Callable[[dict[str, Any]], float] = lambda v: v["value"]
+    """
+    The sub-key of the vehicle state field holding the value.  None when a
+    custom getter is used instead
+    """
+    key: Optional[str]
+    getter: Callable[[dict[str, Any]], float]
     """
     This modifies the Rivian API value. e.g. Battery level is a percentage in
     Rivian but Prometheus wants a ratio from 0-1 so we need to divide it by 100
     """
-    modifier: Callable[[float], float] = lambda x: x
+    modifier: Callable[[float], float]
     gauge: prom.Gauge
 
     def __init__(
@@ -69,24 +211,63 @@ class RivianGauge:
         prometheus_label: str,
         prometheus_description: str,
         rivian_label: str,
-        getter: Callable[[dict[str, Any]], Any] = lambda v: v["value"],
-        modifier: Callable[[Any], Any] = lambda x: x,
+        getter: Optional[Callable[[dict[str, Any]], Any]] = None,
+        modifier: Callable[[Any], Any] = identity,
+        key: str = "value",
+        registry: Optional[prom.CollectorRegistry] = prom.REGISTRY,
     ) -> None:
         self.prometheus_label = prometheus_label
+        self.prometheus_description = prometheus_description
         self.rivian_label = rivian_label
-        self.getter = getter
+        self.key = key if getter is None else None
+        self.getter = getter or operator.itemgetter(key)
         self.modifier = modifier
-        self.gauge = prom.Gauge(prometheus_label, prometheus_description)
+        self.gauge = prom.Gauge(
+            prometheus_label, prometheus_description, LABELS, registry=registry
+        )
+
+    @property
+    def metric(self) -> prom.Gauge:
+        return self.gauge
+
+    @property
+    def sources(self) -> Tuple[str, ...]:
+        """The vehicle state fields this gauge is built from"""
+        return (self.rivian_label,)
 
     def value(self, vehicle_state: dict[str, Any]) -> float:
         datum = vehicle_state[self.rivian_label]
         value = self.getter(datum)
         return self.modifier(value)
 
-    def process(self, vehicle_state: dict[str, Any]) -> None:
+    def process(self, vehicle_state: dict[str, Any], vin: str) -> None:
         value = self.value(vehicle_state)
-        log.debug(f"Setting {self.prometheus_label} to {value}")
-        self.gauge.set(self.value(vehicle_state))
+        log.debug("Setting %s{vin=%s} to %s", self.prometheus_label, vin, value)
+        self.gauge.labels(vin).set(value)
+
+    def family(
+        self, states: dict[str, dict[str, Any]], timestamps: bool = False
+    ) -> GaugeMetricFamily:
+        """
+        Render the gauge for every vehicle in `states` (keyed by VIN) without
+        going through the global prom.Gauge.  With `timestamps` each sample
+        carries the vehicle-reported timestamp of its field.
+        """
+        family = GaugeMetricFamily(
+            self.prometheus_label, self.prometheus_description, labels=LABELS
+        )
+        for vin, vehicle_state in states.items():
+            try:
+                value = self.value(vehicle_state)
+                timestamp = (
+                    sample_timestamp(vehicle_state, self.sources)
+                    if timestamps
+                    else None
+                )
+                family.add_metric([vin], value, timestamp)
+            except (KeyError, TypeError, ValueError):
+                log.debug(f"{self.prometheus_label} not available for {vin}")
+        return family
 
 
 def gauge(
@@ -94,13 +275,150 @@ def gauge(
     prometheus_description: str,
     rivian_label: str,
     *,
-    getter: Callable[[dict[str, Any]], float] = lambda v: v["value"],
-    modifier: Callable[[float], float] = lambda x: x,
+    key: str = "value",
+    getter: Optional[Callable[[dict[str, Any]], float]] = None,
+    modifier: Callable[[float], float] = identity,
+    registry: Optional[prom.CollectorRegistry] = prom.REGISTRY,
 ) -> RivianGauge:
+    """
+    Short hand to create a RivianGauge object.  Prefer `key` over `getter` for
+    picking a sub-key out of the vehicle state field as it can be compiled into
+    an ExtractionPlan
+    """
     return RivianGauge(
         prometheus_label,
         prometheus_description,
         rivian_label,
         getter=getter,
         modifier=modifier,
+        key=key,
+        registry=registry,
     )
+
+
+class RivianStateSet:
+    """
+    Exports one vehicle state field as a state set: a series per value, set to
+    1 for the current value and 0 for the others.  Unlike an info label, a
+    change of value doesn't start a new series.  Values are learned as they're
+    seen, shared by every vehicle, and once `max_states` have been learned
+    any others are exported as OTHER_STATE.
+    """
+
+    prometheus_label: str
+    prometheus_description: str
+    rivian_label: str
+    key: str
+    max_states: int
+    """Values learned so far, in the order they were first seen"""
+    states: list[str]
+    gauge: prom.Gauge
+
+    def __init__(
+        self,
+        prometheus_label: str,
+        prometheus_description: str,
+        rivian_label: str,
+        key: str = "value",
+        max_states: int = MAX_STATES,
+        registry: Optional[prom.CollectorRegistry] = prom.REGISTRY,
+    ) -> None:
+        self.prometheus_label = prometheus_label
+        self.prometheus_description = prometheus_description
+        self.rivian_label = rivian_label
+        self.key = key
+        self.max_states = max_states
+        self.states = []
+        # Like prom.Enum the state label is named after the metric
+        self.gauge = prom.Gauge(
+            prometheus_label,
+            prometheus_description,
+            LABELS + [prometheus_label],
+            registry=registry,
+        )
+
+    @property
+    def metric(self) -> prom.Gauge:
+        return self.gauge
+
+    @property
+    def sources(self) -> Tuple[str, ...]:
+        return (self.rivian_label,)
+
+    def learn(self, value: Any) -> str:
+        """The state `value` is exported as, learning it if there's room"""
+        state = str(value)
+        if state in self.states:
+            return state
+        if len(self.states) < self.max_states - 1:
+            self.states.append(state)
+            return state
+        if OTHER_STATE not in self.states:
+            log.warning(
+                f"{self.prometheus_label} has over {self.max_states - 1} values, "
+                f"exporting new ones as {OTHER_STATE}"
+            )
+            self.states.append(OTHER_STATE)
+        return OTHER_STATE
+
+    def value(self, vehicle_state: dict[str, Any]) -> str:
+        return self.learn(vehicle_state[self.rivian_label][self.key])
+
+    def process(self, vehicle_state: dict[str, Any], vin: str) -> None:
+        current = self.value(vehicle_state)
+        for state in self.states:
+            self.gauge.labels(vin, state).set(state == current)
+
+    def family(
+        self, states: dict[str, dict[str, Any]], timestamps: bool = False
+    ) -> GaugeMetricFamily:
+        """
+        Render the state set for every vehicle in `states` (keyed by VIN)
+        without going through the global prom.Gauge.  With `timestamps` each
+        sample carries the vehicle-reported timestamp of its field.
+        """
+        family = GaugeMetricFamily(
+            self.prometheus_label,
+            self.prometheus_description,
+            labels=LABELS + [self.prometheus_label],
+        )
+        for vin, vehicle_state in states.items():
+            try:
+                current = self.value(vehicle_state)
+                timestamp = (
+                    sample_timestamp(vehicle_state, self.sources)
+                    if timestamps
+                    else None
+                )
+            except (KeyError, TypeError, ValueError):
+                log.debug(f"{self.prometheus_label} not available for {vin}")
+                continue
+            for state in self.states:
+                family.add_metric([vin, state], state == current, timestamp)
+        return family
+
+
+VehicleCollector = Union[RivianGauge, RivianInfo, RivianStateSet]
+
+
+def as_state_sets(collectors: Iterable[VehicleCollector]) -> list[VehicleCollector]:
+    """
+    Replace every info that isn't static with a state set per label, named
+    {info}_{label}.  The state sets aren't registered.
+    """
+    converted: list[VehicleCollector] = []
+    for collector in collectors:
+        if not isinstance(collector, RivianInfo) or collector.static:
+            converted.append(collector)
+            continue
+        for label, (source, key) in collector.data.items():
+            converted.append(
+                RivianStateSet(
+                    f"{collector.prometheus_label}_{label}",
+                    f"{collector.prometheus_description}: {label}",
+                    source,
+                    key,
+                    registry=None,
+                )
+            )
+    return converted
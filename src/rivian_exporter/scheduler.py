@@ -0,0 +1,153 @@
+import asyncio
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Optional
+
+# Keys the API may use to say how long to wait before retrying
+RETRY_AFTER_KEYS = ("retryAfter", "retry_after", "retry-after", "Retry-After")
+
+
+class FixedRateTicker:
+    """
+    Ticks every `interval` seconds measured from when the ticker started rather
+    than from when the last piece of work finished, so the period doesn't drift
+    by however long the work took.  Ticks missed because the work overran are
+    skipped rather than fired back to back.
+    """
+
+    interval: float
+    next_tick: Optional[float]
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.next_tick = None
+
+    def reset(self) -> None:
+        """
+        Start counting from now.  Call this before the first piece of work, and
+        again after sleeping off an error.
+        """
+        self.next_tick = asyncio.get_running_loop().time()
+
+    async def wait(self) -> None:
+        now = asyncio.get_running_loop().time()
+        if self.next_tick is None:
+            self.next_tick = now
+        self.next_tick += self.interval
+        if self.interval > 0 and self.next_tick < now:
+            missed = (now - self.next_tick) // self.interval + 1
+            self.next_tick += missed * self.interval
+        await asyncio.sleep(self.next_tick - now)
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter: the nth consecutive failure waits between
+    half and all of min(cap, base * 2**n) seconds
+    """
+
+    base: float
+    cap: float
+    attempt: int
+
+    def __init__(self, base: float, cap: float) -> None:
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def reset(self) -> None:
+        self.attempt = 0
+
+    def next_delay(self) -> float:
+        delay = min(self.cap, self.base * 2.0**self.attempt)
+        self.attempt += 1
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _retry_after_value(value: Any) -> Optional[float]:
+    if isinstance(value, (int, float)):
+        return max(float(value), 0)
+    if isinstance(value, str):
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max((when - datetime.now(timezone.utc)).total_seconds(), 0)
+    return None
+
+
+def _find_retry_after(value: Any) -> Optional[float]:
+    if isinstance(value, dict):
+        for key in RETRY_AFTER_KEYS:
+            if key in value:
+                found = _retry_after_value(value[key])
+                if found is not None:
+                    return found
+        children = list(value.values())
+    elif isinstance(value, (list, tuple)):
+        children = list(value)
+    else:
+        return None
+    for child in children:
+        found = _find_retry_after(child)
+        if found is not None:
+            return found
+    return None
+
+
+def retry_after(err: BaseException) -> Optional[float]:
+    """
+    The number of seconds the server asked us to wait, if it said.  The rivian
+    client raises with (status, response json) as the exception args, so look
+    for a retry hint anywhere in those, e.g. in the GraphQL error extensions.
+    """
+    return _find_retry_after(err.args)
+
+
+class TokenBucket:
+    """
+    A request budget shared by everything using one Rivian account.  Holds up
+    to `capacity` requests and refills at `rate` requests per second.  `pause`
+    stops all requests, e.g. when the account is being rate limited.
+    """
+
+    rate: float
+    capacity: float
+    tokens: float
+    updated: Optional[float]
+    paused_until: float
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = None
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        until = asyncio.get_running_loop().time() + seconds
+        self.paused_until = max(self.paused_until, until)
+
+    async def acquire(self) -> None:
+        # Holding the lock while sleeping makes waiters queue up in order
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self.updated is not None:
+                    refill = (now - self.updated) * self.rate
+                    self.tokens = min(self.capacity, self.tokens + refill)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                await asyncio.sleep(wait)
@@ -0,0 +1,117 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+import glog as log
+
+# The Rivian client keyword arguments that make up a session
+SESSION_TOKENS = (
+    "access_token",
+    "refresh_token",
+    "user_session_token",
+    "csrf_token",
+    "app_session_token",
+)
+# How long a cached session is reused before a new CSRF token is created anyway
+DEFAULT_MAX_AGE = 6 * 60 * 60
+
+
+def fingerprint(tokens: dict[str, str]) -> str:
+    """
+    Identifies the credentials a session was created from without storing them
+    a second time, so logging in again invalidates the cache
+    """
+    joined = "\0".join(tokens.get(name, "") for name in SESSION_TOKENS)
+    return hashlib.sha256(joined.encode()).hexdigest()
+
+
+class SessionCache:
+    """
+    Keeps the Rivian session tokens on disk so restarts and CLI commands can
+    skip the CSRF handshake.  The file is only readable by its owner, every
+    access holds an exclusive lock on `{path}.lock` and writes replace the file
+    atomically, so concurrent exporters never see a half written session.
+    """
+
+    path: str
+    max_age: float
+
+    def __init__(self, path: str, max_age: float = DEFAULT_MAX_AGE) -> None:
+        self.path = path
+        self.max_age = max_age
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), 0o700, exist_ok=True)
+        fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+
+    def read(self) -> Optional[dict[str, Any]]:
+        try:
+            with open(self.path) as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as ex:
+            log.warning(f"Ignoring unreadable session cache {self.path}: {ex}")
+            return None
+        return entry if isinstance(entry, dict) else None
+
+    def load(self, credentials: str) -> Optional[dict[str, str]]:
+        """
+        The cached session tokens if they were created from `credentials` and
+        are younger than `max_age`
+        """
+        with self.locked():
+            entry = self.read()
+        if entry is None or entry.get("credentials") != credentials:
+            return None
+        saved_at = entry.get("saved_at")
+        if not isinstance(saved_at, (int, float)):
+            return None
+        if time.time() - saved_at > self.max_age:
+            log.info("Cached Rivian session has expired")
+            return None
+        return {
+            name: entry[name]
+            for name in SESSION_TOKENS
+            if isinstance(entry.get(name), str) and entry[name]
+        }
+
+    def save(self, credentials: str, tokens: dict[str, str]) -> None:
+        entry = {
+            **{name: tokens[name] for name in SESSION_TOKENS if name in tokens},
+            "credentials": credentials,
+            "saved_at": time.time(),
+        }
+        with self.locked():
+            # mkstemp creates the file with mode 0600
+            fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path)), prefix=".session-"
+            )
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(entry, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+    def clear(self) -> None:
+        with self.locked():
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,222 @@
+from typing import Any, NamedTuple, Optional
+
+import prometheus_client as prom
+
+from .derived import Reading, read_energy, read_mileage
+from .instrumentation import remove_series
+from .rivian_collectors import LABELS, parse_timestamp
+
+# Vehicle state fields sessions are detected from
+SOURCES = frozenset(
+    {
+        "batteryCapacity",
+        "batteryLevel",
+        "chargerState",
+        "gearStatus",
+        "powerState",
+        "vehicleMileage",
+    }
+)
+# chargerState while energy is flowing into the battery
+CHARGING_STATES = frozenset({"charging_active"})
+# A trip lasts while the vehicle is out of these gears and power states
+PARKED_GEARS = frozenset({"park"})
+ASLEEP_POWER_STATES = frozenset({"sleep", "standby"})
+
+# Charging takes from minutes on a DC charger to a day on a wall socket
+DURATION_BUCKETS = (300, 900, 1800, 3600, 7200, 14400, 28800, 57600, 86400)
+ENERGY_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 135)
+DISTANCE_BUCKETS = (1000, 5000, 10000, 25000, 50000, 100000, 200000, 400000)
+SPEED_BUCKETS = (10, 20, 30, 40, 50, 60, 80, 100, 120)
+
+
+class Reported(NamedTuple):
+    """A state field's value and when the vehicle reported it"""
+
+    value: str
+    timestamp: float
+
+
+def reported(vehicle_state: dict[str, Any], field: str) -> Optional[Reported]:
+    try:
+        value = vehicle_state[field]
+        return Reported(value["value"], parse_timestamp(value["timeStamp"]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class Session:
+    """A charging session or trip in progress"""
+
+    started_at: float
+    """Battery energy or odometer reading at the start"""
+    start: Optional[Reading]
+
+    def __init__(self, started_at: float, start: Optional[Reading]) -> None:
+        self.started_at = started_at
+        self.start = start
+
+
+class VehicleSessions:
+    """What's kept between polls for one vehicle"""
+
+    """Whether the vehicle was charging or driving when last seen, None at first"""
+    charging: Optional[bool]
+    driving: Optional[bool]
+    charge: Optional[Session]
+    trip: Optional[Session]
+
+    def __init__(self) -> None:
+        self.charging = None
+        self.driving = None
+        self.charge = None
+        self.trip = None
+
+
+class SessionTracker:
+    """
+    Detects charging sessions and trips from the changes between consecutive
+    vehicle states, timed with the timestamps the vehicle reported.  Charging
+    lasts while chargerState is charging_active, and a trip while the vehicle
+    is out of park and awake.  Sessions already under way when the exporter
+    starts are skipped as their start wasn't seen.
+
+    Completed sessions are counted per vehicle and summarised in fleet wide
+    histograms, which keeps the number of series down for big fleets.
+    """
+
+    """Vehicle state fields that must be requested"""
+    sources = SOURCES
+    vehicles: dict[str, VehicleSessions]
+    active: prom.Gauge
+    charging_sessions: prom.Counter
+    charging_duration: prom.Histogram
+    charging_energy: prom.Histogram
+    trips: prom.Counter
+    trip_distance: prom.Histogram
+    trip_duration: prom.Histogram
+    trip_speed: prom.Histogram
+
+    def __init__(
+        self, registry: Optional[prom.CollectorRegistry] = prom.REGISTRY
+    ) -> None:
+        self.vehicles = {}
+        self.active = prom.Gauge(
+            "rivian_session_active",
+            "Whether the vehicle is charging or on a trip",
+            LABELS + ["session"],
+            registry=registry,
+        )
+        self.charging_sessions = prom.Counter(
+            "rivian_charging_sessions",
+            "Completed charging sessions",
+            LABELS,
+            registry=registry,
+        )
+        self.charging_duration = prom.Histogram(
+            "rivian_charging_session_duration_seconds",
+            "How long completed charging sessions took",
+            buckets=DURATION_BUCKETS,
+            registry=registry,
+        )
+        self.charging_energy = prom.Histogram(
+            "rivian_charging_session_energy_kwh",
+            "Energy added by completed charging sessions",
+            buckets=ENERGY_BUCKETS,
+            registry=registry,
+        )
+        self.trips = prom.Counter(
+            "rivian_trips",
+            "Completed trips",
+            LABELS,
+            registry=registry,
+        )
+        self.trip_distance = prom.Histogram(
+            "rivian_trip_distance_meters",
+            "Distance of completed trips",
+            buckets=DISTANCE_BUCKETS,
+            registry=registry,
+        )
+        self.trip_duration = prom.Histogram(
+            "rivian_trip_duration_seconds",
+            "How long completed trips took",
+            buckets=DURATION_BUCKETS,
+            registry=registry,
+        )
+        self.trip_speed = prom.Histogram(
+            "rivian_trip_average_speed_kph",
+            "Average speed of completed trips",
+            buckets=SPEED_BUCKETS,
+            registry=registry,
+        )
+
+    def update(self, vin: str, vehicle_state: dict[str, Any]) -> None:
+        vehicle = self.vehicles.get(vin)
+        if vehicle is None:
+            vehicle = self.vehicles[vin] = VehicleSessions()
+        self.update_charging(vin, vehicle, vehicle_state)
+        self.update_trip(vin, vehicle, vehicle_state)
+
+    def forget(self, vin: str) -> None:
+        self.vehicles.pop(vin, None)
+        for session in ("charging", "trip"):
+            remove_series(self.active, vin, session)
+        remove_series(self.charging_sessions, vin)
+        remove_series(self.trips, vin)
+
+    def update_charging(
+        self, vin: str, vehicle: VehicleSessions, vehicle_state: dict[str, Any]
+    ) -> None:
+        state = reported(vehicle_state, "chargerState")
+        if state is None:
+            return
+        charging = state.value in CHARGING_STATES
+        if charging == vehicle.charging:
+            return
+        first = vehicle.charging is None
+        vehicle.charging = charging
+        self.active.labels(vin, "charging").set(charging)
+        if charging and not first:
+            vehicle.charge = Session(state.timestamp, read_energy(vehicle_state))
+            return
+        session, vehicle.charge = vehicle.charge, None
+        if session is None:
+            return
+        self.charging_sessions.labels(vin).inc()
+        self.charging_duration.observe(max(state.timestamp - session.started_at, 0))
+        energy = read_energy(vehicle_state)
+        if session.start is not None and energy is not None:
+            self.charging_energy.observe(max(energy.value - session.start.value, 0))
+
+    def update_trip(
+        self, vin: str, vehicle: VehicleSessions, vehicle_state: dict[str, Any]
+    ) -> None:
+        gear = reported(vehicle_state, "gearStatus")
+        power = reported(vehicle_state, "powerState")
+        if gear is None or power is None:
+            return
+        driving = (
+            gear.value not in PARKED_GEARS and power.value not in ASLEEP_POWER_STATES
+        )
+        if driving == vehicle.driving:
+            return
+        first = vehicle.driving is None
+        vehicle.driving = driving
+        self.active.labels(vin, "trip").set(driving)
+        changed_at = max(gear.timestamp, power.timestamp)
+        if driving and not first:
+            vehicle.trip = Session(changed_at, read_mileage(vehicle_state))
+            return
+        session, vehicle.trip = vehicle.trip, None
+        mileage = read_mileage(vehicle_state)
+        if session is None or session.start is None or mileage is None:
+            return
+        distance = mileage.value - session.start.value
+        if distance <= 0:
+            # Shifting out of park and back without going anywhere
+            return
+        duration = max(changed_at - session.started_at, 1)
+        self.trips.labels(vin).inc()
+        self.trip_distance.observe(distance)
+        self.trip_duration.observe(duration)
+        self.trip_speed.observe(distance / 1000 / (duration / 3600))
@@ -0,0 +1,134 @@
+import hashlib
+import json
+from time import time
+from typing import Any, NamedTuple, Optional
+
+from aiohttp import web
+
+# Documents kept rendered.  Each set of fields asked for is kept separately,
+# so this stops clients asking for many different ones from using up memory.
+MAX_RENDERED = 256
+
+
+class Rendered(NamedTuple):
+    """A JSON document and the validators conditional requests are checked against"""
+
+    """The state version it was rendered from"""
+    version: int
+    etag: str
+    """When the document last changed, not just when it was last rendered"""
+    modified: float
+    body: bytes
+
+
+def filter_fields(
+    state: dict[str, Any], fields: Optional[tuple[str, ...]]
+) -> dict[str, Any]:
+    if fields is None:
+        return state
+    return {field: state[field] for field in fields if field in state}
+
+
+class StateApi:
+    """
+    Serves the vehicle state the exporter last fetched as JSON so other
+    consumers can share its polls rather than each calling the Rivian API:
+    /api/vehicles lists the VINs, /api/vehicles/state has every vehicle's
+    state keyed by VIN and /api/vehicles/{vin}/state one vehicle's.
+    `?fields=batteryLevel,gnssLocation` returns only those fields.
+
+    Responses carry an ETag and Last-Modified, so a poll for a state that
+    hasn't changed since gets a 304.  Documents are rendered at most once per
+    update for each set of fields and only count as modified when their
+    content changes, however often the vehicle was polled.
+    """
+
+    states: dict[str, dict[str, Any]]
+    """Bumped whenever that vehicle's state is updated"""
+    versions: dict[str, int]
+    """Bumped whenever any vehicle's state is updated"""
+    generation: int
+    """Keyed by VIN, None for every vehicle, and the fields asked for"""
+    rendered: dict[tuple[Optional[str], Optional[tuple[str, ...]]], Rendered]
+
+    def __init__(self, states: dict[str, dict[str, Any]]) -> None:
+        self.states = states
+        self.versions = {}
+        self.generation = 0
+        self.rendered = {}
+
+    def invalidate(self, vin: str) -> None:
+        """Called whenever the state of `vin` has been updated or forgotten"""
+        self.generation += 1
+        if vin not in self.states:
+            # Its documents would be stale if it came back with the same version
+            self.versions.pop(vin, None)
+            self.rendered = {k: r for k, r in self.rendered.items() if k[0] != vin}
+            return
+        self.versions[vin] = self.versions.get(vin, 0) + 1
+
+    def document(self, vin: Optional[str], fields: Optional[tuple[str, ...]]) -> Any:
+        if vin is not None:
+            return filter_fields(self.states[vin], fields)
+        return {
+            vin: filter_fields(state, fields)
+            for vin, state in sorted(self.states.items())
+        }
+
+    def render(self, vin: Optional[str], fields: Optional[tuple[str, ...]]) -> Rendered:
+        key = (vin, fields)
+        version = self.generation if vin is None else self.versions.get(vin, 0)
+        previous = self.rendered.get(key)
+        if previous is not None and previous.version == version:
+            return previous
+        if previous is None and len(self.rendered) >= MAX_RENDERED:
+            self.rendered.clear()
+        body = json.dumps(self.document(vin, fields), separators=(",", ":")).encode()
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        if previous is not None and previous.etag == etag:
+            # Polled again but nothing changed
+            modified = previous.modified
+        else:
+            modified = time()
+        self.rendered[key] = Rendered(version, etag, modified, body)
+        return self.rendered[key]
+
+    def not_modified(self, request: web.Request, rendered: Rendered) -> bool:
+        if request.if_none_match is not None:
+            return any(
+                tag.value in (rendered.etag, "*") for tag in request.if_none_match
+            )
+        if request.if_modified_since is not None:
+            # HTTP dates only have whole seconds
+            return int(rendered.modified) <= request.if_modified_since.timestamp()
+        return False
+
+    async def handle_state(self, request: web.Request) -> web.StreamResponse:
+        vin = request.match_info.get("vin")
+        if vin is not None and vin not in self.states:
+            raise web.HTTPNotFound(text=f"No state for {vin}")
+        fields = None
+        if "fields" in request.query:
+            requested = request.query["fields"].split(",")
+            fields = tuple(sorted({f.strip() for f in requested if f.strip()}))
+        rendered = self.render(vin, fields)
+        response: web.StreamResponse
+        if self.not_modified(request, rendered):
+            response = web.Response(status=304)
+        else:
+            response = web.Response(body=rendered.body, content_type="application/json")
+        response.etag = rendered.etag
+        response.last_modified = rendered.modified
+        # Caches may keep the state but must check it's still current
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    async def handle_vehicles(self, request: web.Request) -> web.Response:
+        return web.json_response({"vins": sorted(self.states)})
+
+    def routes(self) -> list[web.RouteDef]:
+        return [
+            web.get("/api/vehicles", self.handle_vehicles),
+            web.get("/api/vehicles/state", self.handle_state),
+            web.get("/api/vehicles/{vin}/state", self.handle_state),
+        ]
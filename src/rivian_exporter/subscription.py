@@ -0,0 +1,68 @@
+from typing import Any, Awaitable, Callable, Optional
+
+import glog as log
+from rivian import Rivian
+
+UpdateCallback = Callable[[dict[str, Any]], None]
+
+
+class VehicleSubscription:
+    """
+    Holds a GraphQL vehicle state subscription open for one VIN and hands the
+    (partial) vehicle state of every frame to `on_update`.
+
+    The rivian client owns the web socket and will reconnect and resubscribe on
+    its own; this class only tracks whether frames can currently arrive so the
+    exporter knows when to fall back to polling.
+    """
+
+    vin: str
+    rivian: Rivian
+    on_update: UpdateCallback
+    frames: int
+    unsubscribe: Optional[Callable[[], Awaitable[None]]]
+
+    def __init__(self, rivian: Rivian, vin: str, on_update: UpdateCallback) -> None:
+        self.rivian = rivian
+        self.vin = vin
+        self.on_update = on_update
+        self.frames = 0
+        self.unsubscribe = None
+
+    @property
+    def connected(self) -> bool:
+        monitor = self.rivian._ws_monitor
+        return (
+            self.unsubscribe is not None
+            and monitor is not None
+            and monitor.connected
+            and monitor.connection_ack.is_set()
+        )
+
+    def handle(self, frame: dict[str, Any]) -> None:
+        payload = frame.get("payload") or {}
+        update = (payload.get("data") or {}).get("vehicleState")
+        if not update:
+            log.debug(f"Ignoring subscription frame for {self.vin}: {frame}")
+            return
+        self.frames += 1
+        self.on_update(update)
+
+    async def start(self, properties: Optional[set[str]] = None) -> bool:
+        """
+        Returns True if the subscription was started.  The rivian client logs and
+        swallows connection errors so there is nothing to catch here.
+        """
+        self.unsubscribe = await self.rivian.subscribe_for_vehicle_updates(
+            self.vin, self.handle, properties
+        )
+        if self.unsubscribe is None:
+            log.warning(f"Unable to subscribe to vehicle updates for {self.vin}")
+            return False
+        log.info(f"Subscribed to vehicle updates for {self.vin}")
+        return True
+
+    async def stop(self) -> None:
+        if self.unsubscribe is not None:
+            await self.unsubscribe()
+            self.unsubscribe = None
@@ -0,0 +1,356 @@
+import asyncio
+import gzip
+import hashlib
+import multiprocessing
+import os
+import signal
+from multiprocessing.process import BaseProcess
+from typing import Any, Callable, Iterable, Optional
+
+import aiohttp
+import glog as log
+import prometheus_client as prom
+from aiohttp import web
+from prometheus_client import exposition
+from prometheus_client.metrics_core import Metric
+from prometheus_client.openmetrics import parser
+
+from . import exporter, vehicle
+from .http_server import MetricsServer
+from .instrumentation import SUPERVISOR_REGISTRY, WORKER_RESTARTS, WORKER_UP
+from .scheduler import Backoff
+
+# How often to check that the workers are still running (seconds)
+WORKER_CHECK_INTERVAL = 1.0
+# Crashed workers are restarted with exponential backoff between these
+# (seconds), starting again from the minimum once a worker has run this long
+RESTART_BACKOFF_MIN = 1.0
+RESTART_BACKOFF_MAX = 60.0
+WORKER_STABLE = 60.0
+# Workers are scraped over loopback so they should answer quickly
+SCRAPE_TIMEOUT = 10
+# Workers answer in OpenMetrics so counters and infos parse back unambiguously
+SCRAPE_HEADERS = {"Accept": "application/openmetrics-text; version=1.0.0"}
+
+
+def shard_for(vin: str, shards: int) -> int:
+    """
+    The shard a VIN belongs to, by rendezvous hashing: each VIN goes to the
+    shard with the highest hash of the pair.  It depends only on the VIN and
+    the number of shards, so assignments survive restarts, and adding a shard
+    only moves the VINs the new shard wins.
+    """
+    return max(
+        range(shards),
+        key=lambda shard: hashlib.sha256(f"{shard}:{vin}".encode()).digest(),
+    )
+
+
+def assign_shards(vins: Iterable[str], shards: int) -> list[list[str]]:
+    assigned: list[list[str]] = [[] for _ in range(shards)]
+    for vin in vins:
+        assigned[shard_for(vin, shards)].append(vin)
+    return assigned
+
+
+def merge_families(
+    sources: Iterable[tuple[Optional[int], Iterable[Metric]]],
+) -> list[Metric]:
+    """
+    Merge the metric families of several processes into one family per name.
+    Vehicle series are disjoint between shards, but the exporter's own metrics
+    aren't, so samples without a vin label get a shard label from the process
+    they came from.  Sources with no shard are passed through as they are.
+    """
+    merged: dict[str, Metric] = {}
+    for shard, families in sources:
+        for family in families:
+            target = merged.get(family.name)
+            if target is None:
+                target = Metric(family.name, family.documentation, family.type)
+                target.unit = family.unit
+                merged[family.name] = target
+            elif target.type != family.type:
+                log.warning(
+                    f"Dropping {family.name} from shard {shard}: it's a "
+                    f"{family.type} there but a {target.type} elsewhere"
+                )
+                continue
+            for sample in family.samples:
+                if shard is not None and "vin" not in sample.labels:
+                    sample = sample._replace(
+                        labels={**sample.labels, "shard": str(shard)}
+                    )
+                target.samples.append(sample)
+    return list(merged.values())
+
+
+class Snapshot:
+    """A collector returning families that have already been collected"""
+
+    families: list[Metric]
+
+    def __init__(self, families: list[Metric]) -> None:
+        self.families = families
+
+    def collect(self) -> Iterable[Metric]:
+        return self.families
+
+
+class ShardedMetricsServer(MetricsServer):
+    """
+    Serves the metrics of every worker as one exposition by scraping each of
+    them and merging the results.  Nothing is cached as the supervisor doesn't
+    see the workers' updates.
+
+    /healthz and /readyz likewise merge the workers' own, failing when any
+    shard's does.  A shard that doesn't answer only fails /readyz: workers
+    that exit are restarted by the supervisor rather than the orchestrator.
+    """
+
+    ports: dict[int, int]
+    session: Optional[aiohttp.ClientSession]
+
+    def __init__(
+        self,
+        ports: dict[int, int],
+        registry: prom.CollectorRegistry = SUPERVISOR_REGISTRY,
+    ) -> None:
+        super().__init__(registry, cache=False)
+        self.ports = ports
+        self.session = None
+        self.routes += [
+            web.get("/healthz", self.handle_healthz),
+            web.get("/readyz", self.handle_readyz),
+        ]
+
+    async def scrape(self, shard: int, port: int) -> list[Metric]:
+        assert self.session is not None
+        try:
+            async with self.session.get(
+                f"http://127.0.0.1:{port}/metrics", headers=SCRAPE_HEADERS
+            ) as response:
+                response.raise_for_status()
+                text = await response.text()
+            families = list(parser.text_string_to_metric_families(text))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+            log.warning(f"Unable to scrape shard {shard} on port {port}: {ex}")
+            WORKER_UP.labels(str(shard)).set(0)
+            return []
+        WORKER_UP.labels(str(shard)).set(1)
+        return families
+
+    async def check(self, shard: int, port: int, path: str) -> Optional[Any]:
+        """The shard's health report, None when it doesn't answer"""
+        assert self.session is not None
+        try:
+            async with self.session.get(f"http://127.0.0.1:{port}{path}") as response:
+                # Failing checks still carry the report
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+            log.warning(f"Unable to check shard {shard} on port {port}: {ex}")
+            return None
+
+    async def merge_health(self, path: str, unanswered_fails: bool) -> web.Response:
+        shards = list(self.ports.items())
+        reports = await asyncio.gather(
+            *(self.check(shard, port, path) for shard, port in shards)
+        )
+        problems = []
+        vehicles: dict[str, Any] = {}
+        for (shard, _), report in zip(shards, reports):
+            if report is None:
+                if unanswered_fails:
+                    problems.append(f"Shard {shard} didn't answer")
+                continue
+            problems += [f"Shard {shard}: {problem}" for problem in report["problems"]]
+            vehicles.update(report["vehicles"])
+        body = {"ok": not problems, "problems": problems, "vehicles": vehicles}
+        return web.json_response(body, status=503 if problems else 200)
+
+    async def handle_healthz(self, request: web.Request) -> web.Response:
+        return await self.merge_health("/healthz", unanswered_fails=False)
+
+    async def handle_readyz(self, request: web.Request) -> web.Response:
+        return await self.merge_health("/readyz", unanswered_fails=True)
+
+    async def render(self, accept: str, compress: bool) -> tuple[bytes, str]:
+        encoder, content_type = exposition.choose_encoder(accept)
+        shards = list(self.ports.items())
+        scraped = await asyncio.gather(
+            *(self.scrape(shard, port) for shard, port in shards)
+        )
+        sources: list[tuple[Optional[int], Iterable[Metric]]] = [
+            (shard, families) for (shard, _), families in zip(shards, scraped)
+        ]
+        sources.append((None, self.registry.collect()))
+        registry = prom.CollectorRegistry(auto_describe=False)
+        registry.register(Snapshot(merge_families(sources)))  # type: ignore
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(None, encoder, registry)
+        if compress:
+            body = await loop.run_in_executor(None, gzip.compress, body)
+        return body, content_type
+
+    async def start(self, port: int, host: str = "0.0.0.0") -> None:
+        timeout = aiohttp.ClientTimeout(total=SCRAPE_TIMEOUT)
+        self.session = aiohttp.ClientSession(timeout=timeout)
+        await super().start(port, host)
+
+    async def stop(self) -> None:
+        await super().stop()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+def run_worker(port: int, vins: list[str], options: dict[str, Any]) -> None:
+    """Entry point of a worker process, exporting its shard on loopback only"""
+    log.setLevel("INFO")
+    exporter.run(port, vins=vins, server="asyncio", host="127.0.0.1", **options)
+
+
+class Supervisor:
+    """
+    Shards the VINs over worker processes, each a normal exporter serving its
+    shard on loopback, and restarts workers that exit.  Shard n is served on
+    port `base_port` + n.
+    """
+
+    shards: list[list[str]]
+    base_port: int
+    """Keyword arguments of `exporter.run` shared by every worker"""
+    options: dict[str, Any]
+    target: Callable[[int, list[str], dict[str, Any]], None]
+    processes: dict[int, BaseProcess]
+    started_at: dict[int, float]
+    """When each exited worker is due to be restarted"""
+    restart_at: dict[int, float]
+    backoffs: dict[int, Backoff]
+
+    def __init__(
+        self,
+        vins: list[str],
+        workers: int,
+        base_port: int,
+        options: dict[str, Any],
+        target: Callable[[int, list[str], dict[str, Any]], None] = run_worker,
+    ) -> None:
+        self.shards = assign_shards(vins, workers)
+        self.base_port = base_port
+        self.options = options
+        self.target = target
+        self.processes = {}
+        self.started_at = {}
+        self.restart_at = {}
+        self.backoffs = {}
+
+    def ports(self) -> dict[int, int]:
+        """The port of each shard that has any VINs"""
+        return {
+            shard: self.base_port + shard
+            for shard, vins in enumerate(self.shards)
+            if vins
+        }
+
+    def worker_options(self, shard: int) -> dict[str, Any]:
+        options = dict(self.options)
+        rate = options.get("requests_per_minute")
+        if rate:
+            # The budget is for the whole account, split it by shard size
+            total = sum(len(vins) for vins in self.shards)
+            options["requests_per_minute"] = rate * len(self.shards[shard]) / total
+        if "remote_write_queue" in options:
+            # Each worker needs a queue of its own
+            options["remote_write_queue"] += f"/shard-{shard}"
+        return options
+
+    def start_worker(self, shard: int) -> None:
+        vins = self.shards[shard]
+        port = self.base_port + shard
+        log.info(f"Starting shard {shard} on port {port} for {len(vins)} vehicles")
+        # Spawned rather than forked so workers don't inherit the event loop
+        process = multiprocessing.get_context("spawn").Process(
+            target=self.target,
+            args=(port, vins, self.worker_options(shard)),
+            name=f"rivian-exporter-shard-{shard}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[shard] = process
+        self.started_at[shard] = asyncio.get_running_loop().time()
+        self.backoffs.setdefault(
+            shard, Backoff(RESTART_BACKOFF_MIN, RESTART_BACKOFF_MAX)
+        )
+
+    def check_workers(self) -> None:
+        now = asyncio.get_running_loop().time()
+        for shard, process in self.processes.items():
+            if shard in self.restart_at:
+                if now >= self.restart_at[shard]:
+                    del self.restart_at[shard]
+                    WORKER_RESTARTS.labels(str(shard)).inc()
+                    self.start_worker(shard)
+                continue
+            if process.is_alive():
+                continue
+            backoff = self.backoffs[shard]
+            if now - self.started_at[shard] >= WORKER_STABLE:
+                backoff.reset()
+            delay = backoff.next_delay()
+            log.error(
+                f"Shard {shard} exited with code {process.exitcode}, "
+                f"restarting in {delay:.1f}s"
+            )
+            WORKER_UP.labels(str(shard)).set(0)
+            self.restart_at[shard] = now + delay
+
+    def signal_workers(self, signum: int) -> None:
+        for process in self.processes.values():
+            if process.is_alive() and process.pid is not None:
+                os.kill(process.pid, signum)
+
+    def stop(self) -> None:
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(5)
+
+    async def run(self) -> None:
+        for shard in self.ports():
+            self.start_worker(shard)
+        try:
+            while True:
+                await asyncio.sleep(WORKER_CHECK_INTERVAL)
+                # Reaping is a quick non-blocking waitpid per worker
+                self.check_workers()
+        finally:
+            self.stop()
+
+
+async def supervise(supervisor: Supervisor, port: int) -> None:
+    metrics_server = ShardedMetricsServer(supervisor.ports())
+    if supervisor.options.get("metrics_config") is not None:
+        # Each worker reloads its own metric definitions
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP, supervisor.signal_workers, signal.SIGHUP
+        )
+    await metrics_server.start(port)
+    try:
+        await supervisor.run()
+    finally:
+        await metrics_server.stop()
+
+
+def run(port: int, workers: int, vins: list[str], options: dict[str, Any]) -> None:
+    """
+    Export `vins`, or every vehicle on the account when there are none, from
+    `workers` processes behind one /metrics on `port`.  `options` are the
+    keyword arguments of `exporter.run`.
+    """
+    if not vins:
+        info = asyncio.run(vehicle.get_user_info(options.get("session_cache")))
+        vins = vehicle.vins_from_user_info(info)
+        log.info(f"Found {len(vins)} vehicles on the account")
+    supervisor = Supervisor(vins, workers, port + 1, options)
+    asyncio.run(supervise(supervisor, port))
@@ -1,8 +1,14 @@
 import os
-from typing import Any, Tuple
+from typing import Any, Awaitable, Callable, Optional, Tuple, TypeVar
 
 import glog as log
 import rivian
+from rivian.exceptions import RivianUnauthenticated
+
+from .decoding import get_decoder
+from .session_cache import SessionCache, fingerprint
+
+T = TypeVar("T")
 
 
 class RivianExporterException(Exception):
@@ -45,28 +51,103 @@ def get_token(token: str) -> str:
         return line.strip()
 
 
-def get_rivian() -> rivian.Rivian:
-    access_token = get_token("ACCESS_TOKEN")
-    refresh_token = get_token("REFRESH_TOKEN")
-    user_session_token = get_token("USER_SESSION_TOKEN")
+def get_credentials() -> dict[str, str]:
+    return {
+        "access_token": get_token("ACCESS_TOKEN"),
+        "refresh_token": get_token("REFRESH_TOKEN"),
+        "user_session_token": get_token("USER_SESSION_TOKEN"),
+    }
+
+
+def get_rivian(session_cache: Optional[SessionCache] = None) -> rivian.Rivian:
+    tokens = get_credentials()
+    if session_cache is not None:
+        cached = session_cache.load(fingerprint(tokens))
+        if cached:
+            log.info("Reusing cached Rivian session")
+            tokens.update(cached)
     return rivian.Rivian(
-        access_token=access_token,
-        refresh_token=refresh_token,
-        user_session_token=user_session_token,
+        access_token=tokens["access_token"],
+        refresh_token=tokens["refresh_token"],
+        user_session_token=tokens["user_session_token"],
+        csrf_token=tokens.get("csrf_token", ""),
+        app_session_token=tokens.get("app_session_token", ""),
     )
 
 
-async def get_user_info() -> Any:
-    async with get_rivian() as r:
-        await r.create_csrf_token()
-        info = await r.get_user_information()
+async def start_session(
+    r: rivian.Rivian,
+    session_cache: Optional[SessionCache] = None,
+    refresh: bool = False,
+) -> bool:
+    """
+    Create the CSRF and app session tokens, unless they were restored from the
+    session cache, and save them for the next start.  Returns whether the
+    session was restored.
+    """
+    if r._csrf_token and not refresh:
+        return True
+    await r.create_csrf_token()
+    if session_cache is not None:
+        tokens = {
+            "access_token": r._access_token,
+            "refresh_token": r._refresh_token,
+            "user_session_token": r._user_session_token,
+            "csrf_token": r._csrf_token,
+            "app_session_token": r._app_session_token,
+        }
+        session_cache.save(fingerprint(get_credentials()), tokens)
+    return False
+
+
+async def with_session(
+    r: rivian.Rivian,
+    session_cache: Optional[SessionCache],
+    request: Callable[[], Awaitable[T]],
+) -> T:
+    """
+    Start a session and make `request` with it.  A restored session the API
+    rejects is dropped from the cache and `request` retried once with a new
+    one.
+    """
+    restored = await start_session(r, session_cache)
+    while True:
+        try:
+            return await request()
+        except RivianUnauthenticated:
+            if session_cache is not None:
+                # Don't restore a rejected session next time
+                session_cache.clear()
+            if not restored:
+                raise
+            log.info("The cached Rivian session was rejected, creating a new one")
+            restored = await start_session(r, session_cache, refresh=True)
+
+
+async def get_user_info(session_cache: Optional[SessionCache] = None) -> Any:
+    async with get_rivian(session_cache) as r:
+        info = await with_session(r, session_cache, r.get_user_information)
         body = await info.json()
         return body
 
 
-async def get_vehicle_state(vin: str) -> Any:
-    async with get_rivian() as r:
-        await r.create_csrf_token()
-        state = await r.get_vehicle_state(vin)
-        body = await state.json()
-        return body
+async def get_vehicle_state(
+    vin: str,
+    session_cache: Optional[SessionCache] = None,
+    properties: Optional[set[str]] = None,
+) -> Any:
+    """`properties` limits the fields requested, by default all of them are"""
+    async with get_rivian(session_cache) as r:
+        state = await with_session(
+            r, session_cache, lambda: r.get_vehicle_state(vin, properties)
+        )
+        return get_decoder()(await state.read())
+
+
+def vins_from_user_info(info: Any) -> list[str]:
+    """
+    Pull the VIN of every vehicle on the account out of a `get_user_info`
+    response
+    """
+    vehicles = info["data"]["currentUser"]["vehicles"]
+    return [v["vin"] for v in vehicles]
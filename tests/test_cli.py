@@ -0,0 +1,18 @@
+import os
+import subprocess
+import sys
+
+# Modules the CLI must only import once a command needs them
+HEAVY_MODULES = ["aiohttp", "prometheus_client", "rivian"]
+
+
+def test_cli_import_is_light():
+    code = (
+        "import sys, rivian_exporter.__main__; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+    result = subprocess.run(
+        [sys.executable, "-c", code], env=env, check=True, capture_output=True
+    )
+    assert result.stdout.decode().strip() == ""
@@ -0,0 +1,116 @@
+import prometheus_client as prom
+import pytest
+
+import rivian_exporter.exporter as exporter
+from rivian_exporter import builtin_metrics, config, rivian_collectors
+
+from . import utils
+
+VIN = "ConfiguredVin"
+
+
+def samples(collectors):
+    state = utils.vehicle_data()["data"]["vehicleState"]
+    return [
+        sample
+        for collector in collectors
+        for sample in collector.family({VIN: state}).samples
+    ]
+
+
+def test_example_matches_built_in_metrics():
+    collectors = config.load_collectors("metrics.example.toml")
+    assert samples(collectors) == samples(exporter.GAUGES + exporter.INFOS)
+    sources = {s for c in exporter.GAUGES + exporter.INFOS for s in c.sources}
+    assert builtin_metrics.SOURCES == sources
+
+
+def test_yaml_definitions(tmp_path):
+    pytest.importorskip("yaml")
+    path = tmp_path / "metrics.yaml"
+    path.write_text("""
+gauge:
+  - name: yaml_speed_mps
+    help: Speed
+    source: gnssSpeed
+    scale: 0.2777777777777778
+info:
+  - name: yaml_location
+    help: Location
+    labels:
+      latitude: {source: gnssLocation, key: latitude}
+""")
+    speed, location = config.load_collectors(str(path))
+    state = utils.vehicle_data()["data"]["vehicleState"]
+    assert speed.value(state) == pytest.approx(state["gnssSpeed"]["value"] / 3.6)
+    assert location.values(state) == {
+        "latitude": str(state["gnssLocation"]["latitude"])
+    }
+
+
+def test_every_problem_is_reported():
+    definitions = {
+        "gauge": [
+            {"name": "bad name", "help": "", "source": "gnssSpeed", "scale": "2"},
+            {"name": "twice", "help": "Twice", "source": "gnssSpeed", "unit": "m"},
+        ],
+        "info": [
+            {"name": "twice", "help": "Twice", "labels": {"vin": "gnssSpeed"}},
+        ],
+        "counter": [],
+    }
+    with pytest.raises(config.ConfigError) as raised:
+        config.parse_definitions(definitions)
+    message = str(raised.value)
+    for problem in (
+        "unknown section counter",
+        "help must be a non-empty string",
+        "scale must be a number",
+        "unknown key unit",
+        "the vin label is reserved",
+        "bad name is not a valid metric name",
+        "twice is defined more than once",
+    ):
+        assert problem in message
+
+
+def test_reload_swaps_metrics(tmp_path):
+    path = tmp_path / "metrics.toml"
+    path.write_text("""
+[[gauge]]
+name = "reloaded_range_km"
+help = "Range"
+source = "distanceToEmpty"
+""")
+    replay = exporter.ReplayExporter(str(tmp_path / "unused.ndjson.gz"))
+    replay.metrics_config = str(path)
+    replay.states[VIN] = utils.vehicle_data()["data"]["vehicleState"]
+    built_in = list(exporter.COLLECTORS)
+    try:
+        replay.reload_metrics()
+        get_sample_value = prom.REGISTRY.get_sample_value
+        assert get_sample_value("reloaded_range_km", {"vin": VIN}) is not None
+        assert exporter.PLAN.sources == {"distanceToEmpty"}
+        assert replay.properties == {"distanceToEmpty"}
+        assert "rivian_speed_kph" not in prom.REGISTRY._names_to_collectors
+
+        # Broken definitions leave the current ones in place
+        path.write_text("[[gauge]]\nname = 'broken'\n")
+        replay.reload_metrics()
+        assert [c.prometheus_label for c in exporter.COLLECTORS] == [
+            "reloaded_range_km"
+        ]
+    finally:
+        exporter.use_collectors(built_in)
+    assert "rivian_speed_kph" in prom.REGISTRY._names_to_collectors
+
+
+def test_static_infos_stay_infos():
+    collectors = config.load_collectors("metrics.example.toml")
+    names = {
+        c.prometheus_label: type(c).__name__
+        for c in rivian_collectors.as_state_sets(collectors)
+    }
+    assert names["rivian_ota_version"] == "RivianInfo"
+    assert names["rivian_vehicle_state_gear"] == "RivianStateSet"
+    assert "rivian_vehicle_state" not in names
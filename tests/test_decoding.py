@@ -0,0 +1,20 @@
+import json
+
+import pytest
+
+from rivian_exporter import decoding
+
+from . import utils
+
+
+@pytest.mark.parametrize("name", list(decoding.DECODERS))
+def test_decoders_agree(name):
+    data = utils.vehicle_data()
+    raw = json.dumps(data).encode()
+    state = decoding.vehicle_state(decoding.get_decoder(name)(raw))
+    assert state == data["data"]["vehicleState"]
+
+
+def test_missing_vehicle_state():
+    with pytest.raises(ValueError):
+        decoding.vehicle_state({"data": {"vehicleState": None}})
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta, timezone
+
+import prometheus_client as prom
+import pytest
+
+import rivian_exporter.exporter as exporter
+from rivian_exporter import derived
+from rivian_exporter.state_api import StateApi
+
+VIN = "DerivedVin"
+START = datetime(2023, 10, 8, tzinfo=timezone.utc)
+
+
+def state(minutes: float, level: float, mileage: float) -> dict:
+    reported = (START + timedelta(minutes=minutes)).isoformat()
+    return {
+        "batteryLevel": {"timeStamp": reported, "value": level},
+        "batteryCapacity": {"timeStamp": reported, "value": 100},
+        "vehicleMileage": {"timeStamp": reported, "value": mileage},
+    }
+
+
+def test_charging_and_driving():
+    registry = prom.CollectorRegistry()
+    metrics = derived.DerivedMetrics(["1h"], registry=registry)
+
+    def value(name, **labels):
+        return registry.get_sample_value(name, {"vin": VIN, **labels})
+
+    metrics.update(VIN, state(0, 50, 1000))
+    # Charging from 50 to 60 kWh over half an hour
+    metrics.update(VIN, state(30, 60, 1000))
+    assert value("rivian_charge_power_kilowatts") == pytest.approx(20)
+    assert value("rivian_energy_added_kwh_total") == pytest.approx(10)
+
+    # Polling again before the vehicle reports anything new changes nothing
+    metrics.update(VIN, state(30, 60, 1000))
+    assert value("rivian_energy_added_kwh_total") == pytest.approx(10)
+
+    # Driving 20 km on 4 kWh
+    metrics.update(VIN, state(60, 56, 21000))
+    assert value("rivian_charge_power_kilowatts") == 0
+    assert value("rivian_energy_used_kwh_total") == pytest.approx(4)
+    assert value("rivian_distance_traveled_meters_total") == 20000
+    assert value("rivian_efficiency_meters_per_kwh", window="1h") == pytest.approx(5000)
+
+    # An hour parked, then a less efficient drive weighs more than the first
+    metrics.update(VIN, state(120, 55, 21000))
+    metrics.update(VIN, state(150, 51, 31000))
+    efficiency = value("rivian_efficiency_meters_per_kwh", window="1h")
+    assert 10000 / 5 < efficiency < 30000 / 9
+
+
+def test_windows_are_validated():
+    assert derived.parse_window("15m") == 900
+    assert derived.parse_window("7d") == 7 * 86400
+    for window in ("0h", "1w", "h"):
+        with pytest.raises(ValueError):
+            derived.parse_window(window)
+
+
+def test_exporter_requests_derived_sources(tmp_path):
+    rivian_exporter = exporter.ReplayExporter(str(tmp_path / "unused.ndjson.gz"))
+    rivian_exporter.add_tracker(
+        derived.DerivedMetrics(registry=prom.CollectorRegistry())
+    )
+    assert derived.SOURCES <= rivian_exporter.properties
+    assert exporter.PLAN.sources <= rivian_exporter.properties
+
+
+def test_forgotten_vehicles_lose_their_series(tmp_path):
+    registry = prom.CollectorRegistry()
+    metrics = derived.DerivedMetrics(["1h"], registry=registry)
+    rivian_exporter = exporter.ReplayExporter(str(tmp_path / "unused.ndjson.gz"))
+    rivian_exporter.add_tracker(metrics)
+    api = StateApi(rivian_exporter.states)
+    rivian_exporter.add_listener(api.invalidate)
+    for minutes, level, mileage in ((0, 50, 1000), (30, 46, 21000)):
+        rivian_exporter.states[VIN] = state(minutes, level, mileage)
+        rivian_exporter.notify(VIN)
+    api.render(VIN, None)
+    labels = {"vin": VIN}
+    assert registry.get_sample_value("rivian_distance_traveled_meters_total", labels)
+
+    rivian_exporter.forget(VIN)
+    assert VIN not in rivian_exporter.states
+    assert VIN not in metrics.vehicles
+    assert api.versions == {}
+    assert api.rendered == {}
+    for name in (
+        "rivian_distance_traveled_meters_total",
+        "rivian_charge_power_kilowatts",
+        "rivian_energy_used_kwh_total",
+    ):
+        assert registry.get_sample_value(name, labels) is None
+    efficiency = {**labels, "window": "1h"}
+    assert (
+        registry.get_sample_value("rivian_efficiency_meters_per_kwh", efficiency)
+        is None
+    )
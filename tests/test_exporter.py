@@ -1,7 +1,19 @@
+import asyncio
+import io
+import json
+
+import prometheus_client as prom
+import pytest
 import testslide as ts
+from rivian.exceptions import (
+    RivianApiRateLimitError,
+    RivianDataError,
+    RivianUnauthenticated,
+)
 
 import rivian_exporter.exporter as exporter
 import rivian_exporter.vehicle as vehicle
+from rivian_exporter.recording import Recorder, read_recording
 
 from . import utils
 from .pytest_testslide import testslide
@@ -15,19 +27,178 @@ def test_set_prom_metrics():
     P.S. I love PRs
     """
     data = utils.vehicle_data()
-    exporter.set_prom_metrics(data)
+    exporter.set_prom_metrics(data, "TheVin")
 
 
 async def test_get_vehicle_state(testslide):
     vin = "TheVin"
     response_mock = ts.StrictMock()
-    testslide.mock_async_callable(response_mock, "json").to_return_value("{}")
+    testslide.mock_async_callable(response_mock, "read").to_return_value(b"{}")
     rivian_mock = utils.get_rivian_mock(testslide)
+    # Only the fields the collectors read are requested
     testslide.mock_async_callable(rivian_mock, "get_vehicle_state").for_call(
-        vin
+        vin, set(exporter.PLAN.sources)
     ).to_return_value(response_mock).and_assert_called_once()
 
     testslide.mock_callable(vehicle, "get_rivian").to_return_value(rivian_mock)
-    rivian_exporter = exporter.RivianExporter(vin, scrape_interval=30)
-    state = await rivian_exporter.get_vehicle_state()
-    assert state is not None
+    rivian_exporter = exporter.RivianExporter([vin], scrape_interval=30)
+    labels = {"operation": "vehicle_state"}
+    before = prom.REGISTRY.get_sample_value(
+        "rivian_exporter_response_bytes_count", labels
+    )
+    state = await rivian_exporter.get_vehicle_state(vin)
+    assert state == {}
+    after = prom.REGISTRY.get_sample_value(
+        "rivian_exporter_response_bytes_count", labels
+    )
+    assert after == (before or 0) + 1
+
+
+async def test_discover_vins(testslide):
+    response_mock = ts.StrictMock()
+    testslide.mock_async_callable(response_mock, "json").to_return_value(
+        {"data": {"currentUser": {"vehicles": [{"vin": "Vin1"}, {"vin": "Vin2"}]}}}
+    )
+    rivian_mock = utils.get_rivian_mock(testslide)
+    testslide.mock_async_callable(rivian_mock, "get_user_information").to_return_value(
+        response_mock
+    ).and_assert_called_once()
+
+    testslide.mock_callable(vehicle, "get_rivian").to_return_value(rivian_mock)
+    rivian_exporter = exporter.RivianExporter([], scrape_interval=30)
+    assert await rivian_exporter.discover_vins() == ["Vin1", "Vin2"]
+
+
+async def test_inner_loop_honours_retry_after(testslide):
+    vin = "TheVin"
+    rivian_mock = utils.get_rivian_mock(testslide)
+    testslide.mock_async_callable(rivian_mock, "get_vehicle_state").to_raise(
+        RivianApiRateLimitError(429, {"errors": [{"extensions": {"retryAfter": 60}}]})
+    )
+    testslide.mock_callable(vehicle, "get_rivian").to_return_value(rivian_mock)
+    rivian_exporter = exporter.RivianExporter(
+        [vin], scrape_interval=30, requests_per_minute=60
+    )
+    backoff = rivian_exporter.backoff()
+    assert await rivian_exporter.inner_loop(vin, backoff) == 60
+    assert backoff.attempt == 0
+    # The whole account backs off, not just this vehicle
+    assert rivian_exporter.budget is not None
+    loop = asyncio.get_running_loop()
+    assert rivian_exporter.budget.paused_until > loop.time() + 59
+
+
+async def test_inner_loop_backs_off_on_errors(testslide):
+    vin = "TheVin"
+    rivian_mock = utils.get_rivian_mock(testslide)
+    testslide.mock_async_callable(rivian_mock, "get_vehicle_state").to_raise(
+        RuntimeError("boom")
+    )
+    testslide.mock_callable(vehicle, "get_rivian").to_return_value(rivian_mock)
+    rivian_exporter = exporter.RivianExporter([vin], scrape_interval=30)
+    polled: list[str] = []
+    rivian_exporter.add_poll_listener(polled.append)
+    backoff = rivian_exporter.backoff()
+    labels = {"exception": "RuntimeError"}
+    before = prom.REGISTRY.get_sample_value("rivian_exporter_poll_errors_total", labels)
+    first = await rivian_exporter.inner_loop(vin, backoff)
+    second = await rivian_exporter.inner_loop(vin, backoff)
+    after = prom.REGISTRY.get_sample_value("rivian_exporter_poll_errors_total", labels)
+    assert after == (before or 0) + 2
+    # Failed polls still refresh the served metrics
+    assert polled == [vin, vin]
+    assert first is not None and 15 <= first <= 30
+    assert second is not None and 30 <= second <= 60
+
+
+async def test_snapshot_streams_ndjson(testslide):
+    response_mock = ts.StrictMock()
+    testslide.mock_async_callable(response_mock, "read").to_return_value(
+        json.dumps(utils.vehicle_data()).encode()
+    )
+    rivian_mock = utils.get_rivian_mock(testslide)
+    testslide.mock_async_callable(rivian_mock, "get_vehicle_state").for_call(
+        "GoodVin", set(exporter.PLAN.sources)
+    ).to_return_value(response_mock).and_assert_called_twice()
+    testslide.mock_async_callable(rivian_mock, "get_vehicle_state").for_call(
+        "BadVin", set(exporter.PLAN.sources)
+    ).to_raise(RivianDataError("No such vehicle"))
+    testslide.mock_async_callable(vehicle, "start_session").to_return_value(False)
+    testslide.mock_callable(vehicle, "get_rivian").to_return_value(rivian_mock)
+
+    rivian_exporter = exporter.RivianExporter(["GoodVin", "BadVin"], 0)
+    output = io.StringIO()
+    await rivian_exporter.snapshot(output, interval=0.01, count=2)
+    entries = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert len(entries) == 4
+    good = [e for e in entries if e["vin"] == "GoodVin"]
+    assert [e["response"] for e in good] == [utils.vehicle_data()] * 2
+    bad = [e for e in entries if e["vin"] == "BadVin"]
+    assert [e["error"] for e in bad] == ["RivianDataError: No such vehicle"] * 2
+
+
+async def test_record_closes_the_session(testslide, tmp_path):
+    response_mock = ts.StrictMock()
+    testslide.mock_async_callable(response_mock, "read").to_return_value(
+        json.dumps(utils.vehicle_data()).encode()
+    )
+    rivian_mock = utils.get_rivian_mock(testslide)
+    testslide.mock_async_callable(rivian_mock, "get_vehicle_state").to_return_value(
+        response_mock
+    )
+    testslide.mock_async_callable(rivian_mock, "__aexit__").to_return_value(
+        None
+    ).and_assert_called_once()
+    testslide.mock_async_callable(vehicle, "start_session").to_return_value(False)
+    testslide.mock_callable(vehicle, "get_rivian").to_return_value(rivian_mock)
+
+    rivian_exporter = exporter.RivianExporter(["TheVin"], 0)
+    path = str(tmp_path / "recording.ndjson.gz")
+    with Recorder(path) as recorder:
+        await rivian_exporter.record(recorder, count=1)
+    assert [r.vin for r in read_recording(path)] == ["TheVin"]
+
+
+class StaleSession:
+    """Rejects vehicle state requests until a new session is started"""
+
+    def __init__(self) -> None:
+        self.fresh = False
+        self.sessions = 0
+
+    async def request_vehicle_state(self, vin):
+        if not self.fresh:
+            raise RivianUnauthenticated("Bad session")
+        return utils.vehicle_data()
+
+
+async def test_rejected_cached_session_is_replaced_once(monkeypatch):
+    stale = StaleSession()
+
+    async def start_session(r, session_cache, refresh=False):
+        if refresh:
+            stale.fresh = True
+            stale.sessions += 1
+        return not refresh
+
+    monkeypatch.setattr(vehicle, "get_rivian", lambda _cache: stale)
+    monkeypatch.setattr(vehicle, "start_session", start_session)
+    rivian_exporter = exporter.RivianExporter(["VinA", "VinB"], 0)
+    monkeypatch.setattr(
+        rivian_exporter, "request_vehicle_state", stale.request_vehicle_state
+    )
+    await rivian_exporter.start_session()
+
+    states = await asyncio.gather(
+        rivian_exporter.get_vehicle_state("VinA"),
+        rivian_exporter.get_vehicle_state("VinB"),
+    )
+    assert states == [utils.vehicle_data()] * 2
+    # Both polls saw the rejection but only one new session was started
+    assert stale.sessions == 1
+
+    # A session we created ourselves being rejected isn't retried
+    stale.fresh = False
+    with pytest.raises(RivianUnauthenticated):
+        await rivian_exporter.get_vehicle_state("VinA")
+    assert stale.sessions == 1
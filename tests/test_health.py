@@ -0,0 +1,133 @@
+import asyncio
+import socket
+from typing import Any
+
+import aiohttp
+import pytest
+from rivian.exceptions import RivianUnauthenticated
+
+import rivian_exporter.exporter as exporter
+import rivian_exporter.vehicle as vehicle
+from rivian_exporter import health
+
+VIN = "HealthVin"
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(health, "monotonic", clock)
+    return clock
+
+
+def test_freshness(clock):
+    checks = health.Health(max_age=600, ready_max_age=90)
+    checks.expect([VIN, "OtherVin"])
+    assert checks.liveness_problems(clock.now) == []
+    assert checks.readiness_problems(clock.now) == []
+
+    clock.now += 60
+    checks.polled(VIN)
+    clock.now += 60
+    assert checks.liveness_problems(clock.now) == []
+    assert checks.readiness_problems(clock.now) == [
+        "OtherVin hasn't been polled for 120s"
+    ]
+    checks.subscription("OtherVin", True)
+    assert checks.readiness_problems(clock.now) == []
+    checks.subscription("OtherVin", False)
+    # Vehicles the exporter has forgotten aren't waited for
+    checks.forget("OtherVin")
+    assert checks.readiness_problems(clock.now) == []
+    checks.expect(["OtherVin"])
+
+    # Stuck backing off
+    checks.subscription("OtherVin", False)
+    checks.failed(VIN, 900)
+    clock.now += 900
+    assert checks.liveness_problems(clock.now) == [
+        "No vehicle has been polled for 960s"
+    ]
+    report = checks.report([], clock.now)
+    assert report["vehicles"][VIN]["consecutive_failures"] == 1
+    assert report["vehicles"][VIN]["retry_in_seconds"] == 0
+
+
+def test_rate_limits_and_auth(clock):
+    checks = health.Health()
+    checks.polled(VIN)
+    checks.rate_limited(60)
+    assert checks.liveness_problems(clock.now) == []
+    assert checks.readiness_problems(clock.now) == ["Rate limited for 60s"]
+    clock.now += 61
+    assert checks.readiness_problems(clock.now) == []
+
+    checks.unauthenticated(RivianUnauthenticated("Bad session"))
+    assert checks.liveness_problems(clock.now) == [
+        "The Rivian session was rejected: Bad session"
+    ]
+
+
+def test_on_demand_only_checks_the_session(clock):
+    checks = health.Health(max_age=1, ready_max_age=1)
+    checks.check_freshness = False
+    checks.expect([VIN])
+    clock.now += 60
+    assert checks.readiness_problems(clock.now) == []
+
+
+class RejectingRivian:
+    async def get_vehicle_state(self, vin, properties):
+        raise RivianUnauthenticated("Bad session")
+
+
+async def test_exporter_reports_rejected_session(monkeypatch):
+    monkeypatch.setattr(vehicle, "get_rivian", lambda _cache: RejectingRivian())
+    monkeypatch.setattr(vehicle, "start_session", start_session)
+    rivian_exporter = exporter.RivianExporter([VIN], scrape_interval=30)
+    port = free_port()
+    task = asyncio.create_task(
+        exporter.run_with_server(rivian_exporter, port, "127.0.0.1")
+    )
+    try:
+        async with aiohttp.ClientSession() as session:
+            body = await poll_healthz(session, port)
+        assert body["problems"] == ["The Rivian session was rejected: Bad session"]
+        # Still serving the failure rather than exiting
+        assert not task.done()
+    finally:
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+
+async def start_session(r, session_cache, refresh=False):
+    return False
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port: int = s.getsockname()[1]
+        return port
+
+
+async def poll_healthz(session: aiohttp.ClientSession, port: int) -> Any:
+    """The /healthz report once it's failing"""
+    for _ in range(200):
+        try:
+            async with session.get(f"http://127.0.0.1:{port}/healthz") as response:
+                if response.status == 503:
+                    return await response.json()
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.01)
+    raise TimeoutError("/healthz never failed")
@@ -0,0 +1,105 @@
+import gzip
+from typing import Iterable
+
+import aiohttp
+import prometheus_client as prom
+from prometheus_client import exposition
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.metrics_core import Metric
+from prometheus_client.registry import Collector
+
+from rivian_exporter import http_server
+
+
+def registry_with_gauge() -> tuple[prom.CollectorRegistry, prom.Gauge]:
+    registry = prom.CollectorRegistry()
+    gauge = prom.Gauge("test_http_gauge", "A gauge", registry=registry)
+    gauge.set(1)
+    return registry, gauge
+
+
+async def get(
+    server: http_server.MetricsServer, **headers
+) -> tuple[aiohttp.ClientResponse, bytes]:
+    assert server.runner
+    port = server.runner.addresses[0][1]
+    async with aiohttp.ClientSession(auto_decompress=False) as session:
+        async with session.get(
+            f"http://127.0.0.1:{port}/metrics",
+            headers={"Accept-Encoding": "identity", **headers},
+        ) as response:
+            return response, await response.read()
+
+
+async def test_serves_cached_plain_gzip_and_openmetrics():
+    registry, gauge = registry_with_gauge()
+    server = http_server.MetricsServer(registry)
+    await server.start(0, "127.0.0.1")
+    try:
+        response, body = await get(server)
+        assert response.headers["Content-Type"] == exposition.CONTENT_TYPE_LATEST
+        assert b"test_http_gauge 1.0" in body
+
+        response, body = await get(server, **{"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert b"test_http_gauge 1.0" in gzip.decompress(body)
+
+        response, body = await get(server, Accept="application/openmetrics-text")
+        assert response.headers["Content-Type"].startswith(
+            "application/openmetrics-text"
+        )
+        assert body.endswith(b"# EOF\n")
+
+        # Cached until the metrics are updated
+        gauge.set(2)
+        assert b"test_http_gauge 1.0" in (await get(server))[1]
+        server.invalidate()
+        assert b"test_http_gauge 2.0" in (await get(server))[1]
+    finally:
+        await server.stop()
+
+
+class CountingCollector(Collector):
+    def __init__(self) -> None:
+        self.collections = 0
+
+    def collect(self) -> Iterable[Metric]:
+        self.collections += 1
+        yield GaugeMetricFamily("test_http_counting", "Counts", value=1)
+
+
+async def test_renders_once_per_update():
+    registry = prom.CollectorRegistry()
+    collector = CountingCollector()
+    registry.register(collector)
+    server = http_server.MetricsServer(registry)
+    for _ in range(3):
+        body, content_type = await server.render("", False)
+        assert b"test_http_counting 1.0" in body
+        assert content_type == exposition.CONTENT_TYPE_LATEST
+    assert collector.collections == 1
+    server.invalidate()
+    await server.render("", False)
+    assert collector.collections == 2
+
+
+async def test_renders_again_once_too_old():
+    registry = prom.CollectorRegistry()
+    collector = CountingCollector()
+    registry.register(collector)
+    server = http_server.MetricsServer(registry, max_age=60)
+    await server.render("", False)
+    key, (_, rendered_at, body) = next(iter(server.rendered.items()))
+    assert server.cached(key, rendered_at + 59) == body
+    assert server.cached(key, rendered_at + 61) is None
+    assert collector.collections == 1
+
+
+async def test_uncached_renders_every_time():
+    registry = prom.CollectorRegistry()
+    collector = CountingCollector()
+    registry.register(collector)
+    server = http_server.MetricsServer(registry, cache=False)
+    await server.render("", False)
+    await server.render("", False)
+    assert collector.collections == 2
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+
+import prometheus_client as prom
+import pytest
+
+from rivian_exporter import on_demand
+from rivian_exporter.decoding import vehicle_state
+from rivian_exporter.rivian_collectors import gauge, info, parse_timestamp
+
+from . import utils
+
+VIN = "OnDemandVin"
+
+
+class Fetcher:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.release = asyncio.Event()
+        self.fail = False
+
+    async def __call__(self, vin):
+        self.calls += 1
+        await self.release.wait()
+        if self.fail:
+            raise RuntimeError("boom")
+        return utils.vehicle_data()
+
+
+async def test_concurrent_gets_share_one_fetch():
+    fetch = Fetcher()
+    cache = on_demand.StateCache(fetch, ttl=60)
+    gets = [asyncio.ensure_future(cache.get(VIN)) for _ in range(5)]
+    await asyncio.sleep(0)
+    fetch.release.set()
+    states = await asyncio.gather(*gets)
+    assert fetch.calls == 1
+    assert all(state is states[0] for state in states)
+    # Within the TTL we don't fetch again
+    await cache.get(VIN)
+    assert fetch.calls == 1
+
+
+async def test_expired_entries_are_refetched():
+    fetch = Fetcher()
+    fetch.release.set()
+    cache = on_demand.StateCache(fetch, ttl=0)
+    await cache.get(VIN)
+    await cache.get(VIN)
+    assert fetch.calls == 2
+
+
+async def test_failed_refresh_serves_stale_state():
+    fetch = Fetcher()
+    fetch.release.set()
+    cache = on_demand.StateCache(fetch, ttl=0)
+    first = await cache.get(VIN)
+    fetch.fail = True
+    assert await cache.get(VIN) is first
+    with pytest.raises(RuntimeError):
+        await cache.get("AnotherVin")
+
+
+def test_collector_renders_cached_states():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        fetch = Fetcher()
+        loop.call_soon_threadsafe(fetch.release.set)
+        cache = on_demand.StateCache(fetch, ttl=60)
+        registry = prom.CollectorRegistry()
+        collectors = [
+            gauge("on_demand_capacity_kwh", "capacity", "batteryCapacity"),
+            info("on_demand_drive_mode", "Drive mode", {"mode": "driveMode"}),
+        ]
+        for collector in collectors:
+            prom.REGISTRY.unregister(collector.metric)
+        registry.register(
+            on_demand.RivianCollector(collectors, cache, [VIN], loop, timestamps=True)
+        )
+        # Registering must not hit the API
+        assert fetch.calls == 0
+
+        labels = {"vin": VIN}
+        assert registry.get_sample_value("on_demand_capacity_kwh", labels) == 127
+        assert (
+            registry.get_sample_value(
+                "on_demand_drive_mode_info", {**labels, "mode": "distance"}
+            )
+            == 1
+        )
+        # Reported times are their own series, the samples aren't stamped
+        field = {**labels, "field": "batteryCapacity"}
+        reported = registry.get_sample_value("rivian_field_timestamp_seconds", field)
+        capacity_state = vehicle_state(utils.vehicle_data())["batteryCapacity"]
+        assert reported == parse_timestamp(capacity_state["timeStamp"])
+        assert registry.get_sample_value("rivian_field_age_seconds", field) > 0
+        capacity = next(
+            m for m in registry.collect() if m.name == "on_demand_capacity_kwh"
+        )
+        assert capacity.samples[0].timestamp is None
+        assert fetch.calls == 1
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
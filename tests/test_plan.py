@@ -0,0 +1,264 @@
+import time
+
+import prometheus_client as prom
+import pytest
+import testslide as ts
+
+from rivian_exporter import plan, rivian_collectors
+from rivian_exporter.rivian_collectors import FieldTimestamps, gauge, info
+
+from .pytest_testslide import testslide
+from .test_rivian_collectors import VEHICLE_STATE, VIN
+
+FIELD_TIMESTAMPS = FieldTimestamps()
+
+
+def test_plan_sets_gauges(testslide):
+    prom_mock = ts.StrictMock(prom.Gauge)
+    child_mock = ts.StrictMock(prom.Gauge)
+    testslide.mock_constructor(prom, "Gauge").to_return_value(prom_mock)
+    testslide.mock_callable(prom_mock, "labels").for_call(VIN).to_return_value(
+        child_mock
+    ).and_assert_called_once()
+    testslide.mock_callable(child_mock, "set").for_call(0.526).to_return_value(
+        None
+    ).and_assert_called_twice()
+    collector = gauge(
+        "plan_battery_level_ratio",
+        "Percentage of battery remaining",
+        "batteryLevel",
+        modifier=lambda v: v / 100,
+    )
+    extraction_plan = plan.ExtractionPlan([collector], skip_unchanged=False)
+    # The labelled child is looked up once and reused
+    assert extraction_plan.execute(VEHICLE_STATE, VIN) == 1
+    assert extraction_plan.execute(VEHICLE_STATE, VIN) == 1
+
+
+def test_plan_compiles_keys_and_modifiers():
+    latitude = gauge("plan_latitude", "Latitude", "gnssLocation", key="latitude")
+    capacity = gauge("plan_capacity", "Capacity", "batteryCapacity")
+    custom = gauge(
+        "plan_custom", "Custom", "gnssLocation", getter=lambda v: v["longitude"]
+    )
+    steps = plan.ExtractionPlan([latitude, capacity, custom]).gauges
+    assert [(s.source, s.key, s.modifier) for s in steps] == [
+        ("gnssLocation", "latitude", None),
+        ("batteryCapacity", "value", None),
+        ("gnssLocation", None, None),
+    ]
+    registry = prom.REGISTRY
+    plan.ExtractionPlan([latitude, capacity, custom]).execute(VEHICLE_STATE, VIN)
+    assert registry.get_sample_value("plan_latitude", {"vin": VIN}) == 17.8216
+    assert registry.get_sample_value("plan_custom", {"vin": VIN}) == 31.0492
+
+
+def test_plan_skips_unchanged_infos(testslide):
+    version = info(
+        "plan_version",
+        "Version",
+        {"week": "otaCurrentVersionWeek", "number": "otaCurrentVersionNumber"},
+    )
+    child = version.info.labels(VIN)
+    testslide.mock_callable(child, "info").for_call(
+        {"week": "34", "number": "0"}
+    ).to_call_original().and_assert_called_once()
+    extraction_plan = plan.ExtractionPlan([version], skip_unchanged=False)
+    extraction_plan.execute(VEHICLE_STATE, VIN)
+    extraction_plan.execute(VEHICLE_STATE, VIN)
+
+
+def test_plan_partial_update_skips_missing_fields():
+    week = gauge("plan_week", "Week", "otaCurrentVersionWeek")
+    fluid = gauge("plan_brake_fluid", "Brake fluid", "brakeFluidLow")
+    extraction_plan = plan.ExtractionPlan([week, fluid])
+    changed = {"otaCurrentVersionWeek", "brakeFluidLow"}
+    assert extraction_plan.execute(VEHICLE_STATE, VIN, changed) == 1
+
+
+def test_plan_skips_fields_with_unchanged_timestamps():
+    level = gauge("plan_skip_level", "Level", "batteryLevel")
+    limit = gauge("plan_skip_limit", "Limit", "batteryLimit")
+    extraction_plan = plan.ExtractionPlan([level, limit])
+    assert extraction_plan.execute(VEHICLE_STATE, VIN) == 2
+    assert extraction_plan.execute(VEHICLE_STATE, VIN) == 0
+
+    state = dict(VEHICLE_STATE)
+    state["batteryLevel"] = {"timeStamp": "2023-09-30T05:00:00.000Z", "value": 60}
+    assert extraction_plan.execute(state, VIN) == 1
+    assert prom.REGISTRY.get_sample_value("plan_skip_level", {"vin": VIN}) == 60
+    # Timestamps are tracked per VIN
+    assert extraction_plan.execute(VEHICLE_STATE, "OtherVin") == 2
+
+
+def test_plan_exports_field_timestamps(testslide):
+    week = gauge("plan_timestamp_week", "Week", "otaCurrentVersionWeek")
+    extraction_plan = plan.ExtractionPlan([week])
+    extraction_plan.field_timestamps = FIELD_TIMESTAMPS
+    testslide.mock_callable(time, "time").to_return_value(1695945000.0)
+    extraction_plan.execute(VEHICLE_STATE, VIN)
+
+    labels = {"vin": VIN, "field": "otaCurrentVersionWeek"}
+    reported = 1695911335.388
+    get_sample_value = prom.REGISTRY.get_sample_value
+    assert get_sample_value("rivian_field_timestamp_seconds", labels) == reported
+    assert get_sample_value("rivian_field_age_seconds", labels) == pytest.approx(
+        1695945000.0 - reported
+    )
+
+
+def errors(name: str) -> float:
+    value = prom.REGISTRY.get_sample_value(
+        "rivian_collector_errors_total", {"collector": name}
+    )
+    return value or 0
+
+
+def test_plan_isolates_collector_errors():
+    latitude = gauge("plan_error_latitude", "Latitude", "gnssLocation", key="latitude")
+    broken = gauge(
+        "plan_error_broken", "Broken", "batteryLevel", modifier=lambda v: v / 0
+    )
+    capacity = gauge("plan_error_capacity", "Capacity", "batteryCapacity")
+    version = info("plan_error_version", "Version", {"week": "otaCurrentVersionWeek"})
+    extraction_plan = plan.ExtractionPlan([latitude, broken, capacity, version])
+
+    state = dict(VEHICLE_STATE)
+    del state["gnssLocation"]
+    assert extraction_plan.execute(state, VIN) == 2
+    assert errors("plan_error_latitude") == 1
+    assert errors("plan_error_broken") == 1
+    assert errors("plan_error_capacity") == 0
+    get_sample_value = prom.REGISTRY.get_sample_value
+    assert get_sample_value("plan_error_capacity", {"vin": VIN}) == 127
+    assert get_sample_value("plan_error_version_info", {"vin": VIN, "week": "34"}) == 1
+
+
+def test_plan_removes_series_of_vanished_fields():
+    latitude = gauge("plan_vanish_latitude", "Latitude", "gnssLocation", key="latitude")
+    version = info("plan_vanish_version", "Version", {"week": "otaCurrentVersionWeek"})
+    extraction_plan = plan.ExtractionPlan([latitude, version], remove_missing=True)
+    extraction_plan.execute(VEHICLE_STATE, VIN)
+
+    get_sample_value = prom.REGISTRY.get_sample_value
+    labels = {"vin": VIN}
+    assert get_sample_value("plan_vanish_latitude", labels) == 17.8216
+    state = dict(VEHICLE_STATE)
+    del state["gnssLocation"]
+    state["otaCurrentVersionWeek"] = None
+    extraction_plan.execute(state, VIN)
+    assert get_sample_value("plan_vanish_latitude", labels) is None
+    assert (
+        get_sample_value("plan_vanish_version_info", {**labels, "week": "34"}) is None
+    )
+
+    # The series come back when the fields do, even with the same timestamps
+    extraction_plan.execute(VEHICLE_STATE, VIN)
+    assert get_sample_value("plan_vanish_latitude", labels) == 17.8216
+    assert get_sample_value("plan_vanish_version_info", {**labels, "week": "34"}) == 1
+
+
+def test_plan_times_collectors():
+    capacity = gauge("plan_timed_capacity", "Capacity", "batteryCapacity")
+    version = info("plan_timed_version", "Version", {"week": "otaCurrentVersionWeek"})
+    extraction_plan = plan.ExtractionPlan([capacity, version])
+    extraction_plan.enable_timings()
+    extraction_plan.execute(VEHICLE_STATE, VIN)
+
+    get_sample_value = prom.REGISTRY.get_sample_value
+    name = "rivian_exporter_collector_duration_seconds_count"
+    assert get_sample_value(name, {"collector": "plan_timed_capacity"}) == 1
+    assert get_sample_value(name, {"collector": "plan_timed_version"}) == 1
+
+
+def test_plan_sets_state_sets():
+    week = rivian_collectors.RivianStateSet(
+        "plan_state_week", "Week", "otaCurrentVersionWeek"
+    )
+    extraction_plan = plan.ExtractionPlan([week])
+    assert extraction_plan.sources == {"otaCurrentVersionWeek"}
+    other_vin = "OtherVin"
+    extraction_plan.execute(VEHICLE_STATE, VIN)
+    state = dict(VEHICLE_STATE)
+    state["otaCurrentVersionWeek"] = {"timeStamp": "2023-10-05T00:00:00Z", "value": 35}
+    extraction_plan.execute(state, other_vin)
+
+    def value(vin, week):
+        labels = {"vin": vin, "plan_state_week": week}
+        return prom.REGISTRY.get_sample_value("plan_state_week", labels)
+
+    assert (value(VIN, "34"), value(other_vin, "34"), value(other_vin, "35")) == (
+        1,
+        0,
+        1,
+    )
+    # The value learned from the other vehicle shows up on the next poll
+    assert value(VIN, "35") is None
+    extraction_plan.execute(VEHICLE_STATE, VIN)
+    assert (value(VIN, "34"), value(VIN, "35")) == (1, 0)
+
+
+def dropped(reason: str) -> float:
+    value = prom.REGISTRY.get_sample_value(
+        "rivian_exporter_series_dropped_total", {"reason": reason}
+    )
+    return value or 0
+
+
+def test_plan_expires_series_no_longer_reported(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(plan, "monotonic", lambda: now[0])
+    latitude = gauge("plan_ttl_latitude", "Latitude", "gnssLocation", key="latitude")
+    capacity = gauge("plan_ttl_capacity", "Capacity", "batteryCapacity")
+    extraction_plan = plan.ExtractionPlan([latitude, capacity])
+    extraction_plan.series_ttl = 10
+    extraction_plan.execute(VEHICLE_STATE, VIN)
+    assert extraction_plan.series == 2
+
+    now[0] += 5
+    state = dict(VEHICLE_STATE)
+    del state["gnssLocation"]
+    extraction_plan.execute(state, VIN)
+    expired = dropped("expired")
+    assert extraction_plan.expire(1010) == []
+    assert extraction_plan.expire(1011) == []
+
+    get_sample_value = prom.REGISTRY.get_sample_value
+    labels = {"vin": VIN}
+    assert get_sample_value("plan_ttl_latitude", labels) is None
+    assert get_sample_value("plan_ttl_capacity", labels) == 127
+    assert dropped("expired") == expired + 1
+
+    # Once nothing is reported the vehicle is forgotten
+    assert extraction_plan.expire(1016) == [VIN]
+    assert get_sample_value("plan_ttl_capacity", labels) is None
+    assert extraction_plan.series == 0
+    assert VIN not in extraction_plan.bound
+
+    # Its series come back with the vehicle
+    extraction_plan.execute(VEHICLE_STATE, VIN)
+    assert get_sample_value("plan_ttl_latitude", labels) == 17.8216
+
+
+def test_plan_keeps_to_the_series_budget():
+    capacity = gauge("plan_budget_capacity", "Capacity", "batteryCapacity")
+    version = info("plan_budget_version", "Version", {"week": "otaCurrentVersionWeek"})
+    extraction_plan = plan.ExtractionPlan([capacity, version])
+    extraction_plan.max_series = 1
+    refused = dropped("budget")
+    assert extraction_plan.execute(VEHICLE_STATE, VIN) == 1
+    assert extraction_plan.execute(VEHICLE_STATE, "OtherVin") == 0
+
+    get_sample_value = prom.REGISTRY.get_sample_value
+    assert get_sample_value("plan_budget_capacity", {"vin": VIN}) == 127
+    assert get_sample_value("plan_budget_capacity", {"vin": "OtherVin"}) is None
+    version_labels = {"vin": VIN, "week": "34"}
+    assert get_sample_value("plan_budget_version_info", version_labels) is None
+    assert dropped("budget") == refused + 3
+
+    # Refused series are retried, even when unchanged, but only counted once
+    assert extraction_plan.execute(VEHICLE_STATE, "OtherVin") == 0
+    assert dropped("budget") == refused + 3
+    extraction_plan.max_series = 2
+    assert extraction_plan.execute(VEHICLE_STATE, VIN) == 1
+    assert get_sample_value("plan_budget_version_info", version_labels) == 1
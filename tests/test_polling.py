@@ -0,0 +1,75 @@
+import prometheus_client as prom
+import pytest
+
+import rivian_exporter.exporter as exporter
+from rivian_exporter import polling
+
+VIN = "PollingVin"
+
+
+def state(charger="charging_ready", gear="park", power="ready", speed=0):
+    fields = {
+        "chargerState": charger,
+        "gearStatus": gear,
+        "powerState": power,
+        "gnssSpeed": speed,
+    }
+    return {
+        k: {"timeStamp": "2023-10-08T00:00:00Z", "value": v} for k, v in fields.items()
+    }
+
+
+@pytest.mark.parametrize(
+    "vehicle_state,tier",
+    [
+        (state(gear="drive", power="go"), "driving"),
+        # Rolling in neutral, or a gear report lagging behind the speed
+        (state(power="go", speed=30), "driving"),
+        (state(charger="charging_active"), "charging"),
+        (state(power="sleep"), "asleep"),
+        (state(), "awake"),
+        ({}, "awake"),
+    ],
+)
+def test_vehicle_tier(vehicle_state, tier):
+    assert polling.vehicle_tier(vehicle_state) == tier
+
+
+def test_interval_follows_tier():
+    adaptive = polling.AdaptivePolling(120, {"asleep": 1800})
+    assert adaptive.interval(VIN) == 120
+
+    def tier(name):
+        labels = {"vin": VIN, "tier": name}
+        return prom.REGISTRY.get_sample_value("rivian_exporter_poll_tier", labels)
+
+    adaptive.update(VIN, state(gear="drive", power="go"))
+    assert adaptive.interval(VIN) == polling.DEFAULT_INTERVALS["driving"]
+    assert tier("driving") == 1 and tier("asleep") == 0
+
+    adaptive.update(VIN, state(power="sleep"))
+    assert adaptive.interval(VIN) == 1800
+    assert tier("driving") == 0 and tier("asleep") == 1
+    labels = {"vin": VIN}
+    interval = prom.REGISTRY.get_sample_value(
+        "rivian_exporter_poll_interval_seconds", labels
+    )
+    assert interval == 1800
+
+    # Forgotten vehicles lose their series
+    adaptive.forget(VIN)
+    assert adaptive.interval(VIN) == 120
+    assert tier("asleep") is None
+    interval = prom.REGISTRY.get_sample_value(
+        "rivian_exporter_poll_interval_seconds", labels
+    )
+    assert interval is None
+
+
+def test_exporter_polls_at_tier_interval(tmp_path):
+    rivian_exporter = exporter.ReplayExporter(str(tmp_path / "unused.ndjson.gz"))
+    assert rivian_exporter.poll_interval(VIN) == rivian_exporter.scrape_interval
+    rivian_exporter.adapt_polling({"charging": 300})
+    assert polling.SOURCES <= rivian_exporter.properties
+    rivian_exporter.polling.update(VIN, state(charger="charging_active"))
+    assert rivian_exporter.poll_interval(VIN) == 300
@@ -0,0 +1,65 @@
+import gzip
+
+import prometheus_client as prom
+import pytest
+
+import rivian_exporter.exporter as exporter
+from rivian_exporter.recording import Recorder, read_recording
+
+from . import utils
+
+
+@pytest.fixture(autouse=True)
+def registered_collectors():
+    # Only exporter.run() registers the built in collectors
+    exporter.use_collectors(list(exporter.COLLECTORS))
+
+
+def test_recordings_are_appended(tmp_path):
+    path = str(tmp_path / "recording.ndjson.gz")
+    with Recorder(path) as recorder:
+        recorder.write("Vin1", {"n": 1}, recorded_at=10)
+    with Recorder(path) as recorder:
+        recorder.write("Vin2", {"n": 2}, recorded_at=11)
+        recorder.flush()
+
+    recorded = list(read_recording(path))
+    assert [(r.recorded_at, r.vin, r.response) for r in recorded] == [
+        (10, "Vin1", {"n": 1}),
+        (11, "Vin2", {"n": 2}),
+    ]
+
+
+def test_truncated_and_malformed_lines_are_skipped(tmp_path):
+    path = str(tmp_path / "recording.ndjson.gz")
+    with gzip.open(path, "wb") as f:
+        f.write(b'{"recorded_at": 1, "vin": "Vin1", "response": {}}\n')
+        f.write(b"not json\n")
+        f.write(b'{"recorded_at": 2, "vin": "Vin1", "response": {}}\n')
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        # Lose the end of the stream as if the recorder had been killed
+        f.write(data[:-12])
+
+    assert [r.recorded_at for r in read_recording(path)] == [1]
+
+
+async def test_replay_fans_out_to_synthetic_vins(tmp_path):
+    path = str(tmp_path / "recording.ndjson.gz")
+    with Recorder(path) as recorder:
+        recorder.write("Replayed", utils.vehicle_data(), recorded_at=100)
+        recorder.write("Replayed", utils.vehicle_data(), recorded_at=160)
+
+    replay = exporter.ReplayExporter(path, speed=0, fanout=3)
+    updated = []
+    replay.add_listener(updated.append)
+    assert await replay.replay() == 6
+
+    assert sorted(replay.states) == ["Replayed-0000", "Replayed-0001", "Replayed-0002"]
+    assert len(updated) == 6
+    for vin in replay.states:
+        level = prom.REGISTRY.get_sample_value(
+            "rivian_battery_level_ratio", {"vin": vin}
+        )
+        assert level is not None
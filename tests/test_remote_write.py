@@ -0,0 +1,93 @@
+import asyncio
+import os
+
+import prometheus_client as prom
+
+import rivian_exporter.exporter as exporter
+from rivian_exporter import remote_write
+from rivian_exporter.remote_write import RemoteWriter, Sample, SampleQueue
+
+from . import utils
+
+VIN = "PushedVin"
+
+
+def test_encode_write_request():
+    samples = [
+        Sample("rivian_speed", {"vin": VIN}, 2.5, 2000),
+        Sample("rivian_speed", {"vin": VIN}, 1.5, 1000),
+        Sample("rivian_gear_info", {"vin": VIN, "gear": "drive"}, 1.0, 1000),
+    ]
+    body = remote_write.snappy_literal(remote_write.encode_write_request(samples))
+    assert utils.decode_write_request(body) == {
+        (("__name__", "rivian_speed"), ("vin", VIN)): [(1000, 1.5), (2000, 2.5)],
+        (("__name__", "rivian_gear_info"), ("gear", "drive"), ("vin", VIN)): [
+            (1000, 1.0)
+        ],
+    }
+
+
+def test_snappy_literal_long_input():
+    data = bytes(range(256)) * 1000
+    assert utils.snappy_decompress(remote_write.snappy_literal(data)) == data
+
+
+def test_queue_is_bounded_and_persistent(tmp_path):
+    directory = str(tmp_path / "queue")
+    queue = SampleQueue(directory, max_polls=2)
+    for timestamp in (1, 2, 3):
+        queue.put([Sample("rivian_speed", {"vin": VIN}, 1.0, timestamp)])
+    assert len(queue) == 2
+
+    reopened = SampleQueue(directory, max_polls=2)
+    names, samples = reopened.peek(10)
+    assert [sample.timestamp for sample in samples] == [2, 3]
+    reopened.remove(names)
+    assert os.listdir(directory) == []
+
+
+async def test_polls_are_pushed_after_the_endpoint_recovers(tmp_path):
+    async with utils.FakeRemoteWriteReceiver(statuses=[503]) as receiver:
+        queue = SampleQueue(str(tmp_path / "queue"), max_polls=10)
+        writer = RemoteWriter(
+            receiver.url, exporter.COLLECTORS, queue, retry_min=0.01, retry_max=0.01
+        )
+        state = utils.vehicle_data()["data"]["vehicleState"]
+        writer.observe(VIN, state)
+        # Nothing has changed so there is nothing new to push
+        writer.observe(VIN, state)
+        assert len(queue) == 1
+
+        task = asyncio.create_task(writer.run())
+        await asyncio.wait_for(receiver.received.wait(), 5)
+        # The poll leaves the queue once the response has been read
+        for _ in range(100):
+            if not queue:
+                break
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    assert len(receiver.requests) == 2
+    assert receiver.requests[0].headers["Content-Encoding"] == "snappy"
+    series = receiver.accepted[0]
+    battery = series[(("__name__", "rivian_battery_level_ratio"), ("vin", VIN))]
+    # Stamped with when the vehicle reported it, 2023-10-08T02:06:32.389Z
+    assert battery == [(1696730792389, 0.46)]
+    assert len(queue) == 0
+    assert prom.REGISTRY.get_sample_value(
+        "rivian_exporter_remote_write_failures_total", {"reason": "503"}
+    )
+
+
+def test_forgotten_vehicles_start_afresh(tmp_path):
+    queue = SampleQueue(str(tmp_path / "queue"), max_polls=10)
+    writer = RemoteWriter("http://127.0.0.1:1/write", exporter.COLLECTORS, queue)
+    state = utils.vehicle_data()["data"]["vehicleState"]
+    writer.observe(VIN, state)
+    writer.observe("OtherVin", state)
+    writer.forget(VIN)
+    assert writer.newest
+    assert all(("vin", VIN) not in labels for _, labels in writer.newest)
+    # Written again should it come back
+    writer.observe(VIN, state)
+    assert len(queue) == 3
@@ -5,6 +5,8 @@ from rivian_exporter import rivian_collectors
 
 from .pytest_testslide import testslide
 
+VIN = "TheVin"
+
 VEHICLE_STATE = {
     "alarmSoundStatus": {"timeStamp": "2023-09-29T23:04:12.222Z", "value": "false"},
     "batteryCapacity": {"timeStamp": "2023-09-30T04:35:27.825Z", "value": 127},
@@ -45,8 +47,12 @@ def test_info():
 
 def test_gauge(testslide):
     prom_mock = ts.StrictMock(prom.Gauge)
+    child_mock = ts.StrictMock(prom.Gauge)
     testslide.mock_constructor(prom, "Gauge").to_return_value(prom_mock)
-    testslide.mock_callable(prom_mock, "set").to_return_value(
+    testslide.mock_callable(prom_mock, "labels").for_call(VIN).to_return_value(
+        child_mock
+    )
+    testslide.mock_callable(child_mock, "set").to_return_value(
         None
     ).and_assert_called_once()
     collector = rivian_collectors.gauge(
@@ -61,7 +67,7 @@ def test_gauge(testslide):
     # Check we don't change the value
     assert collector.modifier(127) == 127
 
-    collector.process(VEHICLE_STATE)
+    collector.process(VEHICLE_STATE, VIN)
 
 
 def test_gauge_with_modifier(testslide):
@@ -69,8 +75,12 @@ def test_gauge_with_modifier(testslide):
     The battery level is 52.6%.  Prometheus wants ratios to be from 0-1. Make this divide by 100
     """
     prom_mock = ts.StrictMock(prom.Gauge)
+    child_mock = ts.StrictMock(prom.Gauge)
     testslide.mock_constructor(prom, "Gauge").to_return_value(prom_mock)
-    testslide.mock_callable(prom_mock, "set").for_call(0.526).to_return_value(
+    testslide.mock_callable(prom_mock, "labels").for_call(VIN).to_return_value(
+        child_mock
+    )
+    testslide.mock_callable(child_mock, "set").for_call(0.526).to_return_value(
         None
     ).and_assert_called_once()
     collector = rivian_collectors.gauge(
@@ -79,13 +89,17 @@ def test_gauge_with_modifier(testslide):
         "batteryLevel",
         modifier=lambda v: v / 100,
     )
-    collector.process(VEHICLE_STATE)
+    collector.process(VEHICLE_STATE, VIN)
 
 
 def test_gauge_with_getter(testslide):
     prom_mock = ts.StrictMock(prom.Gauge)
+    child_mock = ts.StrictMock(prom.Gauge)
     testslide.mock_constructor(prom, "Gauge").to_return_value(prom_mock)
-    testslide.mock_callable(prom_mock, "set").for_call(17.8216).to_return_value(
+    testslide.mock_callable(prom_mock, "labels").for_call(VIN).to_return_value(
+        child_mock
+    )
+    testslide.mock_callable(child_mock, "set").for_call(17.8216).to_return_value(
         None
     ).and_assert_called_once()
     collector = rivian_collectors.gauge(
@@ -94,10 +108,56 @@ def test_gauge_with_getter(testslide):
         "gnssLocation",
         getter=lambda v: v["latitude"],
     )
-    collector.process(VEHICLE_STATE)
+    collector.process(VEHICLE_STATE, VIN)
 
 
 def test_info_function_expands_data_dict():
     i = rivian_collectors.info("name", "desc", {"key": "rivian_value"})
     expected_data_dict = {"key": ("rivian_value", "value")}
     assert i.data == expected_data_dict
+
+
+def test_gauge_family_with_sample_timestamps():
+    collector = rivian_collectors.gauge(
+        "family_battery_capacity_kwh", "Battery capacity", "batteryCapacity"
+    )
+    family = collector.family({VIN: VEHICLE_STATE}, timestamps=True)
+    (sample,) = family.samples
+    assert sample.labels == {"vin": VIN}
+    assert sample.value == 127
+    assert sample.timestamp == 1696048527.825
+
+
+def test_state_set_learns_values_up_to_a_cap():
+    state_set = rivian_collectors.RivianStateSet(
+        "test_state_set", "description", "gear", max_states=3, registry=None
+    )
+    assert [state_set.learn(v) for v in ("park", "drive", "reverse", "park")] == [
+        "park",
+        "drive",
+        "other",
+        "park",
+    ]
+    vehicle_state = {
+        "gear": {"timeStamp": "2023-09-30T04:35:27.825Z", "value": "drive"}
+    }
+    samples = state_set.family({VIN: vehicle_state}).samples
+    assert {s.labels["test_state_set"]: s.value for s in samples} == {
+        "park": 0,
+        "drive": 1,
+        "other": 0,
+    }
+
+
+def test_as_state_sets_keeps_static_infos():
+    doors = rivian_collectors.info(
+        "test_doors", "Doors", {"locked": "doorLocked"}, registry=None
+    )
+    version = rivian_collectors.info(
+        "test_version", "Version", {"week": "otaCurrentVersionWeek"}, None, True
+    )
+    converted = rivian_collectors.as_state_sets([doors, version])
+    assert converted[1] is version
+    assert isinstance(converted[0], rivian_collectors.RivianStateSet)
+    assert converted[0].prometheus_label == "test_doors_locked"
+    assert converted[0].sources == ("doorLocked",)
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+from rivian.exceptions import RivianApiRateLimitError
+
+from rivian_exporter import scheduler
+
+
+async def test_ticker_compensates_for_work_time():
+    loop = asyncio.get_running_loop()
+    ticker = scheduler.FixedRateTicker(0.05)
+    start = loop.time()
+    ticker.reset()
+    for _ in range(3):
+        await asyncio.sleep(0.03)  # the "work"
+        await ticker.wait()
+    # Three ticks of 0.05s, not three lots of work plus 0.05s
+    assert loop.time() - start == pytest.approx(0.15, abs=0.03)
+
+
+async def test_ticker_skips_missed_ticks():
+    loop = asyncio.get_running_loop()
+    ticker = scheduler.FixedRateTicker(0.02)
+    await ticker.wait()
+    await asyncio.sleep(0.05)
+    before = loop.time()
+    await ticker.wait()
+    assert ticker.next_tick is not None
+    assert ticker.next_tick > before
+    assert loop.time() - before < 0.03
+
+
+def test_backoff_grows_with_jitter_and_caps():
+    backoff = scheduler.Backoff(10, 60)
+    for ceiling in (10, 20, 40, 60, 60):
+        delay = backoff.next_delay()
+        assert ceiling / 2 <= delay <= ceiling
+    backoff.reset()
+    assert backoff.next_delay() <= 10
+
+
+@pytest.mark.parametrize(
+    "args,expected",
+    [
+        ((429, {"errors": [{"extensions": {"retryAfter": 120}}]}), 120),
+        ((429, {"errors": [{"extensions": {"Retry-After": "30"}}]}), 30),
+        ((429, {"errors": [{"extensions": {"code": "RATE_LIMIT"}}]}), None),
+        (("Rate limited",), None),
+    ],
+)
+def test_retry_after(args, expected):
+    assert scheduler.retry_after(RivianApiRateLimitError(*args)) == expected
+
+
+async def test_token_bucket_limits_rate():
+    loop = asyncio.get_running_loop()
+    bucket = scheduler.TokenBucket(rate=50, capacity=2)
+    start = loop.time()
+    for _ in range(4):
+        await bucket.acquire()
+    # Two from the burst then two more at 50/s
+    assert loop.time() - start == pytest.approx(0.04, abs=0.02)
+
+
+async def test_token_bucket_pause_holds_everyone():
+    loop = asyncio.get_running_loop()
+    bucket = scheduler.TokenBucket(rate=1000, capacity=10)
+    bucket.pause(0.05)
+    start = loop.time()
+    await asyncio.gather(bucket.acquire(), bucket.acquire())
+    assert loop.time() - start >= 0.05
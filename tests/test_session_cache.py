@@ -0,0 +1,110 @@
+import os
+import stat
+import time
+
+import pytest
+from rivian.exceptions import RivianUnauthenticated
+
+from rivian_exporter import vehicle
+from rivian_exporter.session_cache import SessionCache, fingerprint
+
+CREDENTIALS = {
+    "access_token": "access",
+    "refresh_token": "refresh",
+    "user_session_token": "user",
+}
+SESSION = {**CREDENTIALS, "csrf_token": "csrf", "app_session_token": "app"}
+
+
+def test_session_round_trip(tmp_path):
+    cache = SessionCache(str(tmp_path / "sessions" / "session.json"))
+    assert cache.load(fingerprint(CREDENTIALS)) is None
+    cache.save(fingerprint(CREDENTIALS), SESSION)
+
+    assert cache.load(fingerprint(CREDENTIALS)) == SESSION
+    mode = stat.S_IMODE(os.stat(cache.path).st_mode)
+    assert mode == 0o600
+    # Only the session and its lock are left behind
+    assert sorted(os.listdir(tmp_path / "sessions")) == [
+        "session.json",
+        "session.json.lock",
+    ]
+
+    cache.clear()
+    assert cache.load(fingerprint(CREDENTIALS)) is None
+
+
+def test_session_ignored_for_other_credentials_or_when_expired(tmp_path, monkeypatch):
+    cache = SessionCache(str(tmp_path / "session.json"), max_age=60)
+    cache.save(fingerprint(CREDENTIALS), SESSION)
+    other = {**CREDENTIALS, "refresh_token": "logged in again"}
+    assert cache.load(fingerprint(other)) is None
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.load(fingerprint(CREDENTIALS)) is None
+
+
+def test_corrupt_session_is_ignored(tmp_path):
+    cache = SessionCache(str(tmp_path / "session.json"))
+    with open(cache.path, "w") as f:
+        f.write("{not json")
+    assert cache.load(fingerprint(CREDENTIALS)) is None
+
+
+def credentials_env(monkeypatch):
+    monkeypatch.setenv("ACCESS_TOKEN", "access")
+    monkeypatch.setenv("REFRESH_TOKEN", "refresh")
+    monkeypatch.setenv("USER_SESSION_TOKEN", "user")
+
+
+def test_get_rivian_restores_cached_session(tmp_path, monkeypatch):
+    credentials_env(monkeypatch)
+    cache = SessionCache(str(tmp_path / "session.json"))
+    cache.save(fingerprint(CREDENTIALS), SESSION)
+
+    r = vehicle.get_rivian(cache)
+    assert r._csrf_token == "csrf"
+    assert r._app_session_token == "app"
+
+
+class SessionRivian:
+    """Accepts requests only once a new CSRF token has been created"""
+
+    def __init__(self, csrf_token: str) -> None:
+        self._access_token = "access"
+        self._refresh_token = "refresh"
+        self._user_session_token = "user"
+        self._csrf_token = csrf_token
+        self._app_session_token = "app"
+
+    async def create_csrf_token(self) -> None:
+        self._csrf_token = "fresh"
+
+    async def request(self) -> str:
+        if self._csrf_token != "fresh":
+            raise RivianUnauthenticated("Bad session")
+        return "ok"
+
+    async def reject(self) -> str:
+        raise RivianUnauthenticated("Bad session")
+
+
+async def test_rejected_cached_session_is_replaced(tmp_path, monkeypatch):
+    credentials_env(monkeypatch)
+    cache = SessionCache(str(tmp_path / "session.json"))
+    r = SessionRivian("stale")
+
+    assert await vehicle.with_session(r, cache, r.request) == "ok"
+    cached = cache.load(fingerprint(CREDENTIALS))
+    assert cached is not None and cached["csrf_token"] == "fresh"
+
+
+async def test_rejected_new_session_is_not_cached(tmp_path, monkeypatch):
+    credentials_env(monkeypatch)
+    cache = SessionCache(str(tmp_path / "session.json"))
+    r = SessionRivian("")
+
+    with pytest.raises(RivianUnauthenticated):
+        await vehicle.with_session(r, cache, r.reject)
+    assert cache.load(fingerprint(CREDENTIALS)) is None
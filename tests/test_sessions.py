@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta, timezone
+
+import prometheus_client as prom
+import pytest
+
+from rivian_exporter.sessions import SessionTracker
+
+VIN = "SessionVin"
+START = datetime(2023, 10, 8, tzinfo=timezone.utc)
+
+
+def state(minutes, charger, gear, power, level, mileage):
+    reported = (START + timedelta(minutes=minutes)).isoformat()
+    fields = {
+        "chargerState": charger,
+        "gearStatus": gear,
+        "powerState": power,
+        "batteryLevel": level,
+        "batteryCapacity": 100,
+        "vehicleMileage": mileage,
+    }
+    return {k: {"timeStamp": reported, "value": v} for k, v in fields.items()}
+
+
+# Minutes, chargerState, gearStatus, powerState, batteryLevel, vehicleMileage
+REPLAY = [
+    # Already charging when the exporter starts, so it isn't counted
+    (0, "charging_active", "park", "ready", 40, 1000),
+    (10, "charging_complete", "park", "ready", 45, 1000),
+    (20, "charging_ready", "park", "sleep", 45, 1000),
+    # A 90 minute session adding 30 kWh
+    (30, "charging_active", "park", "ready", 45, 1000),
+    (60, "charging_active", "park", "ready", 55, 1000),
+    (120, "charging_complete", "park", "ready", 75, 1000),
+    # A 30 minute, 40 km trip
+    (130, "charging_complete", "drive", "go", 75, 1000),
+    (145, "charging_complete", "drive", "go", 70, 21000),
+    (160, "charging_complete", "park", "go", 65, 41000),
+    # Reversing and back into park goes nowhere
+    (170, "charging_complete", "reverse", "go", 65, 41000),
+    (171, "charging_complete", "park", "go", 65, 41000),
+]
+
+
+def test_replayed_sessions():
+    registry = prom.CollectorRegistry()
+    tracker = SessionTracker(registry)
+    for poll in REPLAY:
+        tracker.update(VIN, state(*poll))
+        # Repeated polls of the same state change nothing
+        tracker.update(VIN, state(*poll))
+
+    def value(name, labels=None):
+        return registry.get_sample_value(name, labels or {})
+
+    assert value("rivian_charging_sessions_total", {"vin": VIN}) == 1
+    assert value("rivian_charging_session_duration_seconds_sum") == 90 * 60
+    assert value("rivian_charging_session_energy_kwh_sum") == pytest.approx(30)
+    assert value("rivian_trips_total", {"vin": VIN}) == 1
+    assert value("rivian_trip_distance_meters_sum") == 40000
+    assert value("rivian_trip_duration_seconds_sum") == 30 * 60
+    assert value("rivian_trip_average_speed_kph_sum") == pytest.approx(80)
+    for session in ("charging", "trip"):
+        assert value("rivian_session_active", {"vin": VIN, "session": session}) == 0
+
+
+def test_sessions_in_progress_are_active():
+    registry = prom.CollectorRegistry()
+    tracker = SessionTracker(registry)
+    tracker.update(VIN, state(0, "charging_ready", "park", "ready", 50, 1000))
+    tracker.update(VIN, state(5, "charging_active", "drive", "go", 50, 1000))
+    for session in ("charging", "trip"):
+        labels = {"vin": VIN, "session": session}
+        assert registry.get_sample_value("rivian_session_active", labels) == 1
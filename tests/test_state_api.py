@@ -0,0 +1,82 @@
+from typing import Mapping
+
+import aiohttp
+
+from rivian_exporter import http_server, state_api
+
+VIN = "StateApiVin"
+
+
+def state(level: float) -> dict:
+    return {
+        "batteryLevel": {"timeStamp": "2023-10-08T00:00:00Z", "value": level},
+        "gnssSpeed": {"timeStamp": "2023-10-08T00:00:00Z", "value": 0},
+    }
+
+
+async def get(
+    server: http_server.MetricsServer, path: str, **headers
+) -> tuple[int, Mapping[str, str], bytes]:
+    assert server.runner
+    port = server.runner.addresses[0][1]
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            f"http://127.0.0.1:{port}{path}", headers=headers
+        ) as response:
+            return response.status, response.headers.copy(), await response.read()
+
+
+async def test_conditional_requests_and_fields():
+    states: dict = {}
+    api = state_api.StateApi(states)
+    server = http_server.MetricsServer()
+    server.routes += api.routes()
+    await server.start(0, "127.0.0.1")
+    try:
+        status, _, _ = await get(server, f"/api/vehicles/{VIN}/state")
+        assert status == 404
+
+        states[VIN] = state(50)
+        api.invalidate(VIN)
+        status, headers, body = await get(server, f"/api/vehicles/{VIN}/state")
+        assert status == 200
+        assert b'"batteryLevel"' in body and b'"gnssSpeed"' in body
+        etag = headers["ETag"]
+
+        # Polled again with nothing changed
+        states[VIN] = state(50)
+        api.invalidate(VIN)
+        path = f"/api/vehicles/{VIN}/state"
+        status, headers, body = await get(server, path, **{"If-None-Match": etag})
+        assert status == 304 and body == b""
+        last_modified = headers["Last-Modified"]
+        status, _, _ = await get(server, path, **{"If-Modified-Since": last_modified})
+        assert status == 304
+
+        states[VIN] = state(49)
+        api.invalidate(VIN)
+        status, headers, body = await get(server, path, **{"If-None-Match": etag})
+        assert status == 200 and headers["ETag"] != etag
+
+        status, _, body = await get(server, f"{path}?fields=batteryLevel,missing")
+        assert (
+            body == b'{"batteryLevel":{"timeStamp":"2023-10-08T00:00:00Z","value":49}}'
+        )
+
+        status, _, body = await get(server, "/api/vehicles/state?fields=gnssSpeed")
+        assert body.startswith(b'{"StateApiVin":{"gnssSpeed":')
+        status, _, body = await get(server, "/api/vehicles")
+        assert body == b'{"vins": ["StateApiVin"]}'
+    finally:
+        await server.stop()
+
+
+def test_renders_once_per_update():
+    states = {VIN: state(50)}
+    api = state_api.StateApi(states)
+    first = api.render(VIN, None)
+    # Changes without an update aren't picked up, as the exporter always notifies
+    states[VIN] = state(10)
+    assert api.render(VIN, None) is first
+    api.invalidate(VIN)
+    assert api.render(VIN, None).etag != first.etag
@@ -0,0 +1,95 @@
+import asyncio
+
+import aiohttp
+import prometheus_client as prom
+import pytest
+import rivian
+import testslide as ts
+
+import rivian_exporter.exporter as exporter
+import rivian_exporter.vehicle as vehicle
+
+from . import utils
+from .pytest_testslide import testslide
+
+VIN = "SubscribedVin"
+
+
+@pytest.fixture(autouse=True)
+def registered_collectors():
+    # Only exporter.run() registers the built in collectors
+    exporter.use_collectors(list(exporter.COLLECTORS))
+
+
+def battery_level() -> float | None:
+    return prom.REGISTRY.get_sample_value("rivian_battery_level_ratio", {"vin": VIN})
+
+
+async def test_subscription_applies_frames_then_falls_back_to_polling(testslide):
+    async with utils.FakeWebSocketServer(
+        utils.subscription_frames(), close_message="Unauthenticated"
+    ) as server, aiohttp.ClientSession() as session:
+        testslide.patch_attribute(rivian.rivian, "GRAPHQL_WEBSOCKET", server.url)
+        testslide.patch_attribute(exporter, "SUBSCRIPTION_CHECK_INTERVAL", 0.01)
+        testslide.mock_callable(vehicle, "get_rivian").to_return_value(
+            rivian.Rivian(session=session)
+        )
+        rivian_exporter = exporter.RivianExporter([VIN], scrape_interval=0)
+        polled = asyncio.Event()
+        polls = []
+
+        async def get_vehicle_state(vin):
+            polls.append(vin)
+            if len(polls) > 1:
+                polled.set()
+            return utils.vehicle_data()
+
+        testslide.mock_async_callable(
+            rivian_exporter, "get_vehicle_state"
+        ).with_implementation(get_vehicle_state)
+
+        task = asyncio.create_task(rivian_exporter.subscription_loop(VIN))
+        await asyncio.wait_for(server.replayed.wait(), 5)
+        await asyncio.sleep(0.1)
+        # The last frame wins and the merged state keeps fields from the poll
+        assert battery_level() == 0.8025
+        state = rivian_exporter.states[VIN]
+        assert state["gearStatus"]["value"] == "drive"
+        assert state["batteryCapacity"]["value"] == 127
+        assert polls == [VIN]
+
+        server.release.set()
+        # The server drops us so the exporter polls instead of resubscribing
+        await asyncio.wait_for(polled.wait(), 5)
+        assert server.connections == 1
+        assert battery_level() != 0.8025
+        task.cancel()
+        await rivian_exporter.rivian.close()
+
+
+def test_partial_update_only_touches_changed_collectors():
+    vin = "PartialVin"
+    data = utils.vehicle_data()
+    exporter.set_prom_metrics(data, vin)
+    state = data["data"]["vehicleState"]
+    state["batteryLevel"] = {"timeStamp": "2023-10-08T04:00:00.000Z", "value": 10}
+    state["gnssSpeed"] = {"timeStamp": "2023-10-08T04:00:00.000Z", "value": 99}
+    exporter.set_partial_prom_metrics(state, {"batteryLevel"}, vin)
+
+    labels = {"vin": vin}
+    get_sample_value = prom.REGISTRY.get_sample_value
+    assert get_sample_value("rivian_battery_level_ratio", labels) == 0.1
+    assert get_sample_value("rivian_speed_kph", labels) == 0
+
+
+def test_subscription_ignores_frames_without_state():
+    updates = []
+    subscription = exporter.VehicleSubscription(
+        ts.StrictMock(rivian.Rivian), VIN, updates.append
+    )
+    subscription.handle({"type": "next", "payload": {"data": None}})
+    subscription.handle(
+        {"type": "next", "payload": {"data": {"vehicleState": {"gnssSpeed": {}}}}}
+    )
+    assert updates == [{"gnssSpeed": {}}]
+    assert subscription.frames == 1
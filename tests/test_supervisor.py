@@ -0,0 +1,143 @@
+import sys
+
+import aiohttp
+import prometheus_client as prom
+from prometheus_client.openmetrics import exposition, parser
+from rivian.exceptions import RivianUnauthenticated
+
+from rivian_exporter import health, http_server, supervisor
+
+VINS = [f"Vin{n:04}" for n in range(200)]
+
+
+def exit_worker(port, vins, options):
+    sys.exit(3)
+
+
+def worker_registry(vin: str, errors: int) -> prom.CollectorRegistry:
+    registry = prom.CollectorRegistry()
+    speed = prom.Gauge("rivian_speed", "Speed", ["vin"], registry=registry)
+    speed.labels(vin).set(10)
+    poll_errors = prom.Counter(
+        "rivian_exporter_poll_errors", "Errors", ["exception"], registry=registry
+    )
+    poll_errors.labels("TimeoutError").inc(errors)
+    return registry
+
+
+def test_shards_are_stable_and_move_little():
+    four = supervisor.assign_shards(VINS, 4)
+    assert four == supervisor.assign_shards(list(VINS), 4)
+    assert sorted(vin for shard in four for vin in shard) == VINS
+    assert all(30 < len(shard) < 70 for shard in four)
+
+    five = supervisor.assign_shards(VINS, 5)
+    moved = [
+        vin for shard, vins in enumerate(four) for vin in vins if vin not in five[shard]
+    ]
+    # Only VINs taken by the new shard move
+    assert set(moved) == set(five[4])
+
+
+def test_merge_labels_shared_series_by_shard():
+    sources = []
+    for shard, vin in enumerate(["VinA", "VinB"]):
+        text = exposition.generate_latest(worker_registry(vin, shard + 1)).decode()
+        sources.append((shard, parser.text_string_to_metric_families(text)))
+    families = {f.name: f for f in supervisor.merge_families(sources)}
+
+    speeds = {s.labels["vin"] for s in families["rivian_speed"].samples}
+    assert speeds == {"VinA", "VinB"}
+    errors = {
+        (s.labels["shard"], s.value)
+        for s in families["rivian_exporter_poll_errors"].samples
+        if s.name.endswith("_total")
+    }
+    assert errors == {("0", 1.0), ("1", 2.0)}
+
+
+async def test_serves_merged_workers():
+    workers = [
+        http_server.MetricsServer(worker_registry(vin, 1)) for vin in ("VinA", "VinB")
+    ]
+    for worker in workers:
+        await worker.start(0, "127.0.0.1")
+    ports = {shard: w.runner.addresses[0][1] for shard, w in enumerate(workers)}
+    # Nothing listens on port 1 so shard 2 is down
+    ports[2] = 1
+    server = supervisor.ShardedMetricsServer(ports)
+    await server.start(0, "127.0.0.1")
+    try:
+        port = server.runner.addresses[0][1]
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                body = await response.text()
+    finally:
+        await server.stop()
+        for worker in workers:
+            await worker.stop()
+
+    assert body.count("# TYPE rivian_speed gauge") == 1
+    assert 'rivian_speed{vin="VinA"} 10.0' in body
+    assert 'rivian_speed{vin="VinB"} 10.0' in body
+    assert (
+        'rivian_exporter_poll_errors_total{exception="TimeoutError",shard="1"}' in body
+    )
+    assert 'rivian_exporter_worker_up{shard="2"} 0.0' in body
+    assert 'rivian_exporter_worker_up{shard="0"} 1.0' in body
+
+
+async def test_merges_worker_health():
+    checks = [health.Health(), health.Health()]
+    checks[0].polled("VinA")
+    checks[1].polled("VinB")
+    checks[1].unauthenticated(RivianUnauthenticated("Bad session"))
+    workers = []
+    for check in checks:
+        worker = http_server.MetricsServer()
+        worker.routes += check.routes()
+        await worker.start(0, "127.0.0.1")
+        workers.append(worker)
+    ports = {shard: w.runner.addresses[0][1] for shard, w in enumerate(workers)}
+    ports[2] = 1
+    server = supervisor.ShardedMetricsServer(ports)
+    await server.start(0, "127.0.0.1")
+    try:
+        port = server.runner.addresses[0][1]
+        reports = {}
+        async with aiohttp.ClientSession() as session:
+            for path in ("/healthz", "/readyz"):
+                async with session.get(f"http://127.0.0.1:{port}{path}") as response:
+                    assert response.status == 503
+                    reports[path] = await response.json()
+    finally:
+        await server.stop()
+        for worker in workers:
+            await worker.stop()
+
+    rejected = "Shard 1: The Rivian session was rejected: Bad session"
+    assert reports["/healthz"]["problems"] == [rejected]
+    assert reports["/readyz"]["problems"] == [rejected, "Shard 2 didn't answer"]
+    assert sorted(reports["/healthz"]["vehicles"]) == ["VinA", "VinB"]
+
+
+async def test_exited_workers_are_restarted(monkeypatch):
+    monkeypatch.setattr(supervisor, "RESTART_BACKOFF_MIN", 0)
+    monkeypatch.setattr(supervisor, "RESTART_BACKOFF_MAX", 0)
+    workers = supervisor.Supervisor(["VinA"], 1, 0, {}, target=exit_worker)
+    workers.start_worker(0)
+    try:
+        crashed = workers.processes[0]
+        crashed.join(30)
+        assert crashed.exitcode == 3
+        workers.check_workers()
+        assert 0 in workers.restart_at
+        workers.check_workers()
+        assert workers.restart_at == {}
+        assert workers.processes[0] is not crashed
+    finally:
+        workers.stop()
+    restarts = supervisor.SUPERVISOR_REGISTRY.get_sample_value(
+        "rivian_exporter_worker_restarts_total", {"shard": "0"}
+    )
+    assert restarts == 1
@@ -1,7 +1,10 @@
+import asyncio
 import json
-from typing import Any
+import struct
+from typing import Any, Iterator, Optional
 
 import rivian
+from aiohttp import web
 from testslide import StrictMock
 
 
@@ -19,3 +22,185 @@ def get_rivian_mock(testslide):
     testslide.mock_async_callable(rivian_mock, "__aexit__").to_return_value(None)
     testslide.mock_async_callable(rivian_mock, "authenticate").to_return_value(None)
     return rivian_mock
+
+
+class FakeWebSocketServer:
+    """
+    A local stand in for the Rivian GraphQL web socket.  It acknowledges the
+    connection, replays recorded `next` frames for each subscription and then
+    closes the socket with `close_message` once `release` is set.
+    """
+
+    def __init__(self, frames: list[dict[str, Any]], close_message: str = "") -> None:
+        self.frames = frames
+        self.close_message = close_message
+        self.replayed = asyncio.Event()
+        self.release = asyncio.Event()
+        self.connections = 0
+        self.runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    async def handler(self, request: web.Request) -> web.WebSocketResponse:
+        self.connections += 1
+        ws = web.WebSocketResponse(protocols=("graphql-transport-ws",))
+        await ws.prepare(request)
+        async for msg in ws:
+            data = json.loads(msg.data)
+            if data["type"] == "connection_init":
+                await ws.send_json({"type": "connection_ack"})
+            elif data["type"] == "subscribe":
+                for frame in self.frames:
+                    await ws.send_json({**frame, "id": data["id"], "type": "next"})
+                self.replayed.set()
+                await self.release.wait()
+                await ws.close(message=self.close_message.encode())
+        return ws
+
+    async def __aenter__(self) -> "FakeWebSocketServer":
+        app = web.Application()
+        app.router.add_get("/", self.handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f"ws://127.0.0.1:{port}/"
+        return self
+
+    async def __aexit__(self, *_exc_info: Any) -> None:
+        assert self.runner
+        await self.runner.cleanup()
+
+
+def subscription_frames() -> Any:
+    with open("tests/data/subscription_frames.json") as f:
+        return json.load(f)
+
+
+def snappy_decompress(data: bytes) -> bytes:
+    """A snappy block decoder, so tests don't need python-snappy"""
+
+    def varint(pos: int) -> tuple[int, int]:
+        value = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                return value, pos
+
+    length, pos = varint(0)
+    out = bytearray()
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+        kind = tag & 3
+        if kind == 0:
+            size = tag >> 2
+            if size >= 60:
+                extra = size - 59
+                size = int.from_bytes(data[pos : pos + extra], "little")
+                pos += extra
+            out += data[pos : pos + size + 1]
+            pos += size + 1
+            continue
+        if kind == 1:
+            size = (tag >> 2 & 7) + 4
+            offset = (tag >> 5) << 8 | data[pos]
+            pos += 1
+        else:
+            extra = 2 if kind == 2 else 4
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos : pos + extra], "little")
+            pos += extra
+        for _ in range(size):
+            out.append(out[-offset])
+    assert len(out) == length
+    return bytes(out)
+
+
+def protobuf_fields(data: bytes) -> Iterator[tuple[int, Any]]:
+    """(field number, value) of a protobuf message, length delimited as bytes"""
+    pos = 0
+
+    def varint() -> int:
+        nonlocal pos
+        value = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                return value
+
+    while pos < len(data):
+        key = varint()
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            yield number, varint()
+        elif wire_type == 1:
+            yield number, struct.unpack("<d", data[pos : pos + 8])[0]
+            pos += 8
+        elif wire_type == 2:
+            size = varint()
+            yield number, data[pos : pos + size]
+            pos += size
+        else:
+            raise ValueError(f"Unexpected wire type {wire_type}")
+
+
+def decode_write_request(body: bytes) -> dict[tuple[tuple[str, str], ...], list]:
+    """{sorted labels: [(timestamp, value)]} of a remote write request"""
+    series = {}
+    for _, encoded in protobuf_fields(snappy_decompress(body)):
+        labels = []
+        samples = []
+        for number, value in protobuf_fields(encoded):
+            fields = dict(protobuf_fields(value))
+            if number == 1:
+                labels.append((fields[1].decode(), fields[2].decode()))
+            else:
+                samples.append((fields.get(2, 0), fields[1]))
+        series[tuple(labels)] = samples
+    return series
+
+
+class FakeRemoteWriteReceiver:
+    """
+    A local stand in for a Prometheus remote write endpoint.  Responds with
+    each of `statuses` in turn, then 204, and keeps the requests it accepted.
+    """
+
+    def __init__(self, statuses: Optional[list[int]] = None) -> None:
+        self.statuses = list(statuses or [])
+        self.requests: list[web.Request] = []
+        self.accepted: list[dict] = []
+        self.received = asyncio.Event()
+        self.runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    async def handler(self, request: web.Request) -> web.Response:
+        self.requests.append(request)
+        body = await request.read()
+        status = self.statuses.pop(0) if self.statuses else 204
+        if status < 300:
+            self.accepted.append(decode_write_request(body))
+            self.received.set()
+        return web.Response(status=status)
+
+    async def __aenter__(self) -> "FakeRemoteWriteReceiver":
+        app = web.Application()
+        app.router.add_post("/api/v1/write", self.handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}/api/v1/write"
+        return self
+
+    async def __aexit__(self, *_exc_info: Any) -> None:
+        assert self.runner
+        await self.runner.cleanup()